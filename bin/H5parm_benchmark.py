@@ -40,6 +40,27 @@ P = lofar.parmdb.parmdb(parmdbFile)
 P2 = lofar.parmdb.parmdb('tmp.parmdb', create=True)
 logging.info("parmdb filename = "+parmdbFile)
 
+######################################################
+logging.info("### Startup time (fresh interpreter)")
+
+import subprocess
+def startupTime(code):
+    start = time.time()
+    for i in xrange(n):
+        subprocess.call([sys.executable, '-c', code])
+    return (time.time() - start)/n
+
+elapsed = startupTime('pass')
+logging.info("Python -- "+str(elapsed)+" s.")
+elapsed = startupTime('import losoto.h5parm')
+logging.info("import h5parm -- "+str(elapsed)+" s.")
+elapsed = startupTime('import losoto.operations')
+logging.info("import operations -- "+str(elapsed)+" s.")
+elapsed = startupTime('import losoto.operations as o; o.getOperation("CLIP")')
+logging.info("load CLIP -- "+str(elapsed)+" s.")
+elapsed = startupTime('import losoto.operations as o\nfor op in o.ops:\n  try: o.getOperation(op)\n  except ImportError: pass')
+logging.info("load all operations -- "+str(elapsed)+" s.")
+
 ######################################################
 logging.info("### Read all frequencies for a pol/dir/station")
 
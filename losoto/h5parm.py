@@ -47,6 +47,150 @@ def openSoltab(h5parmFile, solsetName=None, soltabName=None, address=None, reado
     return solset.getSoltab(soltabName)
 
 
+def _flaggedPercent(weight, chunkSize=2**22):
+    """
+    Percentage of flagged (weight=0) data, reading the weights in chunks along the first axis.
+
+    Parameters
+    ----------
+    weight : pytables array
+        The weight array.
+    chunkSize : int, optional
+        Approximate number of elements read at once, by default 2**22.
+
+    Returns
+    -------
+    float
+        Percentage of flagged data.
+    """
+    size = int(np.prod(weight.shape))
+    if size == 0: return 0.
+    step = max(1, chunkSize // max(1, size // weight.shape[0]))
+    nflagged = 0
+    for i in range(0, weight.shape[0], step):
+        nflagged += np.count_nonzero(weight[i:i+step] == 0)
+    return 100.*nflagged/size
+
+
+def infoToStr(info, filter=None):
+    """
+    Format the dict returned by h5parm.getInfo() as a readable string.
+
+    Parameters
+    ----------
+    info : dict
+        As returned by h5parm.getInfo().
+    filter: str, optional
+        Solution set name filter used to get the info, only reported.
+
+    Returns
+    -------
+    str
+        Info about H5parm contents.
+    """
+    if (sys.version_info > (3, 0)):
+        from itertools import zip_longest
+    else:
+        from itertools import izip_longest as zip_longest
+
+    def grouper(n, iterable, fillvalue=' '):
+        """
+        Groups iterables into specified groups
+
+        Parameters
+        ----------
+        n : int
+            number of iterables to group
+        iterable : iterable
+            iterable to group
+        fillvalue : str
+            value to use when to fill blanks in output groups
+
+        Example
+        -------
+        grouper(3, 'ABCDEFG', 'x') --> ABC DEF Gxx
+        """
+        args = [iter(iterable)] * n
+        return zip_longest(fillvalue=fillvalue, *args)
+
+    def wrap(text, width=80):
+        """
+        Wraps text to given width and returns list of lines
+        """
+        lines = []
+        for paragraph in text.split('\n'):
+            line = []
+            len_line = 0
+            for word in paragraph.split(' '):
+                word.strip()
+                len_word = len(word)
+                if len_line + len_word <= width:
+                    line.append(word)
+                    len_line += len_word + 1
+                else:
+                    lines.append(' '.join(line))
+                    line = [21*' '+word]
+                    len_line = len_word + 22
+            lines.append(' '.join(line))
+        return lines
+
+    text = "\nSummary of %s\n" % info['filename']
+
+    if filter is not None:
+        text += "\nFiltering on solution set name with filter = '{0}'\n".format(filter)
+
+    if len(info['solsets']) == 0:
+        text += "\nNo solution sets found.\n"
+        return text
+
+    # For each solution set, list solution tables, sources, and antennas
+    for solsetName, solsetInfo in info['solsets'].items():
+        text += "\nSolution set '%s':\n" % solsetName
+        text += "=" * len(solsetName) + "=" * 16 + "\n\n"
+
+        # Add direction (source) names
+        text += "Directions: "
+        for src_name1, src_name2, src_name3 in grouper(3, solsetInfo['directions']):
+            text += "{0:}\t{1:}\t{2:}\n            ".format(src_name1, src_name2, src_name3)
+
+        # Add station names
+        text += "\nStations: "
+        for ant1, ant2, ant3, ant4 in grouper(4, solsetInfo['stations']):
+            text += "{0:}\t{1:}\t{2:}\t{3:}\n          ".format(ant1, ant2, ant3, ant4)
+
+        # For each table, add length of each axis and history of
+        # operations applied to the table.
+        for soltabName, soltabInfo in sorted(solsetInfo['soltabs'].items()):
+            if 'error' in soltabInfo:
+                text += "\nSolution table '%s': No valid data found\n" % (soltabName)
+                continue
+            axis_str_list = []
+            for axisName, nslots in soltabInfo['axes']:
+                if nslots > 1:
+                    pls = "s"
+                else:
+                    pls = ""
+                axis_str_list.append("%i %s%s" % (nslots, axisName, pls))
+            text += "\nSolution table '%s' (type: %s): %s\n" % (soltabName, soltabInfo['type'], ", ".join(axis_str_list))
+            if 'flagged' in soltabInfo:
+                text += '    Flagged data: %.3f%%\n' % soltabInfo['flagged']
+
+            # Add some extra attributes stored in screen-type tables
+            if 'screen' in soltabInfo and len(soltabInfo['screen']) > 0:
+                text += '    Screen attributes:\n'
+                for n, v in soltabInfo['screen'].items():
+                    text += '        {0}: {1}\n'.format(n, v)
+
+            # Add history
+            history = "\n".join(soltabInfo['history'])
+            if history != "":
+                text += 4*" " + "History: "
+                joinstr = "\n" + 13*" "
+                text += joinstr.join(wrap(history)) + "\n"
+
+    return text
+
+
 class h5parm( object ):
     """
     Create an h5parm object.
@@ -233,7 +377,63 @@ class h5parm( object ):
         return "sol%03d" % min(list(set(range(1000)) - set(nums)))
 
 
-    def printInfo(self, filter=None, verbose=False):
+    def getInfo(self, filter=None, flagged=True):
+        """
+        Get information on the h5parm contents reading only attributes and array shapes
+        (and the weights if the flagged percentage is requested).
+
+        Parameters
+        ----------
+        filter: str, optional
+            Solution set name to get info for
+        flagged: bool, optional
+            If True, read the weights to compute the percentage of flagged data, by default True.
+
+        Returns
+        -------
+        dict
+            {'filename':str, 'solsets':{solsetName:{'directions':[names], 'stations':[names],
+            'soltabs':{soltabName:{'type':str, 'axes':[[axisName, len],...], 'flagged':percentage (if flagged),
+            'screen':{attrName:value}, 'history':[entries]}}}}}.
+            Soltabs without valid data have only the key 'error'.
+        """
+        def toStr(s):
+            if isinstance(s, bytes) and not isinstance(s, str): return s.decode('utf-8')
+            return s
+
+        def toJson(v):
+            # attributes can be numpy objects
+            if hasattr(v, 'tolist'): return v.tolist()
+            return toStr(v)
+
+        from collections import OrderedDict
+        info = {'filename':self.fileName, 'solsets':OrderedDict()}
+        for solsetName, solset in self.H.root._v_groups.items():
+            if filter is not None and not re.search(filter, solsetName): continue
+            solsetInfo = {'directions':[], 'stations':[], 'soltabs':{}}
+            if 'source' in solset: solsetInfo['directions'] = sorted([toStr(n) for n in solset.source.col('name')])
+            if 'antenna' in solset: solsetInfo['stations'] = sorted([toStr(n) for n in solset.antenna.col('name')])
+
+            for soltabName, soltab in solset._v_groups.items():
+                try:
+                    val = soltab._f_get_child('val')
+                    axesNames = toStr(val.attrs['AXES']).split(',')
+                    soltabInfo = {'type':soltab._v_title, 'axes':[[axisName, int(soltab._f_get_child(axisName).shape[0])] for axisName in axesNames]}
+                    if flagged:
+                        soltabInfo['flagged'] = _flaggedPercent(soltab._f_get_child('weight'))
+                    if soltab._v_title == 'screen':
+                        soltabInfo['screen'] = dict([(n, toJson(soltab._v_attrs[n])) for n in soltab._v_attrs._v_attrnames if n in ['beta', 'freq', 'height', 'order']])
+                    soltabInfo['history'] = [toStr(val.attrs[attr]) for attr in sorted(val.attrs._f_list("user")) if attr[:-3] == 'HISTORY']
+                except tables.exceptions.NoSuchNodeError:
+                    soltabInfo = {'error':'No valid data found'}
+                solsetInfo['soltabs'][soltabName] = soltabInfo
+
+            info['solsets'][solsetName] = solsetInfo
+
+        return info
+
+
+    def printInfo(self, filter=None, verbose=False, flagged=True):
         """
         Used to get readable information on the h5parm file.
 
@@ -243,149 +443,38 @@ class h5parm( object ):
             Solution set name to get info for
         verbose: bool, optional
             If True, return additional info on axes
+        flagged: bool, optional
+            If True, read the weights to report the percentage of flagged data, by default True.
 
         Returns
         -------
         str
             Returns a string with info about H5parm contents.
         """
-        if (sys.version_info > (3, 0)):
-            from itertools import zip_longest
-        else:
-            from itertools import izip_longest as zip_longest
-
-        def grouper(n, iterable, fillvalue=' '):
-            """
-            Groups iterables into specified groups
-
-            Parameters
-            ----------
-            n : int
-                number of iterables to group
-            iterable : iterable
-                iterable to group
-            fillvalue : str
-                value to use when to fill blanks in output groups
-
-            Example
-            -------
-            grouper(3, 'ABCDEFG', 'x') --> ABC DEF Gxx
-            """
-            args = [iter(iterable)] * n
-            return zip_longest(fillvalue=fillvalue, *args)
-
-        def wrap(text, width=80):
-            """
-            Wraps text to given width and returns list of lines
-            """
-            lines = []
-            for paragraph in text.split('\n'):
-                line = []
-                len_line = 0
-                for word in paragraph.split(' '):
-                    word.strip()
-                    len_word = len(word)
-                    if len_line + len_word <= width:
-                        line.append(word)
-                        len_line += len_word + 1
-                    else:
-                        lines.append(' '.join(line))
-                        line = [21*' '+word]
-                        len_line = len_word + 22
-                lines.append(' '.join(line))
-            return lines
-
-        info = "\nSummary of %s\n" % self.fileName
-        solsets = self.getSolsets()
-
-        # Filter on solset name
-        if filter is not None:
-            keys_to_remove = []
-            info += "\nFiltering on solution set name with filter = '{0}'\n".format(filter)
-            solsets = [solset for solset in solsets if re.search(filter, solset.name)]
-
-        if len(solsets) == 0:
-            info += "\nNo solution sets found.\n"
-            return info
-
-        # delete axes value file if already present
-        if verbose and os.path.exists(self.fileName+'-axes_values.txt'):
-            logging.warning('Overwriting '+self.fileName+'-axes_values.txt')
-            os.system('rm '+self.fileName+'-axes_values.txt')
-
-        # For each solution set, list solution tables, sources, and antennas
-        for solset in solsets:
-            info += "\nSolution set '%s':\n" % solset.name
-            info += "=" * len(solset.name) + "=" * 16 + "\n\n"
-
-            # Add direction (source) names
-            sources = sorted( solset.getSou().keys() )
-            info += "Directions: "
-            for src_name1, src_name2, src_name3 in grouper(3, sources):
-                info += "{0:}\t{1:}\t{2:}\n            ".format(src_name1, src_name2, src_name3)
-
-            # Add station names
-            antennas = sorted( solset.getAnt().keys() )
-            info += "\nStations: "
-            for ant1, ant2, ant3, ant4 in grouper(4, antennas):
-                info += "{0:}\t{1:}\t{2:}\t{3:}\n          ".format(ant1, ant2, ant3, ant4)
-
-            # For each table, add length of each axis and history of
-            # operations applied to the table.
-            if verbose:
-                logging.warning('Axes values saved in '+self.fileName+'-axes_values.txt')
-                f = file(self.fileName+'-axes_values.txt','a')
-            soltabs = solset.getSoltabs()
-            names = np.array([s.name for s in soltabs])
-            sorted_soltabs = [x for _, x in sorted(zip(names, soltabs))]
-            for soltab in sorted_soltabs:
-                try:
-                    if verbose:
-                        f.write("### /"+solset.name+"/"+soltab.name+"\n")
-                    logging.debug('Fetching info for '+soltab.name+'.')
-                    axisNames = soltab.getAxesNames()
-                    axis_str_list = []
-                    for axisName in axisNames:
-                        nslots = soltab.getAxisLen(axisName)
-                        if nslots > 1:
-                            pls = "s"
-                        else:
-                            pls = ""
-                        axis_str_list.append("%i %s%s" % (nslots, axisName, pls))
-                        if verbose:
+        info = self.getInfo(filter, flagged)
+
+        if verbose:
+            # write all axes values in a text file
+            axesFile = self.fileName+'-axes_values.txt'
+            if os.path.exists(axesFile):
+                logging.warning('Overwriting '+axesFile)
+            logging.warning('Axes values saved in '+axesFile)
+            with open(axesFile, 'w') as f:
+                for solsetName in info['solsets']:
+                    for soltabName, soltabInfo in sorted(info['solsets'][solsetName]['soltabs'].items()):
+                        if 'error' in soltabInfo: continue
+                        f.write("### /"+solsetName+"/"+soltabName+"\n")
+                        soltab = self.H.get_node('/'+solsetName+'/'+soltabName)
+                        for axisName, axisLen in soltabInfo['axes']:
                             f.write(axisName+": ")
-                            vals = soltab.getAxisValues(axisName)
+                            vals = np.array(soltab._f_get_child(axisName).read())
+                            if vals.dtype.str[0:2] == '|S': vals = vals.astype(str)
                             # ugly hardcoded workaround to print all the important decimal values for time/freq
                             if axisName == 'freq': f.write(" ".join(["{0:.8f}".format(v) for v in vals])+"\n\n")
                             elif axisName == 'time': f.write(" ".join(["{0:.7f}".format(v) for v in vals])+"\n\n")
                             else: f.write(" ".join(["{}".format(v) for v in vals])+"\n\n")
-                    info += "\nSolution table '%s' (type: %s): %s\n" % (soltab.name, soltab.getType(), ", ".join(axis_str_list))
-                    weights = soltab.getValues(weight = True, retAxesVals = False)
-                    info += '    Flagged data: %.3f%%\n' % (100.*np.sum(weights==0)/len(weights.flat))
-
-                    # Add some extra attributes stored in screen-type tables
-                    if soltab.getType() == 'screen':
-                        attr_names = soltab.obj._v_attrs._v_attrnames
-                        add_head = True
-                        for n in attr_names:
-                            if n in ['beta', 'freq', 'height', 'order']:
-                                if add_head:
-                                    info += '    Screen attributes:\n'
-                                    add_head = False
-                                info += '        {0}: {1}\n'.format(n, soltab.obj._v_attrs[n])
-
-                    # Add history
-                    history = soltab.getHistory()
-                    if history != "":
-                        info += 4*" " + "History: "
-                        joinstr = "\n" + 13*" "
-                        info += joinstr.join(wrap(history)) + "\n"
-                except tables.exceptions.NoSuchNodeError:
-                    info += "\nSolution table '%s': No valid data found\n" % (soltab.name)
 
-            if verbose:
-                f.close()
-        return info
+        return infoToStr(info, filter)
 
 
 class Solset( object ):
@@ -689,6 +778,8 @@ class Soltab( object ):
         self.axes = {}
         for axis in self.getAxesNames():
             self.axes[axis] = soltab._f_get_child(axis)
+        # decoded axes values, filled on first access by _getAxisCache()
+        self.axesCache = {}
 
         # initialize selection
         self.setSelection(**args)
@@ -896,7 +987,7 @@ class Soltab( object ):
 
     def getAxisLen(self, axis, ignoreSelection=False):
         """
-        Return an axis lenght.
+        Return an axis lenght. No data are read.
 
         Parameters
         ----------
@@ -910,7 +1001,44 @@ class Soltab( object ):
         int
             The axis lenght.
         """
-        return len(self.getAxisValues(axis, ignoreSelection = ignoreSelection))
+        if axis not in self.getAxesNames():
+            logging.error('Axis \"'+axis+'\" not found.')
+            return None
+
+        axisLen = self.axes[axis].shape[0]
+        if ignoreSelection:
+            return axisLen
+
+        sel = self.selection[self.getAxesNames().index(axis)]
+        if isinstance(sel, slice):
+            start, stop, step = sel.indices(axisLen)
+            return max(0, (stop - start + step - (1 if step > 0 else -1)) // step)
+        else:
+            return len(sel)
+
+
+    @property
+    def shape(self):
+        """
+        Shape of the selected data (as returned by getValues()). No data are read.
+        """
+        return tuple([self.getAxisLen(axis) for axis in self.getAxesNames()])
+
+
+    @property
+    def size(self):
+        """
+        Number of selected data points. No data are read.
+        """
+        return int(np.prod(self.shape))
+
+
+    @property
+    def dtype(self):
+        """
+        Dtype of the values. No data are read.
+        """
+        return self.obj.val.dtype
 
 
     def getAxisType(self, axis):
@@ -955,16 +1083,34 @@ class Soltab( object ):
             return None
 
         if ignoreSelection:
-            axisvalues = np.copy(self.axes[axis])
+            return np.copy(self._getAxisCache(axis))
         else:
             axisIdx = self.getAxesNames().index(axis)
-            axisvalues = np.copy(self.axes[axis][ self.selection[axisIdx] ])
+            return np.copy(self._getAxisCache(axis)[ self.selection[axisIdx] ])
 
-        if axisvalues.dtype.str[0:2] == '|S':
-            # Convert to native string format for python 3
-            return axisvalues.astype(str)
-        else:
-            return axisvalues
+
+    def _getAxisCache(self, axis):
+        """
+        Return all the values of an axis (decoded as native strings if needed).
+        They are read once and then kept in memory, do not modify them.
+
+        Parameters
+        ----------
+        axis : str
+            The name of the axis.
+
+        Returns
+        -------
+        array
+            The cached axis values.
+        """
+        if axis not in self.axesCache:
+            axisvalues = np.array(self.axes[axis].read())
+            if axisvalues.dtype.str[0:2] == '|S':
+                # Convert to native string format for python 3
+                axisvalues = axisvalues.astype(str)
+            self.axesCache[axis] = axisvalues
+        return self.axesCache[axis]
 
 
     def setAxisValues(self, axis, vals):
@@ -985,6 +1131,7 @@ class Soltab( object ):
 
         axisIdx = self.getAxesNames().index(axis)
         self.axes[axis][ self.selection[axisIdx] ] = vals
+        self.axesCache.pop(axis, None)
 
 
     def setValues(self, vals, selection = None, weight = False):
@@ -1052,7 +1199,8 @@ class Soltab( object ):
 
     def __getattr__(self, axis):
         """
-        Links any attribute with an "axis name" to getValuesAxis("axis name")
+        Links any attribute with an "axis name" to getAxisValues("axis name")
+        (served from the axes cache, no data are read)
         also links val and weight to the relative arrays.
 
         Parameters
@@ -1155,9 +1303,9 @@ class Soltab( object ):
                 dataValsRef = self._applyAdvSelection(dataValsRef, refSelection)
 
                 if weight:
-                    dataVals[ np.repeat(dataValsRef, axis=antAxis, repeats=len(self.getAxisValues('ant'))) == 0. ] = 0.
+                    dataVals[ np.repeat(dataValsRef, axis=antAxis, repeats=self.getAxisLen('ant')) == 0. ] = 0.
                 else:
-                    dataVals = dataVals - np.repeat(dataValsRef, axis=antAxis, repeats=len(self.getAxisValues('ant')))
+                    dataVals = dataVals - np.repeat(dataValsRef, axis=antAxis, repeats=self.getAxisLen('ant'))
                     if not self.getType() != 'tec' and not self.getType() != 'clock' and not self.getType() != 'tec3rd':
                         dataVals = normalize_phase(dataVals)
 
@@ -1201,6 +1349,14 @@ class Soltab( object ):
         # get dimensions of non-returned axis (in correct order)
         iterAxesDim = [self.getAxisLen(axis) for axis in self.getAxesNames() if not axis in returnAxes]
 
+        # axes values and, for the iterated axes, the index of each selected value in the complete axis
+        axesVals = {}
+        axesFullIdx = {}
+        for j, axisName in enumerate(self.getAxesNames()):
+            axesVals[axisName] = self.getAxisValues(axisName)
+            if not axisName in returnAxes:
+                axesFullIdx[axisName] = np.arange(self.getAxisLen(axisName, ignoreSelection=True))[self.selection[j]]
+
         # generator to cycle over all the combinations of iterAxes
         # it "simply" gets the indexes of this particular combination of iterAxes
         # and use them to refine the selection.
@@ -1212,19 +1368,19 @@ class Soltab( object ):
                 i = 0
                 for j, axisName in enumerate(self.getAxesNames()):
                     if axisName in returnAxes:
-                        thisAxesVals[axisName] = self.getAxisValues(axisName)
+                        thisAxesVals[axisName] = np.copy(axesVals[axisName])
                         # add a slice with all possible values (main selection is preapplied)
                         refSelection.append(slice(None))
                         # for the return selection use the "main" selection for the return axes
                         returnSelection.append(self.selection[j])
                     else:
                         #TODO: the iteration axes are not into a 1 element array, is it a problem?
-                        thisAxesVals[axisName] = self.getAxisValues(axisName)[axisIdx[i]]
+                        thisAxesVals[axisName] = axesVals[axisName][axisIdx[i]]
                         # add this index to the refined selection, this will return a single value for this axis
                         # an int is appended, this will remove an axis from the final data
                         refSelection.append(axisIdx[i])
                         # for the return selection use the complete axis and find the correct index
-                        returnSelection.append( [self.getAxisValues(axisName, ignoreSelection=True).tolist().index(thisAxesVals[axisName])] )
+                        returnSelection.append( [int(axesFullIdx[axisName][axisIdx[i]])] )
                         i += 1
 
                 # costly command
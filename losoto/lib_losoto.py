@@ -21,15 +21,20 @@ class LosotoParser(ConfigParser):
     ----------
     parsetFile : str
         Name of the parset file.
+    parsetText : str, optional
+        Content of a parset, used in place of parsetFile.
     """
 
-    def __init__(self, parsetFile):
+    def __init__(self, parsetFile=None, parsetText=None):
         ConfigParser.__init__(self, inline_comment_prefixes=('#',';'))
 
+        if parsetText is None:
+            parsetText = open(parsetFile).read()
+
         import StringIO
         config = StringIO.StringIO()
         # add [_global] fake section at beginning
-        config.write('[_global]\n'+open(parsetFile).read())
+        config.write('[_global]\n'+parsetText)
         config.seek(0, os.SEEK_SET)
         self.readfp(config)
 
@@ -167,7 +172,7 @@ def getParAxis( parser, step, axisName ):
     return axisOpt
 
 
-def getStepSoltabs(parser, step, H):
+def getStepSoltabs(parser, step, H, cache=None):
     """
     Return a list of soltabs object for a step and apply selection creteria
 
@@ -182,6 +187,10 @@ def getStepSoltabs(parser, step, H):
     H : h5parm obj
         the h5parm object
 
+    cache : dict, optional
+        {'solset/soltab':(val, weight)} of already read data, used to
+        fill the soltab cache instead of reading it again from disk
+
     Returns
     -------
     list
@@ -202,7 +211,14 @@ def getStepSoltabs(parser, step, H):
         for soltabName in solset.getSoltabNames():
             if any(re.compile(this_stsel).match(solset.name+'/'+soltabName) for this_stsel in stsel):
                 if parser.getstr(step, 'operation').lower() in cacheSteps:
-                    soltabs.append( solset.getSoltab(soltabName, useCache=True) )
+                    address = solset.name+'/'+soltabName
+                    if cache is not None and address in cache:
+                        soltab = solset.getSoltab(soltabName, useCache=False)
+                        soltab.useCache = True
+                        soltab.setCache(*cache[address])
+                        soltabs.append( soltab )
+                    else:
+                        soltabs.append( solset.getSoltab(soltabName, useCache=True) )
                 else:
                     soltabs.append( solset.getSoltab(soltabName, useCache=False) )
 
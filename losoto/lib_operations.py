@@ -10,6 +10,11 @@ import numpy as np
 
 class multiprocManager(object):
 
+    # processes kept alive between managers, see keepAlive() {(procs, funct): [threads, inQueue, outQueue, busy]}
+    _pools = {}
+    _poolsOrder = [] # least recently used first
+    _maxPools = 0
+
     class multiThread(multiprocessing.Process):
         """
         This class is a working thread which load parameters from a queue and
@@ -36,6 +41,35 @@ class multiprocManager(object):
                 self.inQueue.task_done()
 
 
+    @classmethod
+    def keepAlive(cls, maxPools):
+        """
+        Keep the processes alive after wait(): a later manager with the same procs and funct
+        reuses them, with their imported modules and cached data (used by the resident server).
+        maxPools: max number of (procs, funct) sets of processes kept, the least recently used
+        are stopped. 0 (default) stops the processes at each wait().
+        """
+        cls._maxPools = maxPools
+        while len(cls._poolsOrder) > maxPools:
+            cls._stopPool(cls._poolsOrder[0])
+
+    @classmethod
+    def stopAll(cls):
+        """
+        Stop all the processes kept alive.
+        """
+        for key in list(cls._poolsOrder):
+            cls._stopPool(key)
+
+    @classmethod
+    def _stopPool(cls, key):
+        threads, inQueue, outQueue, busy = cls._pools.pop(key)
+        cls._poolsOrder.remove(key)
+        for t in threads:
+            if t.is_alive(): inQueue.put(None)
+        for t in threads:
+            t.join()
+
     def __init__(self, procs=0, funct=None):
         """
         Manager for multiprocessing
@@ -46,17 +80,43 @@ class multiprocManager(object):
         if procs == 0:
             procs = multiprocessing.cpu_count()
         self.procs = procs
+        self.runs = 0
+        self._pool = None
+
+        key = (procs, funct)
+        if self._maxPools > 0 and key in self._pools:
+            pool = self._pools[key]
+            if not pool[3] and all([t.is_alive() for t in pool[0]]):
+                logging.debug('Reusing %i threads...' % self.procs)
+                pool[3] = True
+                self._poolsOrder.remove(key)
+                self._poolsOrder.append(key)
+                self._threads, self.inQueue, self.outQueue = pool[:3]
+                self._pool = pool
+                return
+            elif not pool[3]:
+                # a process died: start a new set
+                self._stopPool(key)
+
         self._threads = []
         self.inQueue = multiprocessing.JoinableQueue()
         self.outQueue = multiprocessing.Queue()
-        self.runs = 0
-        
+
         logging.debug('Spawning %i threads...' % self.procs)
         for proc in xrange(self.procs):
             t = self.multiThread(self.inQueue, self.outQueue, funct)
             self._threads.append(t)
+            if self._maxPools > 0:
+                t.daemon = True # never outlive the process that keeps them
             t.start()
 
+        if self._maxPools > 0 and key not in self._pools:
+            while len(self._poolsOrder) >= self._maxPools:
+                self._stopPool(self._poolsOrder[0])
+            self._pool = [self._threads, self.inQueue, self.outQueue, True]
+            self._pools[key] = self._pool
+            self._poolsOrder.append(key)
+
     def put(self, args):
         """
         Parameters to give to the next jobs sent into queue
@@ -66,24 +126,31 @@ class multiprocManager(object):
 
     def get(self):
         """
-        Return all the results as an iterator
+        Return all the results of the jobs put since the last get() as an iterator
+        It can be used before wait() to reuse the same processes for more rounds of jobs
         """
         # NOTE: do not use queue.empty() check which is unreliable
         # https://docs.python.org/2/library/multiprocessing.html
-        for run in xrange(self.runs):
+        runs, self.runs = self.runs, 0
+        for run in xrange(runs):
             yield self.outQueue.get()
 
     def wait(self):
         """
         Send poison pills to jobs and wait for them to finish
         The join() should kill all the processes
+        If the processes are kept alive (see keepAlive()) just wait for the jobs to finish
         """
-        for t in self._threads:
-            self.inQueue.put(None)
+        if self._pool is None:
+            for t in self._threads:
+                self.inQueue.put(None)
 
         # wait for all jobs to finish
         self.inQueue.join()
 
+        if self._pool is not None:
+            self._pool[3] = False # free for the next manager
+
 
 def reorderAxes( a, oldAxes, newAxes ):
     """
@@ -159,3 +226,478 @@ def normalize_phase(phase):
     # Put nans back
     np.putmask(out, nans, np.nan)
     return out
+
+
+def _windowPad(size):
+    """
+    Padding before/after a running window of a given size, with the
+    same centering used by scipy.ndimage filters (origin=0).
+    """
+    return (size//2, size - 1 - size//2)
+
+
+def nanRunningMedian(vals, size, axes=None, mode='constant', cval=np.nan, chunkSize=2**24):
+    """
+    NaN-aware running median along one or more axes of an N-D array.
+    The other axes are treated as independent series (batch).
+    It gives the same result of scipy.ndimage.generic_filter(vals, np.nanmedian, size=size, mode=mode, cval=cval)
+    but without calling python for each element.
+
+    Parameters
+    ----------
+    vals : array
+        Input values, NaNs are ignored (e.g. flagged data).
+    size : int or list of int
+        Window size along each of the axes.
+    axes : list of int, optional
+        Axes along which to run the median, by default the last len(size) axes.
+    mode : str, optional
+        How to extend the array at the edges, as in scipy.ndimage: 'constant', 'reflect', 'mirror', 'nearest' or 'wrap', by default 'constant'.
+    cval : float, optional
+        Value used outside the edges if mode is 'constant', by default NaN (i.e. ignored).
+    chunkSize : int, optional
+        Max number of elements of the temporary windows array (bounds memory usage), by default 2**24.
+
+    Returns
+    -------
+    array
+        Running median with the same shape of vals, NaN where all the window is NaN.
+    """
+    padModes = {'constant':'constant', 'reflect':'symmetric', 'mirror':'reflect', 'nearest':'edge', 'wrap':'wrap'}
+    if mode not in padModes:
+        raise ValueError('Unknown mode: '+str(mode))
+
+    vals = np.asarray(vals, dtype=float)
+    if np.isscalar(size): size = [size]
+    size = [int(s) for s in size]
+    if axes is None: axes = list(range(vals.ndim - len(size), vals.ndim))
+    axes = [ax % vals.ndim for ax in axes]
+    if len(axes) != len(size):
+        raise ValueError('Axes and size must have the same length.')
+
+    # move the window axes at the end and put all the others in a single batch axis
+    batchAxes = [ax for ax in range(vals.ndim) if ax not in axes]
+    transp = batchAxes + axes
+    valsT = np.transpose(vals, transp)
+    shapeT = valsT.shape
+    valsT = valsT.reshape((-1,)+shapeT[len(batchAxes):])
+
+    # pad the window axes and get a (batch, window axes..., window...) view of all the windows
+    padWidth = [(0, 0)] + [_windowPad(s) for s in size]
+    if mode == 'constant':
+        padded = np.pad(valsT, padWidth, mode='constant', constant_values=cval)
+    else:
+        padded = np.pad(valsT, padWidth, mode=padModes[mode])
+    windows = np.lib.stride_tricks.as_strided(padded, shape=valsT.shape+tuple(size),
+                strides=padded.strides+padded.strides[1:])
+
+    def median(w):
+        w = np.sort(w.reshape(-1, windowSize), axis=1) # copy, NaNs go at the end
+        nvalid = windowSize - np.sum(np.isnan(w), axis=1)
+        rows = np.arange(w.shape[0])
+        med = 0.5*(w[rows, np.maximum(nvalid-1, 0)//2] + w[rows, np.minimum(nvalid//2, windowSize-1)])
+        med[nvalid == 0] = np.nan
+        return med
+
+    # process in chunks along the batch axis (or along the first window axis
+    # if a single series is too large) to bound the memory of the copied windows
+    out = np.empty(valsT.shape)
+    if out.size == 0: return vals.copy()
+    windowSize = int(np.prod(size))
+    itemSize = out[0].size * windowSize
+    if itemSize <= chunkSize:
+        step = chunkSize // itemSize
+        chunks = [(slice(i, i+step),) for i in range(0, out.shape[0], step)]
+    else:
+        step = max(1, chunkSize // (itemSize // out.shape[1]))
+        chunks = [(b, slice(i, i+step)) for b in range(out.shape[0]) for i in range(0, out.shape[1], step)]
+    for chunk in chunks:
+        out[chunk] = median(windows[chunk]).reshape(out[chunk].shape)
+
+    return np.transpose(out.reshape(shapeT), np.argsort(transp))
+
+
+def _nanLocalPolyFit(padded, size, degree, chunkSize=2**24):
+    """
+    Weighted least-squares polynomial fit on every running window along the last axis of a
+    2-D (series, padded axis) array. NaNs have zero weight.
+    The polynomial variable is the offset from the window center divided by half the window size.
+
+    Returns
+    -------
+    array, array
+        Fitted coefficients (series, windows, degree+1), NaN where there are not enough valid points,
+        and number of valid points in each window (series, windows).
+    """
+    nwin = padded.shape[1] - size + 1
+    half = max((size-1)//2, 1)
+    x = (np.arange(size) - (size-1)//2) / float(half)
+    xpow = x[:,np.newaxis] ** np.arange(2*degree+1) # (size, 2*degree+1)
+    hankel = np.arange(degree+1)[:,np.newaxis] + np.arange(degree+1)
+
+    coeffs = np.empty((padded.shape[0], nwin, degree+1))
+    nvalid = np.empty((padded.shape[0], nwin), dtype=int)
+    step = max(1, chunkSize // max(nwin*size, 1))
+    for i in range(0, padded.shape[0], step):
+        w = (~np.isnan(padded[i:i+step])).astype(float)
+        wy = np.where(w > 0, padded[i:i+step], 0.)
+        strides = w.strides+w.strides[1:]
+        wWin = np.lib.stride_tricks.as_strided(w, shape=(w.shape[0], nwin, size), strides=strides)
+        wyWin = np.lib.stride_tricks.as_strided(wy, shape=(w.shape[0], nwin, size), strides=strides)
+        # normal equations: A_jk = sum w x^(j+k), b_j = sum w y x^j
+        moments = np.dot(wWin, xpow)
+        A = moments[..., hankel]
+        b = np.dot(wyWin, xpow[:, :degree+1])
+        n = np.rint(moments[..., 0]).astype(int)
+        c = np.empty(b.shape)
+        c.fill(np.nan)
+        good = (n > degree)
+        if good.any():
+            c[good] = np.linalg.solve(A[good], b[good][..., np.newaxis])[..., 0]
+        coeffs[i:i+step] = c
+        nvalid[i:i+step] = n
+
+    return coeffs, nvalid
+
+
+def nanRunningPoly(vals, size, degree, axis=-1):
+    """
+    NaN-aware running polynomial fit along one axis of an N-D array, the other axes are treated as independent series.
+    For each point a polynomial is fitted to the non-NaN values of the window centered on it (nothing is used outside the edges)
+    and evaluated at the center.
+
+    Parameters
+    ----------
+    vals : array
+        Input values, NaNs are ignored (e.g. flagged data).
+    size : int
+        Window size, should be odd.
+    degree : int
+        Degree of the polynomial.
+    axis : int, optional
+        Axis along which to smooth, by default the last.
+
+    Returns
+    -------
+    array
+        Smoothed values with the same shape of vals, NaN where all the window is NaN.
+    """
+    vals = np.swapaxes(np.asarray(vals, dtype=float), axis, -1)
+    shape = vals.shape
+    padded = np.pad(vals.reshape(-1, shape[-1]), [(0, 0), _windowPad(size)], mode='constant', constant_values=np.nan)
+    coeffs, nvalid = _nanLocalPolyFit(padded, size, degree)
+    out = coeffs[..., 0]
+
+    # not enough points to constrain the polynomial: do as numpy polyfit (least-norm solution)
+    for s, j in zip(*np.where((nvalid > 0) & (nvalid <= degree))):
+        data = padded[s, j:j+size]
+        x = np.arange(size)[~np.isnan(data)]
+        p = np.polynomial.polynomial.polyfit(x, data[~np.isnan(data)], deg=degree)
+        out[s, j] = np.polynomial.polynomial.polyval((size-1)//2, p)
+
+    return np.swapaxes(out.reshape(shape), axis, -1)
+
+
+def nanSavitzkyGolay(vals, size, degree, axis=-1, deriv=0, rate=1):
+    """
+    Smooth (and optionally differentiate) data with a Savitzky-Golay filter along one axis of an N-D array,
+    the other axes are treated as independent series.
+    At the extremes the signal is padded with values taken from the signal itself.
+    NaNs are ignored: windows with NaNs are fitted with a weighted least-squares polynomial.
+
+    Parameters
+    ----------
+    vals : array
+        Input values, NaNs are ignored (e.g. flagged data).
+    size : int
+        The length of the window. Must be an odd integer number.
+    degree : int
+        The order of the polynomial used in the filtering. Must be less then `size` - 1.
+    axis : int, optional
+        Axis along which to smooth, by default the last.
+    deriv : int, optional
+        The order of the derivative to compute, by default 0 (only smoothing).
+    rate : float, optional
+        Sampling rate, used for the derivatives, by default 1.
+
+    Returns
+    -------
+    array
+        Smoothed signal (or its n-th derivative) with the same shape of vals, NaN where the window does not have enough valid points.
+
+    References
+    ----------
+    .. [1] A. Savitzky, M. J. E. Golay, Smoothing and Differentiation of
+       Data by Simplified Least Squares Procedures. Analytical
+       Chemistry, 1964, 36 (8), pp 1627-1639.
+    """
+    from math import factorial
+
+    try:
+        size = np.abs(int(size))
+        degree = np.abs(int(degree))
+    except ValueError as msg:
+        raise ValueError("size and degree have to be of type int")
+    if size % 2 != 1 or size < 1:
+        raise TypeError("size must be a positive odd number")
+    if size < degree + 2:
+        raise TypeError("size is too small for the polynomials order")
+    half = (size-1) // 2
+
+    vals = np.swapaxes(np.asarray(vals, dtype=float), axis, -1)
+    shape = vals.shape
+    y = vals.reshape(-1, shape[-1])
+
+    # pad the signal at the extremes with values taken from the signal itself
+    idx = np.arange(1, half+1)[::-1]
+    firstvals = y[:, :1] - np.abs(np.take(y, idx, axis=1, mode='clip') - y[:, :1])
+    lastvals = y[:, -1:] + np.abs(np.take(y, shape[-1]-1-idx[::-1], axis=1, mode='clip') - y[:, -1:])
+    padded = np.concatenate((firstvals, y, lastvals), axis=1)
+
+    # precompute coefficients for windows without NaNs
+    b = np.array([[k**i for i in range(degree+1)] for k in range(-half, half+1)], dtype=float)
+    m = np.linalg.pinv(b)[deriv] * rate**deriv * factorial(deriv)
+    windows = np.lib.stride_tricks.as_strided(padded, shape=(y.shape[0], y.shape[1], size), strides=padded.strides+padded.strides[1:])
+    out = np.dot(windows, m)
+
+    # windows with NaNs: weighted fit
+    bad = np.isnan(out)
+    if bad.any():
+        rows = np.where(bad.any(axis=1))[0]
+        coeffs, nvalid = _nanLocalPolyFit(padded[rows], size, degree)
+        fit = coeffs[..., deriv] / float(max(half, 1))**deriv * rate**deriv * factorial(deriv)
+        out[rows] = np.where(bad[rows], fit, out[rows])
+
+    return np.swapaxes(out.reshape(shape), axis, -1)
+
+
+def runningSum(vals, size, axes=None, mode='constant', cval=0.):
+    """
+    Running (box) sum along one or more axes of an N-D array, computed with cumulative
+    sums so the cost does not depend on the window size. The other axes are treated as independent series.
+
+    Parameters
+    ----------
+    vals : array
+        Input values.
+    size : int or list of int
+        Window size along each of the axes.
+    axes : list of int, optional
+        Axes along which to sum, by default the last len(size) axes.
+    mode : str, optional
+        How to extend the array at the edges, as in scipy.ndimage: 'constant', 'reflect', 'mirror', 'nearest' or 'wrap', by default 'constant'.
+    cval : float, optional
+        Value used outside the edges if mode is 'constant', by default 0.
+
+    Returns
+    -------
+    array
+        Sum of the values inside the window centered on each element, same shape of vals.
+    """
+    padModes = {'constant':'constant', 'reflect':'symmetric', 'mirror':'reflect', 'nearest':'edge', 'wrap':'wrap'}
+    if mode not in padModes:
+        raise ValueError('Unknown mode: '+str(mode))
+
+    vals = np.asarray(vals)
+    if np.isscalar(size): size = [size]
+    size = [int(s) for s in size]
+    if axes is None: axes = list(range(vals.ndim - len(size), vals.ndim))
+    axes = [ax % vals.ndim for ax in axes]
+    if len(axes) != len(size):
+        raise ValueError('Axes and size must have the same length.')
+
+    padWidth = [(0, 0)] * vals.ndim
+    for ax, s in zip(axes, size):
+        padWidth[ax] = _windowPad(s)
+    if mode == 'constant':
+        out = np.pad(vals, padWidth, mode='constant', constant_values=cval)
+    else:
+        out = np.pad(vals, padWidth, mode=padModes[mode])
+
+    # box sum as difference of cumulative sums, one axis at the time
+    for ax, s in zip(axes, size):
+        zeroShape = list(out.shape)
+        zeroShape[ax] = 1
+        cs = np.concatenate((np.zeros(zeroShape, dtype=out.dtype), np.cumsum(out, axis=ax)), axis=ax)
+        n = cs.shape[ax] - s
+        out = np.take(cs, np.arange(s, s+n), axis=ax) - np.take(cs, np.arange(n), axis=ax)
+
+    return out
+
+
+def nanRunningRms(vals, size, axes=None, mode='mirror'):
+    """
+    NaN-aware running rms (standard deviation around the window mean) along one or more axes of an N-D array,
+    the cost does not depend on the window size. The other axes are treated as independent series.
+
+    Parameters
+    ----------
+    vals : array
+        Input values, NaNs are ignored (e.g. flagged data).
+    size : int or list of int
+        Window size along each of the axes.
+    axes : list of int, optional
+        Axes along which to run the window, by default the last len(size) axes.
+    mode : str, optional
+        How to extend the array at the edges, as in scipy.ndimage, by default 'mirror'.
+
+    Returns
+    -------
+    array
+        Running rms with the same shape of vals, NaN where all the window is NaN.
+    """
+    vals = np.asarray(vals, dtype=float)
+    if np.isscalar(size): size = [size]
+    if axes is None: axes = list(range(vals.ndim - len(size), vals.ndim))
+    valid = ~np.isnan(vals)
+    # remove the mean of each series to limit the loss of precision of the cumulative sums
+    with np.errstate(invalid='ignore'):
+        mean = np.nanmean(vals, axis=tuple(axes), keepdims=True) if valid.any() else 0.
+    centered = np.where(valid, vals - mean, 0.)
+
+    n = runningSum(valid.astype(float), size, axes, mode)
+    s = runningSum(centered, size, axes, mode)
+    s2 = runningSum(centered**2, size, axes, mode)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        var = s2/n - (s/n)**2
+    return np.sqrt(np.clip(var, 0, None))
+
+
+def chunkSelections(shape, axes, chunkSize=2**24):
+    """
+    Split an array in chunks along the first axis that is not in axes, so that
+    reductions over axes can be done one chunk at the time with bounded memory.
+
+    Parameters
+    ----------
+    shape : tuple
+        Shape of the array.
+    axes : list of int
+        Axes that must not be split (e.g. the reduction axes).
+    chunkSize : int, optional
+        Approximate max number of elements per chunk, by default 2**24.
+
+    Returns
+    -------
+    list
+        A tuple of slices for each chunk.
+    """
+    batchAxes = [ax for ax in range(len(shape)) if ax not in axes]
+    if batchAxes == [] or np.prod(shape) == 0:
+        return [tuple([slice(None)]*len(shape))]
+    ax = batchAxes[0]
+    step = max(1, chunkSize // (int(np.prod(shape)) // shape[ax]))
+    return [tuple([slice(i, i+step) if a == ax else slice(None) for a in range(len(shape))]) \
+            for i in range(0, shape[ax], step)]
+
+
+def phaseGridSearch(Z, basis, pmin, pmax, n=100, nRefine=3, nGridRefine=21, chunkSize=2**22):
+    """
+    Fit the phase model phase_f = p * basis_f to many series at once with a grid search.
+    For each series t find the p that maximizes Re( sum_f exp(-1j*p*basis_f) * Z[f,t] ),
+    which is the least-squares fit on the unit circle if Z = weight*exp(1j*phase) (flagged data: Z=0).
+    A coarse grid is followed by nRefine finer grids around the best point of each series.
+
+    Parameters
+    ----------
+    Z : array
+        Complex data, shape (freq, series).
+    basis : array
+        Phase per unit of parameter for each freq (e.g. -8.44797245e9/freq for TEC).
+    pmin, pmax : float
+        Range of the coarse grid.
+    n : int, optional
+        Number of points of the coarse grid, by default 100.
+    nRefine : int, optional
+        Number of refinement steps, by default 3.
+    nGridRefine : int, optional
+        Number of points of each refinement grid (spanning +/- one previous step), by default 21.
+    chunkSize : int, optional
+        Max number of elements of the temporary arrays, by default 2**22.
+
+    Returns
+    -------
+    array, array
+        Best parameter and its score for each series (score is 0 for series without data).
+    """
+    Z = np.asarray(Z, dtype=complex)
+    basis = np.asarray(basis, dtype=float)
+    nfreq, nseries = Z.shape
+
+    # coarse grid: matrix products on blocks of grid points and series, keeping the running best of each series
+    grid = np.linspace(pmin, pmax, n)
+    p = np.empty(nseries)
+    bestScore = np.empty(nseries)
+    seriesStep = max(1, chunkSize // max(nfreq, 1))
+    gridStep = max(1, chunkSize // max(nfreq, min(seriesStep, nseries), 1))
+    for j in range(0, nseries, seriesStep):
+        best = np.zeros(len(p[j:j+seriesStep]), dtype=int)
+        bestScore[j:j+seriesStep] = -np.inf
+        for i in range(0, n, gridStep):
+            score = np.real(np.dot(np.exp(-1j*np.outer(grid[i:i+gridStep], basis)), Z[:, j:j+seriesStep]))
+            thisBest = np.argmax(score, axis=0)
+            thisScore = score[thisBest, np.arange(score.shape[1])]
+            # strictly better: ties go to the first grid point, as with a single argmax
+            better = thisScore > bestScore[j:j+seriesStep]
+            best[better] = i + thisBest[better]
+            bestScore[j:j+seriesStep][better] = thisScore[better]
+        p[j:j+seriesStep] = grid[best]
+    delta = (pmax - pmin) / float(max(n-1, 1))
+
+    # finer grids centered on the best point of each series
+    offsets = np.linspace(-1, 1, nGridRefine)
+    ZT = Z.T
+    step = max(1, chunkSize // max(nfreq*nGridRefine, 1))
+    for r in range(nRefine):
+        for i in range(0, nseries, step):
+            grid = p[i:i+step, np.newaxis] + delta*offsets # (series, grid)
+            score = np.real(np.sum(np.exp(-1j*grid[:,:,np.newaxis]*basis) * ZT[i:i+step, np.newaxis, :], axis=2))
+            best = np.argmax(score, axis=1)
+            rows = np.arange(len(best))
+            # keep the previous best if not improved (e.g. no data)
+            better = score[rows, best] > bestScore[i:i+step]
+            p[i:i+step][better] = grid[rows, best][better]
+            bestScore[i:i+step][better] = score[rows, best][better]
+        delta *= 2./(nGridRefine-1)
+
+    return p, bestScore
+
+
+def nanUnwrap(vals, axis=-1, discont=np.pi):
+    """
+    Unwrap phases along one axis of an N-D array skipping NaNs (e.g. flagged data).
+    Each series gives the same result of np.unwrap() on its non-NaN values, NaNs are left in place.
+
+    Parameters
+    ----------
+    vals : array
+        Phases in radians.
+    axis : int, optional
+        Axis along which to unwrap, by default the last.
+    discont : float, optional
+        Maximum discontinuity between values, by default pi.
+
+    Returns
+    -------
+    array
+        Unwrapped phases.
+    """
+    vals = np.swapaxes(np.asarray(vals, dtype=float), axis, -1)
+    shape = vals.shape
+    vals = vals.reshape(-1, shape[-1])
+    valid = ~np.isnan(vals)
+
+    # index of the previous valid element of each element (-1 if none)
+    lastValid = np.maximum.accumulate(np.where(valid, np.arange(shape[-1]), -1), axis=1)
+    prevValid = np.concatenate((-np.ones((vals.shape[0], 1), dtype=int), lastValid[:, :-1]), axis=1)
+    prevVals = vals[np.arange(vals.shape[0])[:, np.newaxis], np.maximum(prevValid, 0)]
+
+    # as np.unwrap()
+    dd = np.where(valid & (prevValid >= 0), vals - prevVals, 0.)
+    ddmod = np.mod(dd + np.pi, 2*np.pi) - np.pi
+    ddmod[(ddmod == -np.pi) & (dd > 0)] = np.pi
+    correct = ddmod - dd
+    correct[np.abs(dd) < discont] = 0
+    out = vals + np.cumsum(correct, axis=1)
+
+    return np.swapaxes(out.reshape(shape), axis, -1)
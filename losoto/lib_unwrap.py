@@ -8,6 +8,24 @@ import scipy.fftpack as fft
 import logging
 import itertools
 
+_fftKernels = {}
+_fftKernelsSize = 64 # max number of cached shapes
+
+def _fft_kernels(shape):
+    """
+    Return the (cached) Fourier kernels used by unwrap_fft() for a given shape.
+    """
+    if shape not in _fftKernels:
+        puRadius = np.roll( np.roll(
+              np.add.outer( np.arange(-shape[0]//2+1,shape[0]//2+1)**2.0,
+                            np.arange(-shape[1]//2+1,shape[1]//2+1)**2.0 ),
+              shape[1]//2+1,axis=1), shape[0]//2+1,axis=0)+1e-9
+        if len(_fftKernels) >= _fftKernelsSize:
+            _fftKernels.clear()
+        _fftKernels[shape] = (puRadius, np.where(puRadius==1e-9,1,puRadius**-1.0))
+    return _fftKernels[shape]
+
+
 def unwrap_fft(phase, iterations=3):
     """
     Unwrap phase using Fourier techniques.
@@ -15,83 +33,86 @@ def unwrap_fft(phase, iterations=3):
     For details, see:
     Marvin A. Schofield & Yimei Zhu, Optics Letters, 28, 14 (2003)
 
+    The phases are unwrapped along the last axis, all the other axes are
+    independent series which are unwrapped at once.
+
     Keyword arguments:
     phase -- array of phase solutions
     iterations -- number of iterations to perform
     """
-    puRadius=lambda x : np.roll( np.roll(
-          np.add.outer( np.arange(-x.shape[0]/2+1,x.shape[0]/2+1)**2.0,
-                        np.arange(-x.shape[1]/2+1,x.shape[1]/2+1)**2.0 ),
-          x.shape[1]/2+1,axis=1), x.shape[0]/2+1,axis=0)+1e-9
-
-    idt,dt=np.fft.ifft2,np.fft.fft2
-    puOp=lambda x : idt( np.where(puRadius(x)==1e-9,1,puRadius(x)**-1.0)*dt(
-          np.cos(x)*idt(puRadius(x)*dt(np.sin(x)))
-         -np.sin(x)*idt(puRadius(x)*dt(np.cos(x))) ) )
+    idt = lambda x : np.fft.ifft2(x, axes=(-2,-1))
+    dt = lambda x : np.fft.fft2(x, axes=(-2,-1))
 
     def phaseUnwrapper(ip):
-       mirrored=np.zeros([x*2 for x in ip.shape])
-       mirrored[:ip.shape[0],:ip.shape[1]]=ip
-       mirrored[ip.shape[0]:,:ip.shape[1]]=ip[::-1,:]
-       mirrored[ip.shape[0]:,ip.shape[1]:]=ip[::-1,::-1]
-       mirrored[:ip.shape[0],ip.shape[1]:]=ip[:,::-1]
+       n0, n1 = ip.shape[-2:]
+       mirrored=np.zeros(ip.shape[:-2]+(2*n0,2*n1))
+       mirrored[...,:n0,:n1]=ip
+       mirrored[...,n0:,:n1]=ip[...,::-1,:]
+       mirrored[...,n0:,n1:]=ip[...,::-1,::-1]
+       mirrored[...,:n0,n1:]=ip[...,:,::-1]
+
+       puRadius, puRadiusInv = _fft_kernels(mirrored.shape[-2:])
+       puOp = idt( puRadiusInv*dt(
+             np.cos(mirrored)*idt(puRadius*dt(np.sin(mirrored)))
+            -np.sin(mirrored)*idt(puRadius*dt(np.cos(mirrored))) ) )
 
        return (ip+2*np.pi*
-             np.round((puOp(mirrored).real[:ip.shape[0],:ip.shape[1]]-ip)
+             np.round((puOp.real[...,:n0,:n1]-ip)
              /2/np.pi))
 
-    phase2D = phase[:, None]
-    i = 0
-    if iterations < 1:
-        interations = 1
-    while i < iterations:
-        i += 1
+    phase2D = np.asarray(phase, dtype=np.float64)[..., None]
+    for i in xrange(max(iterations, 1)):
         phase2D = phaseUnwrapper(phase2D)
 
-    return phase2D[:, 0]
+    return phase2D[..., 0]
+
+
+def _wrap_delta(delta):
+    """
+    Bring phase differences (already reduced with fmod) in [-pi, pi].
+    """
+    return np.where(delta < -np.pi, delta + 2.0 * np.pi,
+                    np.where(delta > np.pi, delta - 2.0 * np.pi, delta))
 
 
 def unwrap(phase, window_size=5):
     """
     Unwrap phase by estimating the trend of the phase signal.
+
+    The phases are unwrapped along the last axis, all the other axes are
+    independent series which are unwrapped at once: only the recurrence in
+    time is sequential.
     """
+    phase = np.asarray(phase, dtype=np.float64)
+
     # Allocate result.
     out = np.zeros(phase.shape)
 
-    windowl = np.array([math.fmod(phase[0], 2.0 * math.pi)] * window_size)
+    windowl = np.repeat(np.fmod(phase[..., 0:1], 2.0 * np.pi), window_size, axis=-1)
 
-    delta = math.fmod(phase[1] - windowl[0], 2.0 * math.pi)
-    if delta < -math.pi:
-        delta += 2.0 * math.pi
-    elif delta > math.pi:
-        delta -= 2.0 * math.pi
-    windowu = np.array([windowl[0] + delta] * window_size)
+    delta = _wrap_delta(np.fmod(phase[..., 1] - windowl[..., 0], 2.0 * np.pi))
+    windowu = np.repeat((windowl[..., 0] + delta)[..., np.newaxis], window_size, axis=-1)
 
-    out[0] = windowl[0]
-    out[1] = windowu[0]
+    out[..., 0] = windowl[..., 0]
+    out[..., 1] = windowu[..., 0]
 
-    meanl = windowl.mean()
-    meanu = windowu.mean()
+    meanl = windowl.mean(axis=-1)
+    meanu = windowu.mean(axis=-1)
     slope = (meanu - meanl) / float(window_size)
 
-    for i in xrange(2, len(phase)):
+    for i in xrange(2, phase.shape[-1]):
         ref = meanu + (1.0 + (float(window_size) - 1.0) / 2.0) * slope
-        delta = math.fmod(phase[i] - ref, 2.0 * math.pi)
+        delta = _wrap_delta(np.fmod(phase[..., i] - ref, 2.0 * np.pi))
 
-        if delta < -math.pi:
-            delta += 2.0 * math.pi
-        elif delta > math.pi:
-            delta -= 2.0 * math.pi
+        out[..., i] = ref + delta
 
-        out[i] = ref + delta
+        windowl[..., :-1] = windowl[..., 1:].copy()
+        windowl[..., -1] = windowu[..., 0]
+        windowu[..., :-1] = windowu[..., 1:].copy()
+        windowu[..., -1] = out[..., i]
 
-        windowl[:-1] = windowl[1:]
-        windowl[-1] = windowu[0]
-        windowu[:-1] = windowu[1:]
-        windowu[-1] = out[i]
-
-        meanl = windowl.mean()
-        meanu = windowu.mean()
+        meanl = windowl.mean(axis=-1)
+        meanu = windowu.mean(axis=-1)
         slope = (meanu - meanl) / float(window_size)
 
     return out
@@ -100,34 +121,34 @@ def unwrap(phase, window_size=5):
 def unwrap_huib( x, window = 10, alpha = 0.01, iterations = 3,
     clip_range = [ 170., 180. ] ):
     """
-    Unwrap the x array, if it is shorter than 2*window, use np.unwrap()
-    """
-    import np as np
-
-    if len(x) < 2*window: return np.unwrap(x)
+    Unwrap the x array (in degrees), if it is shorter than 2*window, use np.unwrap()
 
+    The values are unwrapped along the last axis, all the other axes are
+    independent series which are unwrapped at once, each with its own
+    adaptive filter.
+    """
     xx = np.array( x, dtype = np.float64 )
-#   a = zeros( ( window ), dtype = np.float64 )
-#   a[ -1 ] = 1.
+    if xx.shape[-1] < 2*window:
+        return np.degrees( np.unwrap( np.radians( xx ), axis = -1 ) )
+
     if ( len( clip_range ) == 2 ):
         o = clip_range[ 0 ]
         s = ( clip_range[ 1 ] - clip_range[ 0 ] ) / 90.
-    a = np.ones( ( window ), dtype = np.float64 ) / float( window )
-    xs = xx[ 0 ]
+    a = np.ones( xx.shape[:-1] + ( window, ), dtype = np.float64 ) / float( window )
+    xs = xx[ ..., 0 ].copy()
     for j in xrange( 2 * iterations ):
-        for k in xrange( window, len( x ) ):
-            xi = xx[ k - window : k ]
-            xp = np.dot( xi, a )
-            e = xx[ k ] - xp
+        for k in xrange( window, xx.shape[-1] ):
+            xi = xx[ ..., k - window : k ].copy()
+            xp = np.sum( xi * a, axis = -1 )
+            e = xx[ ..., k ] - xp
             e = np.mod( e + 180., 360. ) - 180.
             if ( len( clip_range ) == 2 ):
-                if ( abs( e ) > o ):
-                    e = sign( e ) * ( s * degrees( atan( radians( ( abs( e ) - o ) / s ) ) ) + o )
-            xx[ k ] = xp + e
-#           a = a + xx[ k - window : k ] * alpha * e / 360.
-            a = a + xi * alpha * e / ( np.dot( xi, xi ) + 1.e-6 )
-        xx = xx[ : : -1 ].copy()
-    xx = xx - xx[ 0 ] + xs
+                e = np.where( np.abs( e ) > o,
+                    np.sign( e ) * ( s * np.degrees( np.arctan( np.radians( ( np.abs( e ) - o ) / s ) ) ) + o ), e )
+            xx[ ..., k ] = xp + e
+            a = a + xi * ( alpha * e / ( np.sum( xi * xi, axis = -1 ) + 1.e-6 ) )[ ..., np.newaxis ]
+        xx = xx[ ..., : : -1 ].copy()
+    xx = xx - xx[ ..., 0:1 ] + xs[ ..., np.newaxis ]
     return xx
 
 # This script implements a DCT-based one-step path independent phase
@@ -139,47 +160,98 @@ def unwrap_huib( x, window = 10, alpha = 0.01, iterations = 3,
 # - Masking out parts of the phase map with zeros also leads to boundary effects.
 # - Use it stand alone or as initial guess for preconditioned conjugate gradient method.
 
-# 2D DCT and inverse
+# 2D DCT and inverse (on the last two axes, the others are independent planes)
 def dct2(arr, inverse=False):
     if inverse:
-        return np.transpose(fft.idct(np.transpose(fft.idct(arr,norm='ortho')),norm='ortho'))
+        return fft.idct(fft.idct(arr,axis=-1,norm='ortho'),axis=-2,norm='ortho')
     else:
-        return np.transpose(fft.dct(np.transpose(fft.dct(arr,norm='ortho')),norm='ortho'))
+        return fft.dct(fft.dct(arr,axis=-1,norm='ortho'),axis=-2,norm='ortho')
+
+_laplacianCoords = {}
+_laplacianCoordsSize = 64 # max number of cached shapes
+
+def _laplacian_coord(shape):
+    """
+    Return the (cached) Fourier domain coordinates (eigenvalues of the Laplacian
+    in the DCT domain) for a grid of the given 2D shape.
+    """
+    if shape not in _laplacianCoords:
+        m = np.arange(shape[1])
+        n = np.arange(shape[0])
+        m,n = np.meshgrid(m,n)
+        m = m.astype(float)
+        n = n.astype(float)
+        m[:,0] = 1/np.sqrt(shape[1])
+        n[0,:] = 1/np.sqrt(shape[0])
+        if len(_laplacianCoords) >= _laplacianCoordsSize:
+            _laplacianCoords.clear()
+        _laplacianCoords[shape] = m*m+n*n
+    return _laplacianCoords[shape]
 
 # Laplace operator and inverse
 def laplacian(arr, inverse=False):
-    # precompute Fourier domain coordinates for the Laplacians of phase_wrapped
-    m = np.arange(arr.shape[1])
-    n = np.arange(arr.shape[0])
-    m,n = np.meshgrid(m,n)
-    m = m.astype(float)
-    n = n.astype(float)
-    m[:,0] = 1/np.sqrt(arr.shape[1])
-    n[0,:] = 1/np.sqrt(arr.shape[0])
-    coord = m*m+n*n
-    m = n = None
+    coord = _laplacian_coord(arr.shape[-2:])
 
     if inverse:
         return dct2(dct2(arr)/coord, inverse=True) # factor -M*N/4/pi**2 omitted
     else:
         return dct2(dct2(arr)*coord, inverse=True) # factor -4*pi**2/M/N omitted
 
+def _fill_flags(arr, flags, coord_x, coord_y):
+    """
+    Replace flagged values of each plane of arr (..., x, y) with the nearest unflagged one.
+    """
+    import scipy.interpolate
+    grid = np.array([x for x in itertools.product(coord_x,coord_y)])
+    flags = np.broadcast_arrays(arr, flags)[1].reshape((-1,)+arr.shape[-2:])
+    arr = arr.reshape((-1,)+arr.shape[-2:]).copy()
+    for plane, planeFlags in zip(arr, flags):
+        planeFlags = np.ndarray.flatten(planeFlags)
+        if not planeFlags.any() or planeFlags.all(): continue
+        plane.flat[planeFlags] = scipy.interpolate.griddata(grid[~planeFlags], plane.flat[~planeFlags], grid[planeFlags], 'nearest')
+    return arr
+
+def _unwrap_2d_planes(arr, flags, coord_x, coord_y, index, outQueue):
+    """
+    Worker for unwrap_2d(): unwrap a stack of planes and put it back with its index.
+    """
+    outQueue.put([index, unwrap_2d(arr, flags, coord_x, coord_y)])
+
 # phase unwrapping, see DOI: 10.3390/jimaging1010031
-def unwrap_2d(arr, flags = None, coord_x = None, coord_y = None):
+def unwrap_2d(arr, flags = None, coord_x = None, coord_y = None, ncpu = 1):
     """
-    if flags are specified do interp
+    Unwrap 2D phase maps up to an additive constant.
+
+    arr can be a single (x, y) map or a stack (..., x, y) of maps on the same grid,
+    which are unwrapped all at once. If flags are specified the flagged values
+    are first replaced by the nearest unflagged ones (this requires coord_x/coord_y).
+    If ncpu != 1 the stack is split among ncpu processes (0 means all available).
     """
+    arr = np.asarray(arr, dtype=float)
     if not flags is None:
-        import scipy.interpolate
         if coord_x is None or coord_y is None:
             logging.error('Cannot unwrap with flags and no coordinates.')
             return
+
+    nPlanes = int(np.prod(arr.shape[:-2]))
+    if ncpu != 1 and nPlanes > 1:
+        from losoto.lib_operations import multiprocManager
         shapeOrig = arr.shape
-        grid = np.array([x for x in itertools.product(coord_x,coord_y)])
-        arr = np.ndarray.flatten(arr)
-        flags = np.ndarray.flatten(flags)
-        arr[flags] = scipy.interpolate.griddata(grid[~flags], arr[~flags], grid[flags], 'nearest')
-        arr = arr.reshape(shapeOrig)
+        if not flags is None:
+            flags = np.broadcast_arrays(arr, flags)[1].reshape((-1,)+shapeOrig[-2:])
+        arr = arr.reshape((-1,)+shapeOrig[-2:])
+        mpm = multiprocManager(ncpu, _unwrap_2d_planes)
+        chunks = np.array_split(np.arange(nPlanes), min(nPlanes, mpm.procs))
+        for i, chunk in enumerate(chunks):
+            mpm.put([arr[chunk], None if flags is None else flags[chunk], coord_x, coord_y, i])
+        mpm.wait()
+        out = np.empty(arr.shape)
+        for i, unwrapped in mpm.get():
+            out[chunks[i]] = unwrapped
+        return out.reshape(shapeOrig)
+
+    if not flags is None:
+        arr = _fill_flags(arr, flags, coord_x, coord_y).reshape(arr.shape)
     return arr + np.round( ( laplacian( np.cos(arr)*laplacian(np.sin(arr)) - np.sin(arr)*laplacian(np.cos(arr)), inverse=True ) - arr ) / 2/np.pi ) * 2*np.pi
 
 if __name__ == "__main__":
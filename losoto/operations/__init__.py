@@ -1,9 +1,64 @@
 import os, time, glob
+import logging
+import importlib
 
-__all__ = [ os.path.basename(f)[:-3] for f in glob.glob(os.path.dirname(__file__)+"/*.py") if f[0] != '_']
+__all__ = [ os.path.basename(f)[:-3] for f in glob.glob(os.path.dirname(__file__)+"/*.py") if os.path.basename(f)[0] != '_']
+
+# Possible operations, linked to the module implementing them.
+# Modules are NOT imported here: each one pulls in its own heavy dependencies
+# (scipy, matplotlib, pyrap...), so they are imported on first use by getOperation().
+ops = {
+               "ABS": "abs",
+               "CLIP": "clip",
+               "CLOCKTEC": "clocktec",
+               "POLALIGN": "polalign",
+               "DIRECTIONSCREEN": "directionscreen",
+               "DUPLICATE": "duplicate",
+               "FARADAY": "faraday",
+               "FLAG": "flag",
+               "FLAGEXTEND": "flagextend",
+               "FLAGSTATION": "flagstation",
+               "INTERPOLATE": "interpolate",
+               "LOFARBEAM": "lofarbeam",
+               "NORM": "norm",
+               "PLOT": "plot",
+               "PLOTSCREEN": "plotscreen",
+               "RESET": "reset",
+               "RESIDUALS": "residuals",
+               "REWEIGHT": "reweight",
+               "SMOOTH": "smooth",
+               "SPLITLEAK": "splitleak",
+               "STRUCTURE": "structure",
+               "PREFACTOR_BANDPASS": "prefactor_bandpass",
+               "PREFACTOR_XYOFFSET": "prefactor_XYoffset",
+               "TEC": "tec",
+               #"TECFIT": "tecfit",
+               #"TECJUMP": "tecjump",
+               #"TECSCREEN": "tecscreen",
+               # example operation
+               #"EXAMPLE": "example"
+}
+
+
+def getOperation(op):
+    """
+    Return the module implementing an operation, importing it on first use.
+
+    Parameters
+    ----------
+    op : str
+        Operation name as written in the parset (e.g. CLIP).
+
+    Returns
+    -------
+    module
+        The operation module (with the _run_parser() and run() functions).
+    """
+    if not op in ops:
+        raise KeyError('Unknown operation: '+op)
+    # import_module caches in sys.modules, so this is cheap after the first call
+    return importlib.import_module('losoto.operations.'+ops[op])
 
-for x in __all__:
-    __import__(x, locals(), globals())
 
 class timer(object):
     """
@@ -19,14 +74,20 @@ class timer(object):
         else: self.log = log
         self.step = step
         self.operation = operation
+        self.elapsed = 0.
+        self.elapsedcpu = 0.
 
     def __enter__(self):
         self.log.info("--> Starting \'" + self.step + "\' step (operation: " + self.operation + ").")
         self.start = time.time()
         self.startcpu = time.clock()
+        return self
 
     def __exit__(self, exit_type, value, tb):
 
+        self.elapsed = time.time() - self.start
+        self.elapsedcpu = time.clock() - self.startcpu
+
         # if not an error
         if exit_type is None:
-            self.log.info("Time for this step: %i s (cpu: %i s)." % ( ( time.time() - self.start), (time.clock() - self.startcpu) ))
+            self.log.info("Time for this step: %i s (cpu: %i s)." % ( self.elapsed, self.elapsedcpu ))
@@ -4,7 +4,9 @@ import numpy as np
 import numpy.ma as ma
 import sys
 import logging
-from multiprocessing import Pool
+import multiprocessing
+import traceback
+from losoto.lib_operations import multiprocManager
 
 has_fitting=True
 try:
@@ -67,104 +69,128 @@ def getInitClock(data, freq):
                 avgdata[ist, :, pol].mask[0] = False
             # logging.debug("mask station %d pol %d "%(ist,pol) +str(mymask))
             # logging.debug("average data station %d pol %d "%(ist,pol) +str(avgdata[ist,:,pol]))
-            avgdata[ist, :, pol][~mymask] = np.float32(unwrapSparsePhases(avgdata[ist, :, pol][~mymask],freq[~mymask]))
+            avgdata[ist, :, pol][~mymask] = np.float32(unwrapSparsePhases(np.ma.getdata(avgdata[ist, :, pol][~mymask]),freq[~mymask])[0])
             # logging.debug("average unwrapped data station %d pol %d "%(ist,pol) +str(avgdata[ist,:,pol]))
             # logging.debug("remainder " +str(np.remainder(avgdata[ist,:,pol]+np.pi,2*np.pi)-np.pi))
     A = np.ones((nF, 2), dtype=np.float)
     A[:, 1] = freq * 2 * np.pi * 1e-9
     return np.ma.dot(np.linalg.inv(np.dot(A.T, A)), np.ma.dot(A.T, avgdata).swapaxes(0, -2))
 
-def unwrapSparsePhases(phases,freqs):
-    '''unwrap phases, using frequency coverage'''
+_lstsqCache = {}
+_lstsqCacheSize = 4096 # max number of cached operators
+
+def _lstsqOperator(A, flags):
+    '''least squares operator inv(A^T W A) A^T W (W=0 for flagged rows, 1 otherwise), cached per design matrix and flag pattern'''
+    key = (A.shape, A.tobytes(), flags.tobytes())
+    if key not in _lstsqCache:
+        Aw = np.where(flags[:, np.newaxis], 0., A)
+        if len(_lstsqCache) >= _lstsqCacheSize:
+            _lstsqCache.clear()
+        _lstsqCache[key] = np.dot(np.linalg.inv(np.dot(Aw.T, Aw)), Aw.T)
+    return _lstsqCache[key]
+
+
+def _gridVariance(pars, A, data, flags):
+    '''variance over the unflagged channels of np.dot(pars, A.T) - data for all the parameter sets (rows of pars),
+    computed from the second moments of A and data, without building the (npars, nF) residual cube'''
+    valid = ~flags
+    Ac = A[valid] - np.mean(A[valid], axis=0)
+    datac = data[valid] - np.mean(data[valid])
+    C = np.dot(Ac.T, Ac) / valid.sum()
+    c = np.dot(Ac.T, datac) / valid.sum()
+    return np.sum(np.dot(pars, C) * pars, axis=1) - 2 * np.dot(pars, c) + np.dot(datac, datac) / valid.sum()
+
+
+def unwrapSparsePhases(phases,freqs,flags=None):
+    '''unwrap phases, using frequency coverage, flagged phases are left untouched. Return phases and flags'''
+    if flags is None:
+        flags=np.zeros(phases.shape,dtype=bool)
+    valid=~flags
     testwraps=np.arange(-25,26,.1)
     dclock=testwraps*1e9/(freqs[-1]-freqs[0])
     A = np.ones((freqs.shape[0], 2), dtype=np.float)
     A[:, 1] = freqs * 2 * np.pi * 1e-9
-    testdata=np.zeros_like(dclock)
-    testdata=np.array([testdata,dclock])
-    fitdata=np.ma.dot(testdata.T,A.T)
-    offsets=np.average(np.remainder(phases[np.newaxis]-fitdata+0.5*np.pi,np.pi)-0.5*np.pi,axis=-1)
+    fitdata=dclock[:,np.newaxis]*A[np.newaxis,valid,1]
+    offsets=np.average(np.remainder(phases[np.newaxis,valid]-fitdata+0.5*np.pi,np.pi)-0.5*np.pi,axis=-1)
     fitdata=fitdata-offsets[:,np.newaxis]
-    wraps=np.ma.round((phases[np.newaxis]-fitdata)/(2*np.pi))
-    nphases=phases[np.newaxis]-wraps*2*np.pi
-    myvar1=np.ma.var((nphases-fitdata[np.newaxis]),axis=-1)
+    wraps=np.round((phases[np.newaxis,valid]-fitdata)/(2*np.pi))
+    nphases=phases[np.newaxis,valid]-wraps*2*np.pi
+    myvar1=np.var((nphases-fitdata),axis=-1)
     idx=np.argmin(myvar1)
 
     dclock=dclock[idx]
-    fitdata=np.ma.dot(np.array([0,dclock]),A.T)+offsets[idx]
-    return unwrapPhases(phases,fitdata=fitdata,doFlag=False)
+    fitdata=np.dot(np.array([0,dclock]),A.T)+offsets[idx]
+    return unwrapPhases(phases,flags,fitdata=fitdata,doFlag=False)
 
 
-def unwrapPhases(phases,fitdata=None,maskrange=15,doFlag=True,flagfitdata=False):
-    '''unwrap phases, remove jumps and get best match with fitdata'''
-    mymask=phases.mask
+def unwrapPhases(phases,flags,fitdata=None,maskrange=15,doFlag=True,flagfitdata=False):
+    '''unwrap phases, remove jumps and get best match with fitdata. Flagged phases (flags True) are left untouched.
+    Return the new phases and flags'''
+    phases=np.array(phases,dtype=np.float)
+    mymask=np.array(flags,dtype=bool)
     for nriter in range(2):
         if fitdata is not None and fitdata.shape == phases.shape:
-            wraps=np.ma.round((phases-fitdata)/(2*np.pi))
-            phases-=wraps*2*np.pi
-            unmasked=np.copy(np.array(phases))
+            wraps=np.round((phases-fitdata)/(2*np.pi))
+            phases[~mymask]-=wraps[~mymask]*2*np.pi
+            unmasked=np.copy(phases)
 
         if fitdata is None:
-            unmasked=np.copy(np.array(phases))
-            unmasked=np.unwrap(unmasked)
-            wraps=np.ma.round((phases-unmasked)/(2*np.pi))
-            phases-=wraps*2*np.pi
+            unmasked=np.unwrap(phases)
+            wraps=np.round((phases-unmasked)/(2*np.pi))
+            phases[~mymask]-=wraps[~mymask]*2*np.pi
         maskpoints=np.where(mymask)[0]
         if maskpoints.shape[0]>0:
+            # linear extrapolation from the maskrange previous (next) points
             Atmp=np.ones((maskrange,2),dtype=np.float64)
             Atmp[:,1]=np.arange(maskrange)
-            Atmpinv=np.linalg.inv(np.dot(Atmp.T,Atmp))
+            Atmpinv=np.dot(np.linalg.inv(np.dot(Atmp.T,Atmp)),Atmp.T)
+            forward=np.dot([1,maskrange],Atmpinv)
+            backward=np.dot([1,-1],Atmpinv)
         doreverse=False
         for i in maskpoints:
             if i<maskrange and i>0:
                 unmasked[i]=unmasked[i-1]
                 doreverse=True
             if i>=maskrange:
-                #print "changing unmasked[",i,"]:",unmasked[i],"into",
-                unmasked[i]=np.dot(np.dot(Atmpinv,np.dot(Atmp.T,unmasked[i-maskrange:i])),[1,maskrange])
-                #print unmasked[i]
+                unmasked[i]=np.dot(forward,unmasked[i-maskrange:i])
         if doreverse:
             for i in maskpoints[::-1]:
                 if i<unmasked.shape[0]-1-maskrange:
-                    #print "changing unmasked[",i,"]:",unmasked[i],"into",
-                    unmasked[i]=np.dot(np.dot(Atmpinv,np.dot(Atmp.T,unmasked[i+1:i+maskrange+1])),[1,-1])    
-                    #print unmasked[i],np.dot(Atmp.T,unmasked[i+1:i+maskrange+1])
+                    unmasked[i]=np.dot(backward,unmasked[i+1:i+maskrange+1])
         if doFlag:
             # detect jumps and remove them
             diffdata=unmasked[1:]-unmasked[:-1]
             #detect bad datapoints since they can destroy unwrapping (if the offset is close to np.pi)
             wrapflags=np.logical_and(np.absolute(diffdata[:-1])>0.4*np.pi,np.absolute(diffdata[1:])>0.4*np.pi)
-            newmask=np.zeros_like(diffdata,dtype=bool)
-            newmask[:-1]=wrapflags
-            diffdata=np.ma.array(diffdata,mask=newmask)
             # use 2.5 pi for calculating jumps, tomake sureyou have a real 2pi jump,instead of a sequence of 2 bad datapoints with order 1pi jump. yes I have seen those in LBA calibrator data
-            phases[1:]-=np.ma.cumsum(np.ma.round(diffdata/(2.5*np.pi)))*2*np.pi  
-            #wrapflags=np.logical_and(np.absolute(np.ma.ediff1d(phases)[:-1])>0.2*np.pi,np.absolute(np.ma.ediff1d(phases)[1:])>0.2*np.pi)
+            jumps=np.round(diffdata/(2.5*np.pi))
+            jumps[:-1][wrapflags]=0
             mymask[1:-1]=np.logical_or(mymask[1:-1],wrapflags)
-            phases.mask=mymask
-            # get best match with fitdata
-        if fitdata is None:
-            #average around 0
-            phases-=np.ma.round(np.ma.average(phases)/(2*np.pi))*np.pi*2
-        else:
-    
-            phases-=np.ma.round(np.ma.average(phases-fitdata)/(2*np.pi))*np.pi*2
-            if flagfitdata:
-                newmask=np.absolute(fitdata-phases)>0.4*np.pi
-                phases.mask=np.logical_or(mymask,newmask)
+            phases[1:][~mymask[1:]]-=np.cumsum(jumps)[~mymask[1:]]*2*np.pi
+        # get best match with fitdata
+        if (~mymask).any():
+            if fitdata is None:
+                #average around 0
+                phases[~mymask]-=np.round(np.average(phases[~mymask])/(2*np.pi))*np.pi*2
+            else:
+                phases[~mymask]-=np.round(np.average(phases[~mymask]-fitdata[~mymask])/(2*np.pi))*np.pi*2
+        if fitdata is not None and flagfitdata:
+            mymask=np.logical_or(mymask,np.absolute(fitdata-phases)>0.4*np.pi)
         if not doFlag or np.sum(wrapflags)==0:
-            return phases
-    return phases
+            return phases,mymask
+    return phases,mymask
 
 
 def getInitPar(
     data,
+    flags,
     freqs, 
     nrTEC=40,
     nrClock=40,
     nrthird=0,
     initsol=tuple()
     ):
+    '''brute force search of the initial parameters, flagged data (flags True) are ignored. Return parameters, unwrapped data and new flags'''
     #decide if flagging shouldbe used when unwrapping, depends on frequency coverage
     avgfreqstep=np.average(freqs[1:]-freqs[:-1])
     if avgfreqstep>2.e6:
@@ -173,213 +199,73 @@ def getInitPar(
     else:
         doFlag=True
     if nrthird>0:
-        A=np.ma.zeros((freqs.shape[0],3),dtype=np.float64)
+        A=np.zeros((freqs.shape[0],3),dtype=np.float64)
         A[:,1]=2*np.pi*1e-9*freqs
         A[:,0]=-8.44797245e9/freqs
         A[:,2]=-1.e21/freqs**3
     else:
-        A=np.ma.zeros((freqs.shape[0],2),dtype=np.float64)
+        A=np.zeros((freqs.shape[0],2),dtype=np.float64)
         A[:,1]=2*np.pi*1e-9*freqs
         A[:,0]=-8.44797245e9/freqs
+    twopi=2 * np.pi * np.ones((freqs.shape[0], ), dtype=np.float)
     a=np.mgrid[int(-nrTEC/2):int(nrTEC/2)+1,-int(nrClock/2):int(nrClock/2)+1]
     if len(initsol)>=2 and not (initsol[0]==0 and initsol[1]==0) and not (initsol[0]==-10 and initsol[1]==-10)  :
-        #print "unwrapping with initsol",initsol
         fitdata=np.dot(initsol,A.T)
-        data=unwrapPhases(data,fitdata,doFlag=doFlag)
+        data,flags=unwrapPhases(data,flags,fitdata,doFlag=doFlag)
     else:
         if doFlag:
-            #print "unwrapping pahses",data.count()
-            data=unwrapPhases(data,doFlag=doFlag)
-            #print "unwrapped pahses",data.count()
+            data,flags=unwrapPhases(data,flags,doFlag=doFlag)
         else:
-            data=unwrapSparsePhases(data,freqs)
-        steps = np.ma.dot(np.ma.dot(np.linalg.inv(np.ma.dot(A[:,:2].T, A[:,:2])), A[:,:2].T), 2 * np.pi * np.ones((freqs.shape[0], ), dtype=np.float))
-        par=np.ma.dot(np.linalg.inv(np.ma.dot(A[:,:2].T,A[:,:2])),np.ma.dot(A[:,:2].T,data))
+            data,flags=unwrapSparsePhases(data,freqs,flags)
+        lstsq=_lstsqOperator(A[:,:2],np.zeros(freqs.shape,dtype=bool))
+        steps=np.dot(lstsq,twopi)
+        par=np.dot(lstsq,np.where(flags,0.,data))
         #get parameters close to 0
-        data-=np.round(np.average(np.round(par/steps)))*2*np.pi
-        par=np.ma.dot(np.linalg.inv(np.ma.dot(A[:,:2].T,A[:,:2])),np.ma.dot(A[:,:2].T,data))
+        data[~flags]-=np.round(np.average(np.round(par/steps)))*2*np.pi
+        par=np.dot(lstsq,np.where(flags,0.,data))
         nrTEC+=np.abs(np.round(par[0]/steps[0]))
         nrClock+=np.abs(np.round(par[1]/steps[1]))
-    if data.mask.sum()<0.5*data.size:
-        A=np.ma.array(A,mask=np.tile(data.mask,(A.shape[1],1)).T)
-    steps = np.ma.dot(np.ma.dot(np.linalg.inv(np.ma.dot(A[:,:2].T, A[:,:2])), A[:,:2].T), 2 * np.pi * np.ones((freqs.shape[0], ), dtype=np.float))
+    # the design matrix ignores flagged data only if they are less than half
+    Aflags=np.zeros(freqs.shape,dtype=bool)
+    if flags.sum()<0.5*flags.size:
+        Aflags=flags
+    lstsq=_lstsqOperator(A[:,:2],Aflags)
+    steps=np.dot(lstsq,twopi)
     #get initial guess, first only for first two parameters
-    par=np.ma.dot(np.linalg.inv(np.ma.dot(A[:,:2].T,A[:,:2])),np.ma.dot(A[:,:2].T,data))
-    
-    #print "intial guess",par,"min 0",a[0][0,0]*steps[0]+par[0],"max 0",a[0][-1,0]*steps[0]+par[0],"min 1",a[1][0,0]*steps[1]+par[1],"max 1",a[1][0,-1]*steps[1]+par[1]
-    bigdata=np.concatenate(tuple([a[i][np.newaxis,:]*steps[i]+par[i] for i  in range(2)]),axis=0).transpose(1,2,0)
-    diffdata=np.dot(bigdata,A[:,:2].T)
-    diffdata-=data[np.newaxis,np.newaxis]
-    idx=np.unravel_index(np.argmin(np.ma.var(diffdata,axis=-1)),diffdata.shape[:-1])     
-    par=bigdata[idx]
+    par=np.dot(lstsq,np.where(flags,0.,data))
+
+    bigdata=np.array([a[i].ravel()*steps[i]+par[i] for i in range(2)]).T
+    par=bigdata[np.argmin(_gridVariance(bigdata,A[:,:2],data,flags))]
     fitdata=np.dot(par,A[:,:2].T)
-    data=unwrapPhases(data,fitdata,doFlag=doFlag,flagfitdata=True)
-    if data.mask.sum()<0.5*data.size:
-        A=np.ma.array(A,mask=np.tile(data.mask,(A.shape[1],1)).T)
+    data,flags=unwrapPhases(data,flags,fitdata,doFlag=doFlag,flagfitdata=True)
+    if flags.sum()<0.5*flags.size:
+        Aflags=flags
     #now add third parameter if needed:
     if nrthird>0:
-        steps = np.ma.dot(np.ma.dot(np.linalg.inv(np.ma.dot(A.T, A)), A.T), 2 * np.pi * np.ones((freqs.shape[0], ), dtype=np.float))
-        par=np.ma.dot(np.linalg.inv(np.ma.dot(A.T,A)),np.ma.dot(A.T,data))
+        lstsq=_lstsqOperator(A,Aflags)
+        steps=np.dot(lstsq,twopi)
+        par=np.dot(lstsq,np.where(flags,0.,data))
         a=np.mgrid[max(-1,int(-nrTEC/2)):min(2,int(nrTEC/2)+1),max(-1,int(-nrClock/2)):min(2,int(nrClock/2)+1),-int(nrthird/2):int(nrthird/2)+1] #assume dTEC and dClock are already close
-        bigdata=np.concatenate(tuple([a[i][np.newaxis,:]*steps[i]+par[i] for i  in range(3)]),axis=0).transpose(1,2,3,0)
-        diffdata=np.ma.dot(bigdata,A.T)
-        diffdata-=data[np.newaxis,np.newaxis,np.newaxis]
-        idx=np.unravel_index(np.argmin(np.ma.var(diffdata,axis=-1)),diffdata.shape[:-1])     
-        par=bigdata[idx]
+        bigdata=np.array([a[i].ravel()*steps[i]+par[i] for i in range(3)]).T
+        par=bigdata[np.argmin(_gridVariance(bigdata,A,data,np.logical_or(flags,Aflags)))]
         fitdata=np.dot(par,A.T)
-        data=unwrapPhases(data,fitdata,doFlag=doFlag)
-    return par,data
+        data,flags=unwrapPhases(data,flags,fitdata,doFlag=doFlag)
+    return par,data,flags
 
 
-def getClockTECFit(
-    ph,
-    freq,
-    stations,
-    initSol=[],
-    returnResiduals=True,
-    chi2cut=1e8,
-    fit3rdorder=False,
-    double_search_space=False
-    ):
-    nT = ph.shape[0]
-    nF = freq.shape[0]
-    nSt = ph.shape[2]
-    data = ph
-    tecarray = np.zeros((nT, nSt), dtype=np.float32)
-    clockarray = np.zeros((nT, nSt), dtype=np.float32)
-
-    if returnResiduals:
-        residualarray = np.zeros((nT, nF, nSt), dtype=np.float32)
-    if fit3rdorder:
-        tec3rdarray= np.zeros((nT, nSt), dtype=np.float32)
-    A = np.ones((nF, 2+fit3rdorder), dtype=np.float)
+def getDesignMatrix(freq, fit3rdorder=False):
+    '''design matrix of the [TEC, clock (ns), 3rd order TEC] fit for the frequencies freq'''
+    A = np.ones((freq.shape[0], 2+fit3rdorder), dtype=np.float)
     A[:, 1] = freq * 2 * np.pi * 1e-9
     A[:, 0] = -8.44797245e9 / freq
     if fit3rdorder:
         A[:, 2] = -1e21 / freq**3
-    steps = np.ma.dot(np.ma.dot(np.linalg.inv(np.ma.dot(A.T, A)), A.T), 2 * np.pi * np.ones((freq.shape[0], ), dtype=np.float)) 
-    succes=False
-    initprevsol=np.zeros(nSt,dtype=bool)
-    nrFail=np.zeros(nSt,dtype=int)
-    sol = np.zeros((nSt, 2+fit3rdorder), dtype=np.float)
-    prevsol = np.zeros_like(sol)
-    n3rd=0
-    for itm in xrange(nT):
-        datatmp=np.ma.copy(data[itm, :])
-        if itm == 0 or not succes:
-            for ist in xrange(nSt):
-                if itm == 0 or not initprevsol[ist]:
-                    if hasattr(initSol, '__len__') and len(initSol) > ist:
-                        sol[ist,:initSol[ist].shape[0]]=initSol[ist]
-                        ndt=1
-                        ndtec=1
-                        if fit3rdorder:
-                            n3rd=1
-                    else:
-                        sol[ist]=0
-                        if fit3rdorder:
-                            n3rd=200
-                        if 'CS' in stations[ist]:
-                            ndt=4
-                            ndtec=10
-                            if 'LBA' in stations[ist]:
-                                ndt=2
-                                ndtec=40
-                        else:
-                            if 'RS' in stations[ist]:
-                                ndt=200
-                                ndtec=80
-                            else:
-                                # large TEC variation for EU stations
-                                ndt=200
-                                ndtec=160
-                            if 'LBA' in stations[ist]:
-                                 ndt=60
-                                 # no init clock possible due to large TEC effect
-                                 #stepsize of dtec is small
-                                 ndtec=320
-                else:
-                    # further steps with non success
-                    sol[ist, :] = prevsol[ist, :]
-                    ndtec=min(nrFail[ist]+1,100)
-                    if not 'CS' in stations[ist]:
-                        ndt=min(nrFail[ist]+1,200)
-                    else:
-                        ndt=min(nrFail[ist]+1,4)
-                    if fit3rdorder:
-                        n3rd=min(nrFail[ist]+1,200)
-                datatmpist = datatmp[:, ist]
-                if datatmpist.count() / float(nF) > 0.5:
-                    # do brutforce and update data, unwrp pdata,update flags
-                    #if ist==23 or ist==25:
-                    #    logging.debug("Getting init par for time %d:station %d ntec %d ndt %d n3rd %d"%(itm,ist,ndtec,ndt,n3rd)+str(sol[ist]))
-                    par,datatmp[:, ist] = getInitPar(datatmpist, freq,nrTEC=ndtec*(1+double_search_space),nrClock=ndt*(1+double_search_space),nrthird=n3rd*(1+double_search_space),initsol=sol[ist,:])
-                    sol[ist, :] = par[:]
-                #if itm%100==0:
-                    #logging.debug("Getting init par for station %d:%d "%(itm,ist)+str(sol[ist]))
-        for ist in xrange(nSt):
-            #now do the real fitting
-            datatmpist=datatmp[:,ist]
-            if datatmpist.count() / float(nF) < 0.5:
-                logging.debug("Too many data points flagged t=%d st=%d flags=%d" % (itm,ist,data[itm,:,ist].count()) + str(sol[ist]))
-                sol[ist] = [-10.,]*sol.shape[1]
-                continue
-            fitdata=np.dot(sol[ist],A.T)
-            datatmpist=unwrapPhases(datatmpist,fitdata)
-            #if itm%100==0:
-            #    logging.debug(" init par for station itm %d:%d "%(itm,ist)+str(sol[ist]))
-            mymask=datatmpist.mask
-            maskedfreq=np.ma.array(freq,mask=mymask)
-            A2=np.ma.array(A,mask=np.tile(mymask,(A.shape[1],1)).T)
-            sol[ist] = np.ma.dot(np.linalg.inv(np.ma.dot(A2.T, A2)), np.ma.dot(A2.T, datatmpist)).T
-            if initprevsol[ist] and np.abs((sol[ist,1]-prevsol[ist,1])/steps[1])>0.5 and (np.abs((sol[ist,1]-prevsol[ist,1])/steps[1])>0.75 or np.abs(np.sum((sol[ist]-prevsol[ist])/steps,axis=-1))>0.5*A2.shape[0]):
-                #logging.debug("removing jumps, par for station %d , itm %d"%(ist,itm)+str(sol[ist])+str(prevsol[ist])+str(steps))
-                sol[ist,:]-=np.round((sol[ist,1]-prevsol[ist,1])/steps[1])*steps
-                #logging.debug("removed jumps, par for station %d "%ist+str(sol[ist])+str(prevsol[ist]))
-            #if itm%100==0:
-            #    logging.debug("par for station itm %d:%d "%(itm,ist)+str(sol[ist]))
-         # calculate chi2 per station
-        residual = data[itm] - np.dot(A, sol.T)
-        tmpresid = residual - residual[:, 0][:, np.newaxis]  # residuals relative to station 0
-        residual = np.ma.remainder(tmpresid + np.pi, 2 * np.pi) - np.pi
-        chi2 = np.ma.sum(np.square(np.degrees(residual)), axis=0) / nF
+    return A
 
-        if returnResiduals:
-            residualarray[itm] = residual
-
-        chi2select = np.logical_or(np.array(chi2 > chi2cut), sol[:, 0] < -5) # select bad points
-        chi2select = np.logical_or(chi2select,initprevsol*np.sum(np.abs((sol-prevsol)/steps),axis=-1)>(0.3*sol.shape[1]*(1+nrFail))) #also discard data where there is a "half" jump for any parameter wrst the previous solution (if previous solution exists). Multiply with number of fails, since after a large number of fails there is no clear match with the previous solution expected anyway...
-        if np.any(chi2select):
-            #logging.debug('high chi2 of fit, itm: %d %d ' % (itm, np.sum(chi2select)) + str(sol[chi2select]) + 'prevsol'+str(prevsol[chi2select])+'stations:' + str(np.arange(nSt)[chi2select]) + ' chi2 ' + str(chi2[chi2select]))
-            logging.debug('High chi2 of fit, itm: %d %d ' % (itm, np.sum(chi2select)) + 'stations:' + str(np.arange(nSt)[chi2select]))
-            succes = False
-            nrFail[chi2select] += 1
-            nrFail[~chi2select] = 0
-            prevsol[np.logical_and(initprevsol == False,chi2select==False)] = sol[np.logical_and(initprevsol == False,chi2select==False)]  # compensate missing prevsol at first rounds
-            prevsol[~chi2select] = 0.5 * prevsol[~chi2select] + 0.5 * sol[~chi2select]  # init solution to 0.5 * this solution + 0.5 previous solution
-            initprevsol[~chi2select] = True # once is True it never becomes False
-        else:
-            # prevsol=np.copy(sol)
-            prevsol[initprevsol==False] = sol[initprevsol == False]  # compensate missing prevsol at first rounds
-            prevsol = 0.5 * prevsol + 0.5 * np.copy(sol)
-            succes = True
-            initprevsol = np.ones(nSt, dtype=bool)
-            nrFail = np.zeros(sol.shape[0], dtype=int)
-        tecarray[itm] = sol[:, 0]
-        clockarray[itm] = sol[:, 1]
-        if fit3rdorder:
-            tec3rdarray[itm]=sol[:, 2]
-    if returnResiduals:
-        if fit3rdorder:
-            return (tecarray, clockarray, residualarray,tec3rdarray)
-        else:
-            return (tecarray, clockarray, residualarray)
-    if fit3rdorder:
-        return (tecarray, clockarray,tec3rdarray)
-    return (tecarray, clockarray)
 
 def getClockTECFitStation(
     ph,
+    flags,
     freq,
     stationname,
     initSol=[],
@@ -388,10 +274,10 @@ def getClockTECFitStation(
     fit3rdorder=False,
     double_search_space=False
     ):
-    '''get the c/t separation per station'''
+    '''get the c/t separation per station, ph and flags (True = flagged) are [time:freq] arrays'''
     nT = ph.shape[0]
     nF = freq.shape[0]
-    data = ph
+    data = np.array(ph, dtype=np.float)
     tecarrayst = np.zeros((nT,), dtype=np.float32)
     clockarrayst = np.zeros((nT,), dtype=np.float32)
 
@@ -399,12 +285,8 @@ def getClockTECFitStation(
         residualarrayst = np.zeros((nT, nF), dtype=np.float32)
     if fit3rdorder:
         tec3rdarrayst= np.zeros((nT,), dtype=np.float32)
-    A = np.ones((nF, 2+fit3rdorder), dtype=np.float)
-    A[:, 1] = freq * 2 * np.pi * 1e-9
-    A[:, 0] = -8.44797245e9 / freq
-    if fit3rdorder:
-        A[:, 2] = -1e21 / freq**3
-    steps = np.ma.dot(np.ma.dot(np.linalg.inv(np.ma.dot(A.T, A)), A.T), 2 * np.pi * np.ones((freq.shape[0], ), dtype=np.float)) 
+    A = getDesignMatrix(freq, fit3rdorder)
+    steps = np.dot(_lstsqOperator(A, np.zeros(nF, dtype=bool)), 2 * np.pi * np.ones((freq.shape[0], ), dtype=np.float))
     succes=False
     initprevsol=False
     nrFail=0
@@ -412,7 +294,8 @@ def getClockTECFitStation(
     prevsol = np.zeros_like(sol)
     n3rd=0
     for itm in xrange(nT):
-        datatmp=np.ma.copy(data[itm, :])
+        datatmp=np.copy(data[itm, :])
+        flagstmp=np.copy(flags[itm, :])
         if itm == 0 or not succes:
             if itm == 0 or not initprevsol:
                 if hasattr(initSol, '__len__') and len(initSol) > 0 :
@@ -454,43 +337,38 @@ def getClockTECFitStation(
                     ndt=min(nrFail+1,4)
                 if fit3rdorder:
                     n3rd=min(nrFail+1,200)
-            datatmpist = datatmp[:]
-            if datatmpist.count() / float(nF) > 0.5:
+            if np.sum(~flagstmp) / float(nF) > 0.5:
                 # do brutforce and update data, unwrp pdata,update flags
-                par,datatmp[:] = getInitPar(datatmpist, freq,nrTEC=ndtec*(1+double_search_space),nrClock=ndt*(1+double_search_space),nrthird=n3rd*(1+double_search_space),initsol=sol[:])
+                par,datatmp,flagstmp = getInitPar(datatmp, flagstmp, freq,nrTEC=ndtec*(1+double_search_space),nrClock=ndt*(1+double_search_space),nrthird=n3rd*(1+double_search_space),initsol=sol[:])
                 sol[:] = par[:]
         #now do the real fitting
-        datatmpist=datatmp[:]
-        if datatmpist.count() / float(nF) < 0.5:
-            logging.debug("Too many data points flagged t=%d st=%s flags=%d" % (itm,stationname,data[itm,:].count()) + str(sol[:]))
+        if np.sum(~flagstmp) / float(nF) < 0.5:
+            logging.debug("Too many data points flagged t=%d st=%s flags=%d" % (itm,stationname,np.sum(~flags[itm])) + str(sol[:]))
             sol[:] = [-10.,]*sol.shape[0]
         else:
             fitdata=np.dot(sol,A.T)
-            datatmpist=unwrapPhases(datatmpist,fitdata)
-            mymask=datatmpist.mask
-            maskedfreq=np.ma.array(freq,mask=mymask)
-            A2=np.ma.array(A,mask=np.tile(mymask,(A.shape[1],1)).T)
-            if datatmpist.count() / float(nF) < 0.5:
-                logging.debug("Too many data points flagged t=%d st=%s flags=%d" % (itm,stationname,data[itm,:].count()) + str(sol[:]))
+            datatmp,flagstmp=unwrapPhases(datatmp,flagstmp,fitdata)
+            if np.sum(~flagstmp) / float(nF) < 0.5:
+                logging.debug("Too many data points flagged t=%d st=%s flags=%d" % (itm,stationname,np.sum(~flags[itm])) + str(sol[:]))
                 sol[:] = [-10.,]*sol.shape[0]
             else:
-                sol[:] = np.ma.dot(np.linalg.inv(np.ma.dot(A2.T, A2)), np.ma.dot(A2.T, datatmpist)).T
-            if initprevsol and np.abs((sol[1]-prevsol[1])/steps[1])>0.5 and (np.abs((sol[1]-prevsol[1])/steps[1])>0.75 or np.abs(np.sum((sol-prevsol)/steps,axis=-1))>0.5*A2.shape[0]):
-                #logging.debug("removing jumps, par for station %d , itm %d"%(ist,itm)+str(sol[ist])+str(prevsol[ist])+str(steps))
+                sol[:] = np.dot(_lstsqOperator(A, flagstmp), np.where(flagstmp, 0., datatmp))
+            if initprevsol and np.abs((sol[1]-prevsol[1])/steps[1])>0.5 and (np.abs((sol[1]-prevsol[1])/steps[1])>0.75 or np.abs(np.sum((sol-prevsol)/steps,axis=-1))>0.5*nF):
                 sol[:]-=np.round((sol[1]-prevsol[1])/steps[1])*steps
         # calculate chi2 per station
-      
+        valid = ~flags[itm]
         residual = data[itm] - np.dot(A, sol)
-        residual = np.ma.remainder(residual + np.pi, 2 * np.pi) - np.pi
-        chi2 = np.ma.sum(np.square(np.degrees(residual)), axis=0) / nF
+        residual[valid] = np.remainder(residual[valid] + np.pi, 2 * np.pi) - np.pi
+        chi2 = np.sum(np.square(np.degrees(residual[valid]))) / nF
 
         if returnResiduals:
-            residualarrayst[itm] = residual
+            # flagged channels keep the data
+            residualarrayst[itm] = np.where(valid, residual, data[itm])
 
         chi2select = (chi2 > chi2cut) or (sol[0] < -5) # select bad points
         chi2select = chi2select or initprevsol*np.sum(np.abs((sol-prevsol)/steps),axis=-1)>(0.3*sol.shape[0]*(1+nrFail)) #also discard data where there is a "half" jump for any parameter wrst the previous solution (if previous solution exists). Multiply with number of fails, since after a large number of fails there is no clear match with the previous solution expected anyway...
         if not initprevsol:
-            prevsol= sol[:]
+            prevsol = np.copy(sol)
         if  chi2select:
             logging.debug('High chi2 of fit, itm: %d  ' % (itm) + 'station:' + stationname)
             succes = False
@@ -616,9 +494,43 @@ def get_first_good(data,axis=1,check=lambda x:np.logical_and(x!=-10,x !=0)):
     return np.array(ndata)
 
 
-def merge_ct_args(args):
-    '''hel[per function for multiprocessing'''
-    return getClockTECFitStation(*args)
+_shared = {} # station data in shared memory, inherited by the worker processes
+
+def _fitStation(ist, pol, iseg, times, freqs, stationname, initSol, returnResiduals, chi2cut, fit3rdorder, double_search_space, outQueue):
+    '''worker for multiprocManager: get the c/t separation of one station/polarization/time segment reading the data from shared memory.
+    Errors are sent back as the result, doFit() would otherwise wait forever for it'''
+    try:
+        result = getClockTECFitStation(_shared['data'][times, :, ist, pol], _shared['mask'][times, :, ist, pol], freqs, stationname,
+                                       initSol, returnResiduals, chi2cut, fit3rdorder, double_search_space)
+    except Exception:
+        result = RuntimeError('Clock/TEC fit failed for station %s:\n%s' % (stationname, traceback.format_exc()))
+    outQueue.put([ist, iseg, result])
+
+
+def joinSegments(results, bounds, overlap, steps, fit3rdorder=False):
+    '''
+    join the c/t separations of overlapping time segments of one station.
+    results[i] is the output of getClockTECFitStation() for the times [max(0,start-overlap):end] with (start,end)=bounds[i].
+    Each segment is shifted by the number of 2pi phase wraps (steps) that best matches the previous segment in the overlap
+    '''
+    nT = bounds[-1][1]
+    joined = [np.zeros((nT,)+r.shape[1:], dtype=r.dtype) for r in results[0]]
+    params = [0, 1] + ([len(joined)-1] if fit3rdorder else []) # tec, clock, tec3rd
+    for (start, end), result in zip(bounds, results):
+        result = [np.array(r) for r in result]
+        nover = start - max(0, start-overlap)
+        if nover > 0:
+            valid = (result[0][:nover] > -5) & (joined[0][start-nover:start] > -5)
+            if valid.any():
+                nwraps = np.round(np.median(result[1][:nover][valid] - joined[1][start-nover:start][valid]) / steps[1])
+                if nwraps != 0:
+                    logging.debug('Removing %d wraps from time segment starting at %d' % (nwraps, start))
+                    good = result[0] > -5
+                    for i, p in enumerate(params):
+                        result[p][good] -= nwraps * steps[i]
+        for j, r in zip(joined, result):
+            j[start:end] = r[nover:]
+    return tuple(joined)
 
 
 def doFit(
@@ -638,7 +550,9 @@ def doFit(
     circular=False,
     initSol=[],
     initoffsets=[],
-    n_proc=10
+    n_proc=0,
+    nSegments=1,
+    segmentOverlap=20
     ):
     # make sure order of axes is as expected
     stidx = axes.index('ant')
@@ -744,108 +658,90 @@ def doFit(
     residualarray = np.zeros((nT, nF, nSt), dtype=np.float32)
     if fit3rdorder:
         tec3rdarray= np.zeros((nT, nSt), dtype=np.float32)
-    for pol in xrange(npol):
-        # get a good guesss without offset
-        # logging.debug("sending masked data "+str(data[:,:,:,pol].count()))
-        initialchi2cut = chi2cut  # user defined
-        if removePhaseWraps:
-            initialchi2cut = 30000.  # this number is quite arbitrary
-        if fit3rdorder:
-              poolargs=[]
-              for ist in xrange(nSt):
-                  poolargs.append((np.ma.copy(data[:, :, ist, pol]),
-                                   freqs,
-                                   stations[ist],
-                                   [],
-                                   True,
-                                   initialchi2cut,
-                                   True,
-                                   circular and combine_pol
-                               ))
-              p=Pool(processes=n_proc)
-              result=p.map(merge_ct_args,poolargs)
-              for ist,tc in enumerate(result):
-                  tecarray[:, ist], clockarray[:, ist],residualarray[:,:,ist],tec3rdarray[:,ist] = tc
-        else:
-              poolargs=[]
-              for ist in xrange(nSt):
-                  poolargs.append((np.ma.copy(data[:, :, ist, pol]),
-                                   freqs,
-                                   stations[ist],
-                                   [],
-                                   True,
-                                   initialchi2cut,
-                                   False,
-                                   circular and combine_pol
-                               ))
-              p=Pool(processes=n_proc)
-              result=p.map(merge_ct_args,poolargs)
-              for ist,tc in enumerate(result):
-                  tecarray[:, ist], clockarray[:, ist],residualarray[:,:,ist] = tc
-        if removePhaseWraps:
-            # correctfrist times only,try to make init correct ?
-            #corrects wraps based on spatial correlation (averaged in time), only works for long time observations, not testted for LBA
-            (offset[:, pol], wraps, steps) = correctWraps(tecarray, residualarray, freqs, station_positions)
-        else:
-            #always correct for wraps based on average residuals
-            wraps, steps = correctWrapsFromResiduals(residualarray, tecarray<-5,freqs)
-        logging.debug('Residual iter 1, pol %d: ' % pol + str(residualarray[0, 0]))
-        logging.debug('TEC iter 1, pol %d: ' % pol + str(tecarray[0]))
-        logging.debug('Clock iter 1, pol %d: ' % pol + str(clockarray[0]))
-        logging.debug('Wraps: ' + str(wraps))
-        logging.debug('Offsets: ' + str(offset[:, pol]))
-        # remove completely initialoffset?
-        if len(initoffsets)>0: # Check if initoffsets is not empty
-            offset[:, pol] -= initoffsets[:, pol]
-        data[:, :, :, pol] += offset[:, pol][np.newaxis, np.newaxis]
-        # remove fitoffset
-        if removePhaseWraps:
-            initsol = np.zeros((nSt, 2), dtype=np.float32)
-            initsol[:, 0] = get_first_good(tecarray[:, :]) + wraps * steps[0]
-            initsol[:, 1] = get_first_good(clockarray[:, :]) + wraps * steps[1]
-            logging.debug('Initsol TEC, pol %d: ' % pol + str(initsol[:, 0]))
-            logging.debug('Initsol clock, pol %d: ' % pol + str(initsol[:, 1]))
-            # is it needed to redo the fitting? this is the time bottleneck
-            if fit3rdorder:
-              poolargs=[]
-              for ist in xrange(nSt):
-                  poolargs.append((np.ma.copy(data[:, :, ist, pol]),
-                                   freqs,
-                                   stations[ist],
-                                   initsol[ist],
-                                   False,
-                                   chi2cut,
-                                   True,
-                                   circular and combine_pol
-                               ))
-              p=Pool(processes=n_proc)
-              result=p.map(merge_ct_args,poolargs)
-              for ist,tc in enumerate(result):
-                  tec[:, ist, pol], clock[:, ist, pol],tec3rd[:,ist,pol] = tc
+    # station data in shared memory: jobs only send the station/pol indices
+    _shared['data'] = np.frombuffer(multiprocessing.RawArray('d', data.size)).reshape(data.shape)
+    _shared['mask'] = np.frombuffer(multiprocessing.RawArray('b', data.size), dtype=bool).reshape(data.shape)
+    _shared['data'][:] = np.ma.getdata(data)
+    _shared['mask'][:] = np.ma.getmaskarray(data)
+    # the time axis can be split in overlapping segments fitted in parallel and then joined
+    nSegments = max(1, min(nSegments, nT))
+    bounds = [(t[0], t[-1]+1) for t in np.array_split(np.arange(nT), nSegments)]
+    segTimes = [slice(max(0, start-segmentOverlap), end) for start, end in bounds]
+    fitSteps = np.dot(_lstsqOperator(getDesignMatrix(freqs, fit3rdorder), np.zeros(nF, dtype=bool)), 2 * np.pi * np.ones(nF))
+    if nSegments > 1:
+        logging.debug('Fitting %d time segments per station with %d time slots of overlap.' % (nSegments, segmentOverlap))
+
+    def fitAll(pol, initsol, returnResiduals, chi2cut):
+        '''fit all stations and time segments of a polarization, return the joined results per station'''
+        for ist in xrange(nSt):
+            for iseg, times in enumerate(segTimes):
+                mpm.put([ist, pol, iseg, times, freqs, stations[ist], initsol[ist][iseg], returnResiduals, chi2cut, fit3rdorder, circular and combine_pol])
+        results = [[None]*nSegments for ist in xrange(nSt)]
+        errors = []
+        for ist, iseg, tc in mpm.get():
+            if isinstance(tc, Exception):
+                errors.append(tc)
             else:
-              poolargs=[]
-              for ist in xrange(nSt):
-                  poolargs.append((np.ma.copy(data[:, :, ist, pol]),
-                                   freqs,
-                                   stations[ist],
-                                   initsol[ist],
-                                   False,
-                                   chi2cut,
-                                   False,
-                                   circular and combine_pol
-                               ))
-              p=Pool(processes=n_proc)
-              result=p.map(merge_ct_args,poolargs)
-              for ist,tc in enumerate(result):
-                  tec[:, ist, pol], clock[:, ist, pol] = tc
-
-        else:
-            tec[:, :, pol] = tecarray[:, :]+ wraps * steps[0]
-            clock[:, :, pol] = clockarray[:, :]+ wraps * steps[1]
-            if fit3rdorder:
-              tec3rd[:, :, pol]  = tec3rdarray[:, :]+ wraps * steps[2]
-        logging.debug('TEC iter 2, pol %d: ' % pol + str(tec[0, :, pol]))
-        logging.debug('Clock iter 2, pol %d: ' % pol + str(clock[0, :, pol]))
+                results[ist][iseg] = tc
+        if errors:
+            raise errors[0]
+        return [joinSegments(r, bounds, segmentOverlap, fitSteps, fit3rdorder) for r in results]
+
+    # the same processes are used for all polarizations and fitting passes
+    mpm = multiprocManager(n_proc, _fitStation)
+    try:
+        for pol in xrange(npol):
+            # get a good guesss without offset
+            initialchi2cut = chi2cut  # user defined
+            if removePhaseWraps:
+                initialchi2cut = 30000.  # this number is quite arbitrary
+            for ist, tc in enumerate(fitAll(pol, [[[]]*nSegments]*nSt, True, initialchi2cut)):
+                if fit3rdorder:
+                    tecarray[:, ist], clockarray[:, ist],residualarray[:,:,ist],tec3rdarray[:,ist] = tc
+                else:
+                    tecarray[:, ist], clockarray[:, ist],residualarray[:,:,ist] = tc
+            if removePhaseWraps:
+                # correctfrist times only,try to make init correct ?
+                #corrects wraps based on spatial correlation (averaged in time), only works for long time observations, not testted for LBA
+                (offset[:, pol], wraps, steps) = correctWraps(tecarray, residualarray, freqs, station_positions)
+            else:
+                #always correct for wraps based on average residuals
+                wraps, steps = correctWrapsFromResiduals(residualarray, tecarray<-5,freqs)
+            logging.debug('Residual iter 1, pol %d: ' % pol + str(residualarray[0, 0]))
+            logging.debug('TEC iter 1, pol %d: ' % pol + str(tecarray[0]))
+            logging.debug('Clock iter 1, pol %d: ' % pol + str(clockarray[0]))
+            logging.debug('Wraps: ' + str(wraps))
+            logging.debug('Offsets: ' + str(offset[:, pol]))
+            # remove completely initialoffset?
+            if len(initoffsets)>0: # Check if initoffsets is not empty
+                offset[:, pol] -= initoffsets[:, pol]
+            data[:, :, :, pol] += offset[:, pol][np.newaxis, np.newaxis]
+            _shared['data'][:, :, :, pol] = np.ma.getdata(data[:, :, :, pol])
+            # remove fitoffset
+            if removePhaseWraps:
+                # initial solution of each segment from its first good time
+                initsol = np.zeros((nSt, nSegments, 2), dtype=np.float32)
+                for iseg, times in enumerate(segTimes):
+                    initsol[:, iseg, 0] = get_first_good(tecarray[times, :]) + wraps * steps[0]
+                    initsol[:, iseg, 1] = get_first_good(clockarray[times, :]) + wraps * steps[1]
+                logging.debug('Initsol TEC, pol %d: ' % pol + str(initsol[:, 0, 0]))
+                logging.debug('Initsol clock, pol %d: ' % pol + str(initsol[:, 0, 1]))
+                # is it needed to redo the fitting? this is the time bottleneck
+                for ist, tc in enumerate(fitAll(pol, initsol, False, chi2cut)):
+                    if fit3rdorder:
+                        tec[:, ist, pol], clock[:, ist, pol],tec3rd[:,ist,pol] = tc
+                    else:
+                        tec[:, ist, pol], clock[:, ist, pol] = tc
+            else:
+                tec[:, :, pol] = tecarray[:, :]+ wraps * steps[0]
+                clock[:, :, pol] = clockarray[:, :]+ wraps * steps[1]
+                if fit3rdorder:
+                  tec3rd[:, :, pol]  = tec3rdarray[:, :]+ wraps * steps[2]
+            logging.debug('TEC iter 2, pol %d: ' % pol + str(tec[0, :, pol]))
+            logging.debug('Clock iter 2, pol %d: ' % pol + str(clock[0, :, pol]))
+    finally:
+        mpm.wait()
+        _shared.clear()
     if not 'LBA' in stations[0] and len(initSol) < 1:
         clock[:, RSstations + otherstations] += initclock[1][np.newaxis, :, :]
     if combine_pol and circular:
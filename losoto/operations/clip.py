@@ -32,6 +32,7 @@ def run( soltab, axesToClip, clipLevel=5., log=False ):
     """
 
     import numpy as np
+    import warnings
 
     def percentFlagged(w):
         return 100.*(weights.size-np.count_nonzero(weights))/float(weights.size)
@@ -56,30 +57,27 @@ def run( soltab, axesToClip, clipLevel=5., log=False ):
             del axesToClip[i]
             logging.warning('Axis \"'+axis+'\" not found. Ignoring.')
 
-    for vals, weights, coord, selection in soltab.getValuesIter(returnAxes=axesToClip, weight = True):
-
-        initPercent = percentFlagged(weights)
-
-        # first find the median and standard deviation
-        if (weights == 0).all():
-            valmedian = 0
-        else:
-            if log:
-                valmedian = np.nanmedian(np.log10(vals[(weights != 0)]))
-                rms = np.nanstd(np.log10(vals[(weights != 0)]))
-                np.putmask(weights, np.abs(np.log10(vals)-valmedian) > rms * clipLevel, 0)
-            else:
-                valmedian = np.nanmedian(vals[(weights != 0)])
-                rms = np.nanstd(vals[(weights != 0)])
-                np.putmask(weights, np.abs(vals-valmedian) > rms * clipLevel, 0)
-    
-        # writing back the solutions
-        soltab.setValues(weights, selection, weight=True)
-
-        #print('max', np.max(vals[(weights != 0)]))
-        #print('median', np.nanmedian(vals[(weights != 0)]))
-        logging.debug('Percentage of data flagged (%s): %.3f%% -> %.3f%% (rms=%.2f)' \
-            % (removeKeys(coord, axesToClip), initPercent, percentFlagged(weights), rms))
+    vals = soltab.getValues(retAxesVals=False)
+    weights = soltab.getValues(retAxesVals=False, weight=True)
+    axes = tuple([soltab.getAxesNames().index(axisToClip) for axisToClip in axesToClip])
+    initPercent = percentFlagged(weights)
+
+    # median and standard deviation over axesToClip for all the other axes at once
+    # (completely flagged selections get NaN and are not touched)
+    for chunk in chunkSelections(vals.shape, axes):
+        v = np.log10(vals[chunk]) if log else vals[chunk]
+        w = weights[chunk] # view: flags are written directly in weights
+        vmasked = np.where(w != 0, v, np.nan)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning) # all-NaN slices
+            valmedian = np.nanmedian(vmasked, axis=axes, keepdims=True)
+            rms = np.nanstd(vmasked, axis=axes, keepdims=True)
+            np.putmask(w, np.abs(v-valmedian) > rms * clipLevel, 0)
+
+    # writing back the solutions
+    soltab.setValues(weights, weight=True)
+
+    logging.debug('Percentage of data flagged: %.3f%% -> %.3f%%' % (initPercent, percentFlagged(weights)))
 
     soltab.addHistory('CLIP (over %s with %s sigma cut)' % (axesToClip, clipLevel))
 
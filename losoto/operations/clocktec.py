@@ -17,13 +17,16 @@ def _run_parser(soltab, parser, step):
     fit3rdorder = parser.getbool( step, 'fit3rdorder', False )
     circular = parser.getbool( step, 'circular', False )
     reverse = parser.getbool( step, 'reverse', False )
-    nproc = parser.getint( step, 'nproc', 10 )
+    timeSegments = parser.getint( step, 'timeSegments', 1 )
+    segmentOverlap = parser.getint( step, 'segmentOverlap', 20 )
+    ncpu = parser.getint( '_global', 'ncpu', 0 )
+    nproc = parser.getint( step, 'nproc', 0 ) # deprecated
 
-    parser.checkSpelling( step, soltab, ['flagBadChannels', 'flagCut', 'chi2cut', 'combinePol', 'removePhaseWraps', 'fit3rdorder', 'circular', 'reverse','nproc'])
-    return run(soltab, flagBadChannels, flagCut, chi2cut, combinePol, removePhaseWraps, fit3rdorder, circular, reverse,nproc)
+    parser.checkSpelling( step, soltab, ['flagBadChannels', 'flagCut', 'chi2cut', 'combinePol', 'removePhaseWraps', 'fit3rdorder', 'circular', 'reverse', 'timeSegments', 'segmentOverlap', 'nproc'])
+    return run(soltab, flagBadChannels, flagCut, chi2cut, combinePol, removePhaseWraps, fit3rdorder, circular, reverse, timeSegments, segmentOverlap, ncpu, nproc)
 
 
-def run( soltab, flagBadChannels=True, flagCut=5., chi2cut=3000., combinePol=False, removePhaseWraps=True, fit3rdorder=False, circular=False, reverse=False,nproc=10 ):
+def run( soltab, flagBadChannels=True, flagCut=5., chi2cut=3000., combinePol=False, removePhaseWraps=True, fit3rdorder=False, circular=False, reverse=False, timeSegments=1, segmentOverlap=20, ncpu=0, nproc=0 ):
     """
     Separate phase solutions into Clock and TEC.
     The Clock and TEC values are stored in the specified output soltab with type 'clock', 'tec', 'tec3rd'.
@@ -53,12 +56,31 @@ def run( soltab, flagBadChannels=True, flagCut=5., chi2cut=3000., combinePol=Fal
 
     reverse : bool, optional
         Reverse the time axis. By default False.
+
+    timeSegments : int, optional
+        Split the time axis in this number of segments which are fitted in parallel and then joined
+        removing the phase wraps ambiguities in the overlaps. Useful for long observations with few stations. By default 1 (no split).
+        Each segment starts its fit from its own first good time slot, so on noisy data the results can differ from the ones
+        of a single sequential fit.
+
+    segmentOverlap : int, optional
+        Number of time slots of overlap between consecutive time segments. By default 20.
+
+    ncpu : int, optional
+        Number of cpu to use, by default all available.
+
+    nproc : int, optional
+        Deprecated, use ncpu. If not 0 it overrides ncpu. By default 0.
     """
     import numpy as np
     from ._fitClockTEC import doFit
 
     logging.info("Clock/TEC separation on soltab: "+soltab.name)
 
+    if nproc != 0:
+        logging.warning("CLOCKTEC option nproc is deprecated, use the global option ncpu instead.")
+        ncpu = nproc
+
     # some checks
     solType = soltab.getType()
     if solType != 'phase':
@@ -98,7 +120,7 @@ def run( soltab, flagBadChannels=True, flagCut=5., chi2cut=3000., combinePol=Fal
             flags = np.swapaxes(np.swapaxes(flags, 0, axes.index('time'))[::-1], 0, axes.index('time'))
 
         result=doFit(vals,flags==0,freqs,stations,station_positions,axes,\
-                         flagBadChannels=flagBadChannels,flagcut=flagCut,chi2cut=chi2cut,combine_pol=combinePol,removePhaseWraps=removePhaseWraps,fit3rdorder=fit3rdorder,circular=circular,n_proc=nproc)
+                         flagBadChannels=flagBadChannels,flagcut=flagCut,chi2cut=chi2cut,combine_pol=combinePol,removePhaseWraps=removePhaseWraps,fit3rdorder=fit3rdorder,circular=circular,n_proc=ncpu,nSegments=timeSegments,segmentOverlap=segmentOverlap)
         if fit3rdorder:
             clock,tec,offset,tec3rd=result
             if reverse: 
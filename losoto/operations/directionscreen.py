@@ -8,6 +8,7 @@ import logging
 from losoto.lib_operations import *
 from losoto.operations.stationscreen import _getxy, _radec2xy, _xy2radec, _makeWCS
 from losoto.operations.stationscreen import _flag_outliers, _circ_chi2
+from losoto.operations.stationscreen import _kl_decomposition, _kl_fit
 
 logging.debug('Loading DIRECTIONSCREEN module.')
 
@@ -16,17 +17,23 @@ def _run_parser(soltab, parser, step):
     outSoltab = parser.getstr( step, "outSoltab", 'tecscreen' )
     height = parser.getfloat( step, "height", 200e3 )
     order = parser.getint( step, "Order", 5 )
-    ncpu = parser.getint( '_global', "npcu", 0 )
+    ppTolerance = parser.getfloat( step, "ppTolerance", 0.0 )
+    ncpu = parser.getint( '_global', "ncpu", 0 )
 
-    parser.checkSpelling( step, soltab, ['outSoltab', 'height', 'order'])
-    return run(soltab, outSoltab, height, order, ncpu)
+    parser.checkSpelling( step, soltab, ['outSoltab', 'height', 'order', 'ppTolerance'])
+    return run(soltab, outSoltab, height, order, ncpu=ncpu, ppTolerance=ppTolerance)
 
 
+_ppCache = {}
+_ppCacheSize = 4 # max number of cached pierce-point sets
+
 def _calculate_piercepoints(station_positions, source_positions, times, height=200e3):
     """
     Returns array of piercepoint locations and airmass values for a
     screen at the given height (in m)
 
+    The results are cached, keyed by the input positions, times and height
+
     Parameters
     ----------
     station_positions : array
@@ -50,81 +57,115 @@ def _calculate_piercepoints(station_positions, source_positions, times, height=2
         reference Dec for WCS system (deg)
 
     """
-    import pyrap.measures
     import numpy as np
-    try:
-        import progressbar
-    except ImportError:
-        import losoto.progressbar as progressbar
+
+    station_positions = np.asarray(station_positions, dtype=float)
+    source_positions = np.asarray(source_positions, dtype=float)
+    times = np.asarray(times, dtype=float)
+    key = (station_positions.shape, station_positions.tobytes(), source_positions.shape,
+        source_positions.tobytes(), times.tobytes(), float(height))
+    if key in _ppCache:
+        return _ppCache[key]
 
     logging.info('Calculating screen pierce-point locations and airmass values...')
     N_sources = source_positions.shape[0]
     N_stations = station_positions.shape[0]
     N_piercepoints = N_stations * N_sources
     N_times = len(times)
-    pp = np.zeros((N_times, N_piercepoints, 3))
-    airmass = np.zeros((N_times, N_piercepoints))
 
-    me = pyrap.measures.measures()
-    position = me.position('ITRF', '%fm' % station_positions[0,0],
-        '%fm' % station_positions[0,1], '%fm' % station_positions[0,2])
-    me.doframe(position)
-
-    pbar = progressbar.ProgressBar(maxval=N_times).start()
-    ipbar = 0
-    for k in range(N_times):
-        epoch = me.epoch('UTC', '%fs' % times[k])
-        me.doframe(epoch)
-        pp_idx = 0
-        for i in range(N_sources):
-            ra = source_positions[i,0]
-            dec = source_positions[i,1]
-            d = me.direction('J2000', '%frad' % ra, '%frad' % dec)
-            d1 = me.measure(d, 'ITRF')
-            phi = d1['m0']['value']
-            theta = d1['m1']['value']
-            dx = np.cos(theta)*np.cos(phi)
-            dy = np.cos(theta)*np.sin(phi)
-            dz = np.sin(theta)
-            direction = np.array((dx,dy,dz))
-            for station_position in station_positions:
-                pp[k, pp_idx, :], airmass[k, pp_idx] = _calc_piercepoint(
-                    station_position, direction, height)
-                pp_idx += 1
-        pbar.update(ipbar)
-        ipbar += 1
-    pbar.finish()
+    # all times, sources and stations at once, in the order [time, source, station]
+    directions = _calc_directions(station_positions[0], source_positions, times)
+    pp, airmass = _calc_piercepoint(station_positions[np.newaxis, np.newaxis, :, :],
+        directions[:, :, np.newaxis, :], height)
+    pp = pp.reshape((N_times, N_piercepoints, 3))
+    airmass = airmass.reshape((N_times, N_piercepoints))
     midRA = 0.0
     midDec = 0.0
 
-    return pp, airmass, midRA, midDec
+    if len(_ppCache) >= _ppCacheSize:
+        _ppCache.clear()
+    _ppCache[key] = (pp, airmass, midRA, midDec)
+    return _ppCache[key]
+
+
+def _calc_directions(position, source_positions, times):
+    """
+    Returns the ITRF unit vectors of the given J2000 directions at all times
+
+    The directions are converted with pyrap.measures only at the central
+    time. At the other times they are rotated around the Earth axis by the
+    change of the Earth rotation angle, which neglects the (sub-arcsec)
+    changes of precession, nutation and aberration during the observation
+
+    Parameters
+    ----------
+    position: array
+        ITRF position used as reference frame (m)
+    source_positions : array
+        array of source positions (RA, Dec in rad)
+    times: array
+        array of times (MJD in s)
+
+    Returns
+    -------
+    directions: array
+        array of directions (N_times, N_sources, 3)
+
+    """
+    import pyrap.measures
+    import numpy as np
+
+    me = pyrap.measures.measures()
+    me.doframe(me.position('ITRF', '%fm' % position[0], '%fm' % position[1],
+        '%fm' % position[2]))
+    t0 = times[len(times) // 2]
+    me.doframe(me.epoch('UTC', '%fs' % t0))
+    phi = np.zeros(len(source_positions))
+    theta = np.zeros(len(source_positions))
+    for i, (ra, dec) in enumerate(source_positions[:, :2]):
+        d = me.direction('J2000', '%frad' % ra, '%frad' % dec)
+        d1 = me.measure(d, 'ITRF')
+        phi[i] = d1['m0']['value']
+        theta[i] = d1['m1']['value']
+
+    # the Earth rotation angle grows by 2pi*1.00273781191135448 per day
+    phi = phi[np.newaxis, :] - 2.0 * np.pi * 1.00273781191135448 * \
+        (times[:, np.newaxis] - t0) / 86400.0
+    theta = np.resize(theta, phi.shape)
+    directions = np.zeros(phi.shape + (3,))
+    directions[:, :, 0] = np.cos(theta)*np.cos(phi)
+    directions[:, :, 1] = np.cos(theta)*np.sin(phi)
+    directions[:, :, 2] = np.sin(theta)
+
+    return directions
 
 
 def _calc_piercepoint(pos, direction, height):
     """
     Calculates pierce point locations and airmass values for given station
-    position, source direction, and height (in m)
+    positions, source directions, and height (in m)
 
     Parameters
     ----------
     pos: array
-        array of station positions
+        array of station positions (..., 3)
     direction: array
-        array of source directions
+        array of source directions (..., 3), broadcast against pos
     height: float
         height of screen (m)
 
     Returns
     -------
     pp: array
-        array of pierce points
+        array of pierce points (..., 3)
     airmass: array
-        array of airmass values
+        array of airmass values (...)
 
     """
     import numpy as np
 
-    pp = np.zeros(3)
+    pos = np.asarray(pos, dtype=float)
+    direction = np.asarray(direction, dtype=float)
     earth_ellipsoid_a = 6378137.0
     earth_ellipsoid_a2 = earth_ellipsoid_a * earth_ellipsoid_a
     earth_ellipsoid_b = 6356752.3142
@@ -136,21 +177,21 @@ def _calc_piercepoint(pos, direction, height):
     ion_ellipsoid_b = earth_ellipsoid_b + height
     ion_ellipsoid_b2_inv = 1.0 / (ion_ellipsoid_b * ion_ellipsoid_b)
 
-    x = pos[0] / ion_ellipsoid_a
-    y = pos[1] / ion_ellipsoid_a
-    z = pos[2] / ion_ellipsoid_b
+    x = pos[..., 0] / ion_ellipsoid_a
+    y = pos[..., 1] / ion_ellipsoid_a
+    z = pos[..., 2] / ion_ellipsoid_b
     c = x*x + y*y + z*z - 1.0
 
-    dx = direction[0] / ion_ellipsoid_a
-    dy = direction[1] / ion_ellipsoid_a
-    dz = direction[2] / ion_ellipsoid_b
+    dx = direction[..., 0] / ion_ellipsoid_a
+    dy = direction[..., 1] / ion_ellipsoid_a
+    dz = direction[..., 2] / ion_ellipsoid_b
     a = dx*dx + dy*dy + dz*dz
     b = x*dx + y*dy  + z*dz
     alpha = (-b + np.sqrt(b*b - a*c)) / a
-    pp = pos[0] + alpha * direction
-    normal_x = pp[0] * ion_ellipsoid_a2_inv
-    normal_y = pp[1] * ion_ellipsoid_a2_inv
-    normal_z = pp[2] * ion_ellipsoid_b2_inv
+    pp = pos[..., 0, np.newaxis] + alpha[..., np.newaxis] * direction
+    normal_x = pp[..., 0] * ion_ellipsoid_a2_inv
+    normal_y = pp[..., 1] * ion_ellipsoid_a2_inv
+    normal_z = pp[..., 2] * ion_ellipsoid_b2_inv
     norm_normal2 = normal_x*normal_x + normal_y*normal_y + normal_z*normal_z
     norm_normal = np.sqrt(norm_normal2)
     sin_lat2 = normal_z*normal_z / norm_normal2
@@ -166,35 +207,72 @@ def _calc_piercepoint(pos, direction, height):
     z_offset = ((1.0 - earth_ellipsoid_e2) * N + height - (1.0 -
         local_ion_ellipsoid_e2) * (N+height)) * np.sqrt(sin_lat2)
 
-    x1 = pos[0] / local_ion_ellipsoid_a
-    y1 = pos[1] / local_ion_ellipsoid_a
-    z1 = (pos[2] - z_offset) / local_ion_ellipsoid_b
+    x1 = pos[..., 0] / local_ion_ellipsoid_a
+    y1 = pos[..., 1] / local_ion_ellipsoid_a
+    z1 = (pos[..., 2] - z_offset) / local_ion_ellipsoid_b
     c1 = x1*x1 + y1*y1 + z1*z1 - 1.0
 
-    dx = direction[0] / local_ion_ellipsoid_a
-    dy = direction[1] / local_ion_ellipsoid_a
-    dz = direction[2] / local_ion_ellipsoid_b
+    dx = direction[..., 0] / local_ion_ellipsoid_a
+    dy = direction[..., 1] / local_ion_ellipsoid_a
+    dz = direction[..., 2] / local_ion_ellipsoid_b
     a = dx*dx + dy*dy + dz*dz
     b = x1*dx + y1*dy + z1*dz
     alpha = (-b + np.sqrt(b*b - a*c1)) / a
 
-    pp = pos + alpha * direction
+    pp = pos + alpha[..., np.newaxis] * direction
 
-    normal_x = pp[0] * ion_ellipsoid_a2_inv
-    normal_y = pp[1] * ion_ellipsoid_a2_inv
-    normal_z = (pp[2] - z_offset) * ion_ellipsoid_b2_inv
+    normal_x = pp[..., 0] * ion_ellipsoid_a2_inv
+    normal_y = pp[..., 1] * ion_ellipsoid_a2_inv
+    normal_z = (pp[..., 2] - z_offset) * ion_ellipsoid_b2_inv
 
     norm_normal2 = normal_x*normal_x + normal_y*normal_y + normal_z*normal_z
     norm_normal = np.sqrt(norm_normal2)
 
-    airmass = norm_normal / (direction[0]*normal_x + direction[1]*normal_y +
-        direction[2]*normal_z)
+    airmass = norm_normal / (direction[..., 0]*normal_x + direction[..., 1]*normal_y +
+        direction[..., 2]*normal_z)
 
     return pp, airmass
 
 
+def _screen_groups(pp, tolerance=0.0):
+    """
+    Groups consecutive time slots whose pierce-point geometry differs by at
+    most the given tolerance from the first time slot of the group
+
+    Parameters
+    ----------
+    pp: array
+        Array of piercepoint locations (N_times, N_piercepoints, 3)
+    tolerance: float
+        Maximum change (m) of the distance between any two pierce points for
+        which the same Karhunen-Lo`eve decomposition is used
+
+    Returns
+    -------
+    groups: generator
+        Yields the list of time indices of each group and the squared
+        distances between the pierce points of its first time slot
+
+    """
+    import numpy as np
+
+    tindx = []
+    for k in range(pp.shape[0]):
+        D = pp[k, :, np.newaxis, :] - pp[k, np.newaxis, :, :]
+        D2 = np.sum(D**2, axis=2)
+        if tindx and np.max(np.abs(np.sqrt(D2) - np.sqrt(D2_ref))) <= tolerance:
+            tindx.append(k)
+            continue
+        if tindx:
+            yield tindx, D2_ref
+        tindx = [k]
+        D2_ref = D2
+    if tindx:
+        yield tindx, D2_ref
+
+
 def _fit_phase_screen(station_names, source_names, pp, airmass, rr, weights, times,
-    height, order, r_0, beta, outQueue):
+    height, order, r_0, beta, ppTolerance, outQueue):
     """
     Fits a screen to given phase values using Karhunen-Lo`eve base vectors
 
@@ -205,13 +283,13 @@ def _fit_phase_screen(station_names, source_names, pp, airmass, rr, weights, tim
     source_names: array
         Array of source names
     pp: array
-        Array of piercepoint locations
+        Array of piercepoint locations (N_times, N_piercepoints, 3)
     airmass: array
         Array of airmass values (note: not currently used)
     rr: array
-        Array of phase values to fit screen to
+        Array of phase values to fit screen to (N_piercepoints, N_times)
     weights: array
-        Array of weights
+        Array of weights (N_piercepoints, N_times)
     times: array
         Array of times
     height: float
@@ -223,10 +301,12 @@ def _fit_phase_screen(station_names, source_names, pp, airmass, rr, weights, tim
     beta: float
         Power-law index for phase structure function (5/3 => pure Kolmogorov
         turbulence)
+    ppTolerance: float
+        Maximum change (m) of the pierce-point distances for which the KL
+        decomposition of a previous time slot is reused
 
     """
     import numpy as np
-    from pylab import kron, concatenate, pinv, norm, newaxis, find, amin, svd, eye
 
     logging.info('Fitting screens...')
 
@@ -234,7 +314,6 @@ def _fit_phase_screen(station_names, source_names, pp, airmass, rr, weights, tim
     N_stations = len(station_names)
     N_sources = len(source_names)
     N_times = len(times)
-    N_piercepoints = N_sources * N_stations
     real_fit_white_all = np.zeros((N_times, N_sources, N_stations))
     imag_fit_white_all = np.zeros((N_times, N_sources, N_stations))
     phase_fit_white_all = np.zeros((N_times, N_sources, N_stations))
@@ -246,44 +325,39 @@ def _fit_phase_screen(station_names, source_names, pp, airmass, rr, weights, tim
     rr_real = np.cos(rr)
     rr_imag = np.sin(rr)
 
-    for k in range(N_times):
+    for tindx, D2 in _screen_groups(pp, ppTolerance):
+        shape = (len(tindx), N_sources, N_stations)
         try:
-            D = np.resize(pp[k, :, :], (N_piercepoints, N_piercepoints, 3))
-            D = np.transpose(D, (1, 0, 2)) - D
-            D2 = np.sum(D**2, axis=2)
-            C = -(D2 / r_0**2)**(beta / 2.0) / 2.0
-            pinvC = pinv(C, rcond=1e-3)
-            U, S, V = svd(C)
-            invU = pinv(np.dot(np.transpose(U[:, :order]), np.dot(weights[:, :, k], U[:, :order])), rcond=1e-3)
+            C, invS, U = _kl_decomposition(D2, r_0, beta)
+            w = weights[:, tindx]
 
             # Calculate real screen
-            rr1 = np.dot(np.transpose(U[:, :order]), np.dot(weights[:, :, k], rr_real[:, k]))
-            real_fit = np.dot(pinvC, np.dot(U[:, :order], np.dot(invU, rr1)))
-            real_fit_white_all[k, :, :] = real_fit.reshape((N_sources, N_stations))
-            residual = rr_real - np.dot(C, real_fit)[:, newaxis]
-            real_residual_all[k, :, :] = residual.reshape((N_sources, N_stations))
+            real_fit = _kl_fit(invS, U, rr_real[:, tindx], w, order)
+            real_fit_white_all[tindx] = real_fit.T.reshape(shape)
+            residual = rr_real[:, tindx] - np.dot(C, real_fit)
+            real_residual_all[tindx] = residual.T.reshape(shape)
 
             # Calculate imag screen
-            rr1 = np.dot(np.transpose(U[:, :order]), np.dot(weights[:, :, k], rr_imag[:, k]))
-            imag_fit = np.dot(pinvC, np.dot(U[:, :order], np.dot(invU, rr1)))
-            imag_fit_white_all[k, :, :] = imag_fit.reshape((N_sources, N_stations))
-            residual = rr_imag - np.dot(C, imag_fit)[:, newaxis]
-            imag_residual_all[k, :, :] = residual.reshape((N_sources, N_stations))
+            imag_fit = _kl_fit(invS, U, rr_imag[:, tindx], w, order)
+            imag_fit_white_all[tindx] = imag_fit.T.reshape(shape)
+            residual = rr_imag[:, tindx] - np.dot(C, imag_fit)
+            imag_residual_all[tindx] = residual.T.reshape(shape)
 
             # Calculate phase screen
-            phase_fit = np.dot(pinvC, np.arctan2(np.dot(C, imag_fit), np.dot(C, real_fit)))
-            phase_fit_white_all[k, :, :] = phase_fit.reshape((N_sources, N_stations))
-            residual = rr - np.dot(C, phase_fit)[:, newaxis]
-            phase_residual_all[k, :, :] = residual.reshape((N_sources, N_stations))
+            phase = np.arctan2(np.dot(C, imag_fit), np.dot(C, real_fit))
+            phase_fit = np.dot(U, invS[:, np.newaxis] * np.dot(U.T, phase))
+            phase_fit_white_all[tindx] = phase_fit.T.reshape(shape)
+            residual = rr[:, tindx] - np.dot(C, phase_fit)
+            phase_residual_all[tindx] = residual.T.reshape(shape)
         except:
             # Set screen to zero if fit did not work
-            logging.debug('Screen fit failed for timeslot {}'.format(k))
-            real_fit_white_all[k, :, :] = np.zeros((N_sources, N_stations))
-            real_residual_all[k, :, :] = np.ones((N_sources, N_stations))
-            imag_fit_white_all[k, :, :] = np.zeros((N_sources, N_stations))
-            imag_residual_all[k, :, :] = np.ones((N_sources, N_stations))
-            phase_fit_white_all[k, :, :] = np.zeros((N_sources, N_stations))
-            phase_residual_all[k, :, :] = np.ones((N_sources, N_stations))
+            logging.debug('Screen fit failed for timeslots {}'.format(tindx))
+            real_fit_white_all[tindx] = np.zeros(shape)
+            real_residual_all[tindx] = np.ones(shape)
+            imag_fit_white_all[tindx] = np.zeros(shape)
+            imag_residual_all[tindx] = np.ones(shape)
+            phase_fit_white_all[tindx] = np.zeros(shape)
+            phase_residual_all[tindx] = np.ones(shape)
 
     outQueue.put([real_fit_white_all, real_residual_all,
                   imag_fit_white_all, imag_residual_all,
@@ -292,7 +366,7 @@ def _fit_phase_screen(station_names, source_names, pp, airmass, rr, weights, tim
 
 
 def _fit_tec_screen(station_names, source_names, pp, airmass, rr, weights, times,
-    height, order, r_0, beta, outQueue):
+    height, order, r_0, beta, ppTolerance, outQueue):
     """
     Fits a screen to given TEC values using Karhunen-Lo`eve base vectors
 
@@ -303,13 +377,13 @@ def _fit_tec_screen(station_names, source_names, pp, airmass, rr, weights, times
     source_names: array
         Array of source names
     pp: array
-        Array of piercepoint locations
+        Array of piercepoint locations (N_times, N_piercepoints, 3)
     airmass: array
         Array of airmass values (note: not currently used)
     rr: array
-        Array of TEC values to fit screen to
+        Array of TEC values to fit screen to (N_piercepoints, N_times)
     weights: array
-        Array of weights
+        Array of weights (N_piercepoints, N_times)
     times: array
         Array of times
     height: float
@@ -321,10 +395,12 @@ def _fit_tec_screen(station_names, source_names, pp, airmass, rr, weights, times
     beta: float
         Power-law index for phase structure function (5/3 => pure Kolmogorov
         turbulence)
+    ppTolerance: float
+        Maximum change (m) of the pierce-point distances for which the KL
+        decomposition of a previous time slot is reused
 
     """
     import numpy as np
-    from pylab import kron, concatenate, pinv, norm, newaxis, find, amin, svd, eye
 
     logging.info('Fitting screens...')
 
@@ -332,31 +408,30 @@ def _fit_tec_screen(station_names, source_names, pp, airmass, rr, weights, times
     N_stations = len(station_names)
     N_sources = len(source_names)
     N_times = len(times)
-    N_piercepoints = N_sources * N_stations
     tec_fit_white_all = np.zeros((N_times, N_sources, N_stations))
     tec_residual_all = np.zeros((N_times, N_sources, N_stations))
 
-    for k in range(N_times):
-        D = np.resize(pp[k, :, :], (N_piercepoints, N_piercepoints, 3))
-        D = np.transpose(D, (1, 0, 2)) - D
-        D2 = np.sum(D**2, axis=2)
-        C = -(D2 / r_0**2)**(beta / 2.0) / 2.0
-        pinvC = pinv(C, rcond=1e-3)
-        U, S, V = svd(C)
-        invU = pinv(np.dot(np.transpose(U[:, :order]), np.dot(weights[:, :, k], U[:, :order])), rcond=1e-3)
-
-        # Calculate screen
-        rr1 = np.dot(np.transpose(U[:, :order]), np.dot(weights[:, :, k], rr[:, k]))
-        tec_fit = np.dot(pinvC, np.dot(U[:, :order], np.dot(invU, rr1)))
-        tec_fit_white_all[k, :, :] = tec_fit.reshape((N_sources, N_stations))
-        residual = rr - np.dot(C, tec_fit)[:, newaxis]
-        tec_residual_all[k, :, :] = residual.reshape((N_sources, N_stations))
+    for tindx, D2 in _screen_groups(pp, ppTolerance):
+        shape = (len(tindx), N_sources, N_stations)
+        try:
+            C, invS, U = _kl_decomposition(D2, r_0, beta)
+
+            # Calculate screen
+            tec_fit = _kl_fit(invS, U, rr[:, tindx], weights[:, tindx], order)
+            tec_fit_white_all[tindx] = tec_fit.T.reshape(shape)
+            residual = rr[:, tindx] - np.dot(C, tec_fit)
+            tec_residual_all[tindx] = residual.T.reshape(shape)
+        except:
+            # Set screen to zero if fit did not work
+            logging.debug('Screen fit failed for timeslots {}'.format(tindx))
+            tec_fit_white_all[tindx] = np.zeros(shape)
+            tec_residual_all[tindx] = np.ones(shape)
 
     outQueue.put([tec_fit_white_all, tec_residual_all, times])
 
 
 def run(soltab, outSoltab='tecscreen', height=200.0e3, order=12,
-    beta=5.0/3.0, ncpu=0):
+    beta=5.0/3.0, ncpu=0, ppTolerance=0.0):
     """
     Fits a screen to TEC + scalaraphase values.
 
@@ -383,6 +458,10 @@ def run(soltab, outSoltab='tecscreen', height=200.0e3, order=12,
         turbulence)
     ncpu: int, optional
         Number of CPUs to use. If 0, all are used
+    ppTolerance: float, optional
+        Maximum change in m of the distances between pierce points for which
+        the Karhunen-Lo`eve decomposition of an earlier time slot is reused.
+        If 0, the decomposition is recomputed whenever the geometry changes
     niter: int, optional
         Number of iterations to do when determining weights
     nsigma: float, optional
@@ -471,36 +550,30 @@ def run(soltab, outSoltab='tecscreen', height=200.0e3, order=12,
     pp, airmass, midRA, midDec = _calculate_piercepoints(np.array(station_positions),
         np.array(source_positions), np.array(times), height)
 
-    # Fit the screens
+    # Fit the screens, one batch of consecutive time slots per process
     station_weights = np.reshape(weights, [N_piercepoints, N_times])
     if screen_type == 'phase':
         mpm = multiprocManager(ncpu, _fit_phase_screen)
-        for tindx, t in enumerate(times):
-            w = np.diag(station_weights[:, tindx])[:, :, newaxis]
-            mpm.put([station_names, source_names, pp[tindx, newaxis, :, :],
-                airmass[tindx, newaxis, :], rr[:, tindx, newaxis], w,
-                [t], height, order, r_0, beta])
-        mpm.wait()
-        for (real_scr, real_res, imag_scr, imag_res, phase_scr, phase_res, t) in mpm.get():
-            i = times.tolist().index(t[0])
-            real_screen[:, :, i] = real_scr[0, :, :]
-            real_residual[:, :, i] = real_res[0, :, :]
-            imag_screen[:, :, i] = imag_scr[0, :, :]
-            imag_residual[:, :, i] = imag_res[0, :, :]
-            screen[:, :, i] = phase_scr[0, :, :]
-            residual[:, :, i] = phase_res[0, :, :]
     elif screen_type == 'tec':
         mpm = multiprocManager(ncpu, _fit_tec_screen)
-        for tindx, t in enumerate(times):
-            w = np.diag(station_weights[:, tindx])[:, :, newaxis]
-            mpm.put([station_names, source_names, pp[tindx, newaxis, :, :],
-                airmass[tindx, newaxis, :], rr[:, tindx, newaxis], w,
-                [t], height, order, r_0, beta])
-        mpm.wait()
-        for (scr, res, t) in mpm.get():
-            i = times.tolist().index(t[0])
-            screen[:, :, i] = scr[0, :, :]
-            residual[:, :, i] = res[0, :, :]
+    for tindx in np.array_split(np.arange(N_times), min(N_times, mpm.procs)):
+        mpm.put([station_names, source_names, pp[tindx], airmass[tindx],
+            rr[:, tindx], station_weights[:, tindx], times[tindx], height,
+            order, r_0, beta, ppTolerance])
+    mpm.wait()
+    time_idx = dict([(t, i) for i, t in enumerate(times)])
+    for result in mpm.get():
+        tindx = [time_idx[t] for t in result[-1]]
+        if screen_type == 'phase':
+            real_scr, real_res, imag_scr, imag_res, scr, res, t = result
+            real_screen[:, :, tindx] = real_scr.transpose([1, 2, 0])
+            real_residual[:, :, tindx] = real_res.transpose([1, 2, 0])
+            imag_screen[:, :, tindx] = imag_scr.transpose([1, 2, 0])
+            imag_residual[:, :, tindx] = imag_res.transpose([1, 2, 0])
+        else:
+            scr, res, t = result
+        screen[:, :, tindx] = scr.transpose([1, 2, 0])
+        residual[:, :, tindx] = res.transpose([1, 2, 0])
     weights = np.reshape(station_weights, (N_sources, N_stations, N_times))
 
     # Write the results to the output solset
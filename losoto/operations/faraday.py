@@ -10,12 +10,96 @@ logging.debug('Loading FARADAY module.')
 def _run_parser(soltab, parser, step):
     refAnt = parser.getstr( step, 'refAnt', '')
     maxResidual = parser.getfloat( step, 'maxResidual', 1. )
+    maxRM = parser.getfloat( step, 'maxRM', 2. )
+    ncpu = parser.getint( '_global', 'ncpu', 0 )
 
-    parser.checkSpelling( step, soltab, ['refAnt', 'maxResidual'])
-    return run(soltab, refAnt, maxResidual)
+    parser.checkSpelling( step, soltab, ['refAnt', 'maxResidual', 'maxRM'])
+    return run(soltab, refAnt, maxResidual, maxRM, ncpu)
 
 
-def run( soltab, refAnt='', maxResidual=1. ):
+def _fitRM(phase_diff, weights, freqs, ant, maxResidual, maxRM, outQueue):
+    """
+    Fit the rotation measure for all the time slots of an antenna at once.
+
+    Parameters
+    ----------
+    phase_diff : array
+        Phase difference RR-LL (or twice the rotation angle), shape (freq, time).
+    weights : array
+        Weights (freq, time), 0 means flagged.
+    freqs : array
+        Frequencies.
+    ant : str
+        Antenna name.
+    maxResidual : float
+        Max average residual in radians before flagging datapoint. If 0: no check.
+    maxRM : float
+        The RM is searched in [-maxRM, maxRM], if 0 up to the largest RM that the channel spacing can resolve.
+    """
+    import numpy as np
+
+    c = 2.99792458e8
+    ntimes = phase_diff.shape[1]
+    fitrm = np.zeros(ntimes)
+    fitweights = np.ones(ntimes) # all unflagged to start
+
+    if (weights == 0.).all() == True:
+        logging.warning('Skipping flagged antenna: '+ant)
+        fitweights[:] = 0
+        outQueue.put([ant, fitrm, fitweights])
+        return
+
+    logging.debug('Working on ant: '+ant+'...')
+    idx = (weights != 0.) & ~np.isnan(phase_diff)
+    nfreq = np.sum(idx, axis=0)
+    wav2 = (c/freqs)**2
+
+    # largest unambiguous RM: the rotation 2*RM*wav^2 must change by less than pi between the closest channels
+    if maxRM <= 0:
+        maxRM = np.pi/(2.*np.min(np.diff(np.unique(wav2))))
+        logging.debug('Searching RM in +/- %f rad/m^2' % maxRM)
+
+    # the rotation 2*RM*wav^2 of the largest wav^2 changes by 2pi every pi/max(wav2) in RM,
+    # sample it 8 times in the coarse grid and then refine
+    step = np.pi/np.max(wav2)/8.
+    n = int(np.ceil(2*maxRM/step)) + 1
+    Z = np.where(idx, np.exp(1j*phase_diff), 0)
+    fitrm, score = phaseGridSearch(Z, 2.*wav2, -maxRM, maxRM, n=n)
+
+    # fractional residual
+    residual = np.abs(np.mod((2.*fitrm[np.newaxis,:]*wav2[:,np.newaxis])-phase_diff + np.pi, 2.*np.pi) - np.pi)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        residual = np.sum(np.where(idx, residual, 0), axis=0) / nfreq
+        bad = ~(residual < maxResidual) # NaN (no data) is bad too
+
+    # if more than 1/4 of chans are flagged
+    for t in np.where((len(freqs) - nfreq)/float(len(freqs)) > 1/4.)[0]:
+        logging.debug('High number of filtered out data points for the timeslot %i: %i/%i' % (t, len(freqs) - nfreq[t], len(freqs)) )
+
+    if maxResidual != 0:
+        if bad.any():
+            # high residual, flag
+            maxResidualFound = np.nan if np.isnan(residual).all() else np.nanmax(residual)
+            logging.warning('Bad solution for ant: '+ant+' (%i time slots, max residual: %s).' % (np.sum(bad), maxResidualFound))
+        fitweights[bad] = 0
+
+    # the refinement moved out of the searched range: the RM is likely beyond maxRM
+    outOfRange = (np.abs(fitrm) > maxRM)
+    if outOfRange.any():
+        logging.warning('RM out of the searched range (+/- %f rad/m^2) for ant: %s at %i time slots' % (maxRM, ant, np.sum(outOfRange)))
+        fitweights[outOfRange] = 0
+
+    # not enough data
+    nodata = (nfreq < 30)
+    if nodata.any():
+        logging.warning('No valid data found for Faraday fitting for antenna: '+ant+' at %i time slots' % np.sum(nodata))
+        fitrm[nodata] = 0
+        fitweights[nodata] = 0
+
+    outQueue.put([ant, fitrm, fitweights])
+
+
+def run( soltab, refAnt='', maxResidual=1., maxRM=2., ncpu=0 ):
     """
     Faraday rotation extraction from either a rotation table or a circular phase (of which the operation get the polarisation difference).
 
@@ -27,12 +111,15 @@ def run( soltab, refAnt='', maxResidual=1. ):
     maxResidual : float, optional
         Max average residual in radians before flagging datapoint, by default 1. If 0: no check.
 
+    maxRM : float, optional
+        The rotation measure is searched between -maxRM and +maxRM rad/m^2, by default 2. Fits out of the
+        range are flagged. If 0: up to the largest RM that the channel spacing can resolve
+        (pi/(2*min(delta wavelength^2))), the search is then much more costly with narrow channels.
+
+    ncpu : int, optional
+        Number of cpu to use, by default all available.
     """
     import numpy as np
-    import scipy.optimize
-
-    rmwavcomplex = lambda RM, wav, y: abs(np.cos(2.*RM[0]*wav*wav)  - np.cos(y)) + abs(np.sin(2.*RM[0]*wav*wav)  - np.sin(y))
-    c = 2.99792458e8
 
     logging.info("Find FR for soltab: "+soltab.name)
 
@@ -48,7 +135,7 @@ def run( soltab, refAnt='', maxResidual=1. ):
             coord_rr = np.where(soltab.getAxisValues('pol') == 'XX')[0][0]
             coord_ll = np.where(soltab.getAxisValues('pol') == 'YY')[0][0]
         else:
-            logging.error("Cannot proceed with Faraday estimation with polarizations: "+str(coord['pol']))
+            logging.error("Cannot proceed with Faraday estimation with polarizations: "+str(soltab.getAxisValues('pol')))
             return 1
     elif solType == 'rotation':
         returnAxes = ['freq','time']
@@ -62,6 +149,10 @@ def run( soltab, refAnt='', maxResidual=1. ):
         refAnt = ants[0]
     if refAnt == '': refAnt = ants[0]
 
+    if soltab.getAxisLen('freq') < 10:
+        logging.error('Faraday rotation estimation needs at least 10 frequency channels, preferably distributed over a wide range.')
+        return 1
+
     # times and ants needs to be complete or selection is much slower
     times = soltab.getAxisValues('time')
 
@@ -73,107 +164,34 @@ def run( soltab, refAnt='', maxResidual=1. ):
                              weights=np.ones((len(ants),len(times))))
     soltabout.addHistory('Created by FARADAY operation from %s.' % soltab.name)
 
+    # one antenna per process
+    mpm = multiprocManager(ncpu, _fitRM)
     for vals, weights, coord, selection in soltab.getValuesIter(returnAxes=returnAxes, weight=True, reference=refAnt):
-
-        if len(coord['freq']) < 10:
-            logging.error('Faraday rotation estimation needs at least 10 frequency channels, preferably distributed over a wide range.')
-            return 1
+        if coord['ant'] == refAnt: continue
 
         # reorder axes
         vals = reorderAxes( vals, soltab.getAxesNames(), returnAxes )
         weights = reorderAxes( weights, soltab.getAxesNames(), returnAxes )
 
-        fitrm = np.zeros(len(times))
-        fitweights = np.ones(len(times)) # all unflagged to start
-        fitrmguess = 0.001 # good guess
-
-        if not coord['ant'] == refAnt:
-            logging.debug('Working on ant: '+coord['ant']+'...')
-
-            if (weights == 0.).all() == True:
-                logging.warning('Skipping flagged antenna: '+coord['ant'])
-                fitweights[:] = 0
-            else:
-
-                for t, time in enumerate(times):
-
-                    if solType == 'phase':
-                        idx       = ((weights[coord_rr,:,t] != 0.) & (weights[coord_ll,:,t] != 0.))
-                        freq      = np.copy(coord['freq'])[idx]
-                        phase_rr  = vals[coord_rr,:,t][idx]
-                        phase_ll  = vals[coord_ll,:,t][idx]
-                        # RR-LL to be consistent with BBS/NDPPP
-                        phase_diff  = (phase_rr - phase_ll)      # not divide by 2 otherwise jump problem, then later fix this
-                    else: # rotation table
-                        idx        = ((weights[:,t] != 0.) & (weights[:,t] != 0.))
-                        freq       = np.copy(coord['freq'])[idx]
-                        phase_diff = 2.*vals[:,t][idx] # a rotation is between -pi and +pi
-
-                    if len(freq) < 30:
-                        fitweights[t] = 0
-                        logging.warning('No valid data found for Faraday fitting for antenna: '+coord['ant']+' at timestamp '+str(t))
-                        continue
-        
-                    # if more than 1/4 of chans are flagged
-                    if (len(idx) - len(freq))/float(len(idx)) > 1/4.:
-                        logging.debug('High number of filtered out data points for the timeslot %i: %i/%i' % (t, len(idx) - len(freq), len(idx)) )
-
-                    wav = c/freq
-    
-                    fitresultrm_wav, success = scipy.optimize.leastsq(rmwavcomplex, [fitrmguess], args=(wav, phase_diff))
-                    # fractional residual
-                    residual = np.nanmean(np.abs(np.mod((2.*fitresultrm_wav*wav*wav)-phase_diff + np.pi, 2.*np.pi) - np.pi))
-
-#                    print "t:", t, "result:", fitresultrm_wav, "residual:", residual
-
-                    if maxResidual == 0 or residual < maxResidual:
-                        fitrmguess = fitresultrm_wav[0]
-                        weight = 1
-                    else:       
-                        # high residual, flag
-                        logging.warning('Bad solution for ant: '+coord['ant']+' (time: '+str(t)+', resdiaul: '+str(residual)+').')
-                        weight = 0
-
-                    fitrm[t] = fitresultrm_wav[0]
-                    fitweights[t] = weight
-
-                    # Debug plot
-                    doplot = False
-                    if doplot and coord['ant'] == 'RS310LBA' and t%10==0:
-                        print("Plotting")
-                        if not 'matplotlib' in sys.modules:
-                            import matplotlib as mpl
-                            mpl.rc('font',size =8 )
-                            mpl.rc('figure.subplot',left=0.05, bottom=0.05, right=0.95, top=0.95,wspace=0.22, hspace=0.22 )
-                            mpl.use("Agg")
-                        import matplotlib.pyplot as plt
-
-                        fig = plt.figure()
-                        fig.subplots_adjust(wspace=0)
-                        ax = fig.add_subplot(111)
-
-                        # plot rm fit
-                        plotrm = lambda RM, wav: np.mod( (2.*RM*wav*wav) + np.pi, 2.*np.pi) - np.pi # notice the factor of 2
-                        ax.plot(freq, plotrm(fitresultrm_wav, c/freq[:]), "-", color='purple')
-
-                        if solType == 'phase':
-                            ax.plot(freq, np.mod(phase_rr + np.pi, 2.*np.pi) - np.pi, 'ob' )
-                            ax.plot(freq, np.mod(phase_ll + np.pi, 2.*np.pi) - np.pi, 'og' )
-                        ax.plot(freq, np.mod(phase_diff + np.pi, 2.*np.pi) - np.pi , '.', color='purple' )                           
-     
-                        residual = np.mod(plotrm(fitresultrm_wav, c/freq[:])-phase_diff+np.pi,2.*np.pi)-np.pi
-                        ax.plot(freq, residual, '.', color='yellow')
-        
-                        ax.set_xlabel('freq')
-                        ax.set_ylabel('phase')
-                        ax.set_ylim(ymin=-np.pi, ymax=np.pi)
-    
-                        logging.warning('Save pic: '+str(t)+'_'+coord['ant']+'.png')
-                        plt.savefig(str(t)+'_'+coord['ant']+'.png', bbox_inches='tight')
-                        del fig
-
-        soltabout.setSelection(ant=coord['ant'], time=coord['time'])
-        soltabout.setValues( np.expand_dims(fitrm, axis=1) )
-        soltabout.setValues( np.expand_dims(fitweights, axis=1), weight=True )
+        if solType == 'phase':
+            # RR-LL to be consistent with BBS/NDPPP
+            phase_diff = vals[coord_rr] - vals[coord_ll] # not divide by 2 otherwise jump problem, then later fix this
+            weights = weights[coord_rr] * weights[coord_ll]
+        else: # rotation table
+            phase_diff = 2.*vals # a rotation is between -pi and +pi
+
+        mpm.put([phase_diff, weights, np.array(coord['freq']), coord['ant'], maxResidual, maxRM])
+    mpm.wait()
+
+    # the reference antenna stays at 0
+    fitrm = np.zeros((len(ants), len(times)))
+    fitweights = np.ones((len(ants), len(times)))
+    antIdx = dict([(ant, i) for i, ant in enumerate(ants)])
+    for ant, rm, w in mpm.get():
+        fitrm[antIdx[ant]] = rm
+        fitweights[antIdx[ant]] = w
+
+    soltabout.setValues( fitrm )
+    soltabout.setValues( fitweights, weight=True )
 
     return 0
@@ -25,255 +25,293 @@ def _run_parser(soltab, parser, step):
     return run( soltab, axesToFlag, order, maxCycles, maxRms, maxRmsNoise, fixRms, fixRmsNoise, windowNoise, replace, preflagzeros, mode, refAnt, ncpu )
 
 
-def _flag(vals, weights, coord, solType, order, mode, preflagzeros, maxCycles, maxRms, maxRmsNoise, windowNoise, fixRms, fixRmsNoise, replace, axesToFlag, selection, outQueue):
+# {(axes, order, flag mask): projection matrix} and {(axes, order): vandermonde matrix}
+_polyCache = {}
+_polyCacheSize = 2**22 # max number of cached elements
 
+def _polyCached(key, funct):
+    """
+    Return _polyCache[key], computing it with funct() if missing.
+    """
+    if key not in _polyCache:
+        value = funct()
+        if sum([v.size for v in _polyCache.values()]) + value.size > _polyCacheSize:
+            _polyCache.clear()
+        _polyCache[key] = value
+    return _polyCache[key]
+
+
+def _polyFit(axes, vals, weights, order, rcond=1e-15):
+    """
+    Weighted least-squares polynomial fit (1D or 2D) of a stack of slices, returns the fitted values.
+    In 1D weights are used as fit weights, in 2D all the unflagged points have the same weight.
+    Slices are grouped by flag pattern: the slices of a group with uniform weights (e.g. all
+    antennas/pols with the same flagged channels) are fitted with a single matrix product by the
+    cached projection on the polynomial space of that pattern. The other slices are fitted solving
+    their normal equations all at once.
+
+    Parameters
+    ----------
+    axes : list of arrays
+        Axes values (1 or 2).
+    vals : array
+        Values to fit (N, ...) for N slices, flagged values are ignored.
+    weights : array
+        Weights (same shape of vals).
+    order : list of int
+        Order of the polynomial along each axis.
+    rcond : float, optional
+        Cut-off for small eigenvalues of singular normal matrices (as in np.linalg.pinv), by default 1e-15.
+
+    Returns
+    -------
+    array
+        Fitted values (same shape of vals).
+    """
     import numpy as np
-    import itertools
-    from scipy.ndimage import generic_filter
-    import scipy.interpolate
+    from numpy.polynomial import polynomial
 
-    def rolling_rms(a, window):
-        """
-        Return the rms for each element of the array calculated using the element inside a window,
-        edges are mirrored
-        """
-        assert window % 2 == 1 # window must be odd
-        a = np.pad(a, window/2, mode='reflect')
-        shape = a.shape[:-1] + (a.shape[-1] - window + 1, window)
-        strides = a.strides + (a.strides[-1],)
-        return np.sqrt(np.var(np.lib.stride_tricks.as_strided(a, shape=shape, strides=strides), -1))
-
-    def polyfit(x=None, y=None, z=None, w=None, order=None):
-        """Two-dimensional polynomial fit.
-
-        References:
-            http://stackoverflow.com/questions/7997152/
-            python-3d-polynomial-surface-fit-order-dependent/7997925#7997925
-
-        x: array of coordinates
-        y: array of coordinates (2d only)
-        z: values of these coordinates (1d array as x and y)
-        w: weights
-        order: int for 1d, tuple of 2 values (x-order, y-order) for 2d
-
-        Return: matrix of coefficents, for the 2d is ok to be fed into polynomial.polyval2d()
-        """
-        assert z.shape == w.shape
-        if y is None:
-            # note that np.polynomial.polynomial.polyfit want sigmas not variances
-            m = np.polyfit(x, z, order, w=np.sqrt(w))
+    axes = [np.asarray(ax, dtype=float) for ax in axes]
+    axesKey = (tuple([ax.tobytes() for ax in axes]), tuple(order))
 
+    def vanderFunct():
+        # fitted values do not depend on the axes origin/scale: use [-1,1] for a good conditioning
+        x = [2.*(ax-np.min(ax))/max(np.ptp(ax), 1e-30)-1. for ax in axes]
+        if len(x) == 1:
+            return polynomial.polyvander(x[0], order[0])
         else:
-            from numpy.polynomial import polynomial
-            x, y = np.meshgrid(np.asarray(x),np.asarray(y), indexing='ij')
-            # TODO: unset x,y,z value if flagged
-            z = z[(w != 0)]
-            x = x[(w != 0)]
-            y = y[(w != 0)]
-            vander = polynomial.polyvander2d(x, y, order)
-            vander = vander.reshape((-1,vander.shape[-1]))
-            z = z.reshape((vander.shape[0],))
-            m = np.linalg.lstsq(vander, z)[0]
-            order = np.asarray(order)
-            m = m.reshape(order+1) # matrix of coefficents
-
-        return m
-
-    def polyval(x=None, y=None, m=None):
-        """Values to two-dimensional polynomial fit. Based uppon code
-            provided by Joe Kington.
-        """
-        if y is None:
-            poly = np.poly1d(m)
-            return poly(x)
+            x, y = np.meshgrid(x[0], x[1], indexing='ij')
+            return polynomial.polyvander2d(x.ravel(), y.ravel(), order)
+    vander = _polyCached(axesKey, vanderFunct)
+
+    N = vals.shape[0]
+    z = np.asarray(vals, dtype=float).reshape(N, -1)
+    mask = (np.asarray(weights) != 0).reshape(N, -1)
+    if len(axes) == 1:
+        w = np.where(mask, np.asarray(weights, dtype=float).reshape(N, -1), 0.)
+    else:
+        w = mask.astype(float)
+    z = np.where(mask, z, 0.)
+    fit = np.empty(z.shape)
+
+    # slices whose unflagged points have all the same weight, grouped by flag pattern
+    wMax = np.max(w, axis=1)
+    uniform = np.where(np.min(np.where(mask, w, wMax[:,np.newaxis]), axis=1) == wMax)[0]
+    solve = np.ones(N, dtype=bool)
+    if len(uniform) > 1:
+        packed = np.ascontiguousarray(np.packbits(mask[uniform], axis=1))
+        patterns = packed.view(np.dtype((np.void, packed.shape[1]))).ravel()
+        _, first, inverse = np.unique(patterns, return_index=True, return_inverse=True)
+        counts = np.bincount(inverse)
+        for g in np.where(counts > 1)[0]:
+            group = uniform[inverse == g]
+            m = mask[group[0]]
+            def projFunct():
+                # normal equations, pinv gives the least-norm solution also if not enough points are left
+                vanderW = vander.T * m
+                return np.dot(np.linalg.pinv(np.dot(vanderW, vander)), vanderW)
+            proj = _polyCached(axesKey+(m.tobytes(),), projFunct)
+            fit[group] = np.dot(np.dot(z[group], proj.T), vander.T)
+            solve[group] = False
+
+    # the other slices: one normal matrix per slice, A_n = V^T diag(w_n) V
+    solve = np.where(solve)[0]
+    if len(solve) > 0:
+        nCoeff = vander.shape[1]
+        outer = (vander[:,:,np.newaxis] * vander[:,np.newaxis,:]).reshape(len(vander), -1)
+        A = np.dot(w[solve], outer).reshape(len(solve), nCoeff, nCoeff)
+        b = np.dot(w[solve] * z[solve], vander)
+        # (nearly) singular systems (not enough points left) get the least-norm solution, as with pinv
+        S, U = np.linalg.eigh(A)
+        absS = np.abs(S)
+        singular = np.min(absS, axis=1) <= 1e-10*np.max(absS, axis=1)
+        coeff = np.empty(b.shape)
+        if (~singular).any():
+            coeff[~singular] = np.linalg.solve(A[~singular], b[~singular][:,:,np.newaxis])[:,:,0]
+        if singular.any():
+            S, U, absS = S[singular], U[singular], absS[singular]
+            with np.errstate(divide='ignore'):
+                invS = np.where(absS > rcond*np.max(absS, axis=1)[:,np.newaxis], 1./S, 0.)
+            coeff[singular] = np.einsum('nij,nj,nkj,nk->ni', U, invS, U, b[singular])
+        fit[solve] = np.dot(coeff, vander.T)
+
+    return fit.reshape(vals.shape)
+
+
+def _outlierRej(vals, weights, axes, order, mode, maxCycles, maxRms, maxRmsNoise, windowNoise, fixRms, fixRmsNoise, replace):
+    """
+    Reject outliers in a stack of slices: each cycle detrends all the slices still to process
+    (running median, polynomial or spline) and flags the points far from the trend.
 
-        else:
-            x, y = np.meshgrid(x,y, indexing='ij')
-            return np.polynomial.polynomial.polyval2d(x, y, m)
-
-
-    def outlier_rej(vals, weights, axes, order=5, mode='smooth', max_ncycles=3, max_rms=3., max_rms_noise=0., window_noise=11., fix_rms=0., fix_rms_noise=0., replace=False):
-        """
-        Reject outliers using a running median
-        val = the array (avg must be 0)
-        weights = the weights to convert into flags
-        axes = array with axes values (1d or 2d)
-        order = "see polyfit()"
-        max_ncycles = maximum number of cycles
-        max_rms = number of rms times for outlier flagging
-        max_rms_noise = cut on the rms of the rmss
-        window_noise = window used to calculate the rmss to detect noise
-        replace = instead of flag it, replace the data point with the smoothed one
-
-        return: flags array and final rms
-        """
-
-        # renormalize axes to have decent numbers
-        if len(axes) == 1:
-            axes[0] -= axes[0][0]
-            axes[0] /= axes[0][1] - axes[0][0]
-        elif len(axes) == 2:
-            axes[0] -= axes[0][0]
-            axes[0] /= (axes[0][1]-axes[0][0])
-            axes[1] -= axes[1][0]
-            axes[1] /= (axes[1][1]-axes[1][0])
-        else:
-            logging.error('FLAG operation can flag only along 1 or 2 axes. Given axes: '+str(axesToFlag))
-            return
-
-        # test artificial data
-        #axes[0] = np.array(range(len(axes[0])))*24414.0625
-        #axes[1] = np.array(range(len(axes[1])))*5
-        #vals = np.empty( shape=[len(axes[0]), len(axes[1])] )
-        #for i, xi in enumerate(axes[0]):
-        #    for j, yj in enumerate(axes[1]):
-        #        vals[i,j] = 10*xi + yj**2
-        #weights = np.ones_like(vals)
-
-        if replace:
-            orig_weights = np.copy(weights)
-
-        for i in xrange(max_ncycles):
-
-            # all is flagged? break
-            if (weights == 0).all():
-                rms = 0.
-                break
-
-            if mode == 'smooth':
-                vals_smooth = np.copy(vals)
-                np.putmask(vals_smooth, weights==0, np.nan)
-                if all(o == 0 for o in order): order = vals_smooth.shape
-                vals_smooth = generic_filter(vals_smooth, np.nanmedian, size=order)
-                vals_detrend = vals - vals_smooth
-            # TODO: should be rolling
-            elif mode == 'poly':
-                # get polynomia and values
-                if len(axes) == 1:
-                    fit_sol = polyfit(axes[0], z=vals, w=weights, order=order)
-                    vals_detrend = vals - polyval(axes[0], m=fit_sol)
-                elif len(axes) == 2:
-                    fit_sol = polyfit(axes[0], axes[1], z=vals, w=weights, order=order)
-                    vals_smooth = polyval(axes[0], axes[1], m=fit_sol)
-                    vals_detrend = vals - vals_smooth
-            # TODO: should be rolling
-            elif mode == 'spline':
-                # get spline
+    Parameters
+    ----------
+    vals : array
+        Values (N, ...) for N slices along the axes to flag (avg must be 0).
+    weights : array
+        Weights (same shape of vals) to convert into flags.
+    axes : list of arrays
+        Values of the axes to flag (1 or 2).
+    Other parameters as in run().
+
+    Returns
+    -------
+    weights, vals, rms
+        Updated weights, values (only changed if replace) and final rms of each slice.
+    """
+    import numpy as np
+    import warnings
+    import scipy.interpolate
+
+    allAxes = tuple(range(1, vals.ndim))
+    if mode == 'smooth' and all(o == 0 for o in order): order = vals.shape[1:]
+
+    def sliceNanmedian(x):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning) # all-NaN slices
+            return np.nanmedian(x.reshape(len(x), -1), axis=1).reshape((-1,)+(1,)*(x.ndim-1))
+
+    if replace:
+        orig_weights = np.copy(weights)
+    vals_smooth = np.zeros(vals.shape)
+    rms = np.zeros(len(vals))
+
+    active = np.ones(len(vals), dtype=bool)
+    for i in xrange(maxCycles):
+
+        # all is flagged? stop
+        active &= ~(weights == 0).all(axis=allAxes)
+        if not active.any(): break
+        idx = np.where(active)[0]
+        vi = vals[idx]
+        wi = weights[idx]
+
+        if mode == 'smooth':
+            vals_smooth[idx] = nanRunningMedian(np.where(wi != 0, vi, np.nan), size=order, mode='reflect')
+        # TODO: should be rolling
+        elif mode == 'poly':
+            vals_smooth[idx] = _polyFit(axes, vi, wi, order)
+        # TODO: should be rolling
+        elif mode == 'spline':
+            for j, v, w in zip(idx, vi, wi):
                 if len(axes) == 1:
-                    spline = scipy.interpolate.UnivariateSpline(axes[0], y=vals, w=weights, k=order[0])
-                    vals_detrend = vals - spline(axes[0])
-                elif len(axes) == 2:
+                    spline = scipy.interpolate.UnivariateSpline(axes[0], y=v, w=w, k=order[0])
+                    vals_smooth[j] = spline(axes[0])
+                else:
                     x, y = np.meshgrid(axes[0], axes[1], indexing='ij')
                     # spline doesn't like w=0
-                    z = vals[(weights != 0)].flatten()
-                    x = x[(weights != 0)].flatten()
-                    y = y[(weights != 0)].flatten()
-                    w = weights[(weights != 0)].flatten()
-                    spline = scipy.interpolate.SmoothBivariateSpline(x, y, z, w, kx=order[0], ky=order[1])
-                    vals_smooth = spline(axes[0], axes[1])
-                    vals_detrend = vals - vals_smooth
-
-            # remove outliers
-            if max_rms > 0 or fix_rms > 0:
-                # median calc https://en.wikipedia.org/wiki/Median_absolute_deviation
-                rms =  1.4826 * np.nanmedian( np.abs(vals_detrend[(weights != 0)]) )
-                if np.isnan(rms): weights[:] = 0
-                elif fix_rms > 0:
-                    flags = abs(vals_detrend) > fix_rms
-                    weights[ flags ] = 0
+                    good = (w != 0)
+                    spline = scipy.interpolate.SmoothBivariateSpline(x[good], y[good], v[good], w[good], kx=order[0], ky=order[1])
+                    vals_smooth[j] = spline(axes[0], axes[1])
+        vals_detrend = vi - vals_smooth[idx]
+        flags = np.zeros(vi.shape, dtype=bool)
+
+        # remove outliers
+        if maxRms > 0 or fixRms > 0:
+            # median calc https://en.wikipedia.org/wiki/Median_absolute_deviation
+            rmsi = 1.4826 * sliceNanmedian( np.where(wi != 0, np.abs(vals_detrend), np.nan) )
+            with np.errstate(invalid='ignore'):
+                if fixRms > 0:
+                    flags = np.abs(vals_detrend) > fixRms
                 else:
-                    flags = abs(vals_detrend) > max_rms * rms
-                    weights[ flags ] = 0
+                    flags = np.abs(vals_detrend) > maxRms * rmsi
+            flags[np.isnan(rmsi).ravel()] = False
+            wi[np.isnan(rmsi).ravel()] = 0
+            wi[flags] = 0
+            rms[idx] = rmsi.ravel()
+
+        # remove noisy regions of data
+        if maxRmsNoise > 0 or fixRmsNoise > 0:
+            # running rms along all the flagged axes, edges are mirrored
+            rmses = nanRunningRms(np.where(wi != 0, vals_detrend, np.nan), [windowNoise]*(vi.ndim-1), mode='mirror')
+            rmsi = 1.4826 * sliceNanmedian( np.abs(rmses) )
+            with np.errstate(invalid='ignore'):
+                if fixRmsNoise > 0:
+                    flags = rmses > fixRmsNoise
+                else:
+                    flags = rmses > (maxRmsNoise * rmsi)
+            wi[flags] = 0
+            rms[idx] = rmsi.ravel()
 
-            # remove noisy regions of data
-            if max_rms_noise > 0 or fix_rms_noise > 0:
-                rmses = rolling_rms(vals_detrend, window_noise)
-                rms =  1.4826 * np.nanmedian( abs(rmses) )
+        weights[idx] = wi
+        # no flags? stop
+        active[idx[~flags.any(axis=allAxes)]] = False
 
-                # rejection
-                if fix_rms_noise > 0:
-                    flags = rmses > fix_rms_noise
-                else:
-                    flags = rmses > (max_rms_noise * rms)
-                weights[ flags ] = 0
-
-            # all is flagged? break
-            if (weights == 0).all():
-                rms == 0.
-                break
-
-            # no flags? break
-            if (flags == False).all():
-                break
-
-        # replace (outlier) flagged values with smoothed ones
-        if replace:
-            logging.debug('Replacing %.2f%% of the data.' % np.sum(orig_weights != weights))
-            vals[np.where(orig_weights != weights)] = vals_smooth[np.where(orig_weights != weights)]
-            weights = orig_weights
-
-        # plot 1d
-        plot = False
-        if plot:
-            import matplotlib as mpl
-            mpl.use("Agg")
-            import matplotlib.pyplot as plt
-            plt.plot(axes[0][weights == 0], vals[weights == 0], 'ro')
-            plt.plot(axes[0], vals, 'k.')
-            plt.plot(axes[0], vals_smooth, 'r.')
-            #plt.plot(axes[0], vals_detrend, 'g.')
-            plt.savefig('test.png')
-            #sys.exit(1)
-
-        return weights, vals, rms
+    # replace (outlier) flagged values with smoothed ones
+    if replace:
+        changed = (orig_weights != weights)
+        logging.debug('Replacing %.2f%% of the data.' % (100.*np.sum(changed)/float(max(changed.size, 1))))
+        vals[changed] = vals_smooth[changed]
+        weights = orig_weights
 
+    rms[np.isnan(rms) | (weights == 0).all(axis=allAxes)] = 0.
+    return weights, vals, rms
 
-    def percentFlagged(w):
-        return 100.*(weights.size-np.count_nonzero(weights))/float(weights.size)
-    ########################################
 
-    # check if everything flagged
-    if (weights == 0).all() == True:
-        logging.debug('Percentage of data flagged/replaced (%s): already completely flagged' % (removeKeys(coord, axesToFlag)))
-        outQueue.put([vals, weights, selection])
+def _flag(vals, weights, coords, solType, order, mode, preflagzeros, maxCycles, maxRms, maxRmsNoise, windowNoise, fixRms, fixRmsNoise, replace, axesToFlag, selections, outQueue):
+    """
+    Flag a stack of slices (N, ...) along axesToFlag, coords and selections are the lists of the N slices.
+    """
+    import numpy as np
+
+    vals = np.array(vals, dtype=float)
+    weights = np.array(weights, dtype=float)
+    allAxes = tuple(range(1, vals.ndim))
+
+    def percentFlagged(w):
+        return 100.*np.sum(w.reshape(len(w), -1) == 0, axis=1)/float(max(w[0].size, 1))
+
+    # already completely flagged slices are left untouched
+    todo = np.where(~(weights == 0).all(axis=allAxes))[0]
+    for i in np.where((weights == 0).all(axis=allAxes))[0]:
+        logging.debug('Percentage of data flagged/replaced (%s): already completely flagged' % (removeKeys(coords[i], axesToFlag)))
+    if len(todo) == 0:
+        outQueue.put([vals, weights, selections])
         return
+    v = vals[todo]
+    w = weights[todo]
 
     if preflagzeros:
-        if solType == 'amplitude': np.putmask(weights, vals == 1, 0)
-        else: np.putmask(weights, vals == 0, 0)
+        if solType == 'amplitude': np.putmask(w, v == 1, 0)
+        else: np.putmask(w, v == 0, 0)
 
+    # renormalize axes to have decent numbers
     flagCoord = []
     for axisToFlag in axesToFlag:
-        flagCoord.append(coord[axisToFlag])
+        axis = np.array(coords[0][axisToFlag], dtype=float)
+        if len(axis) > 1: axis = (axis - axis[0]) / (axis[1] - axis[0])
+        flagCoord.append(axis)
 
-    initPercentFlag = percentFlagged(weights)
+    initPercentFlag = percentFlagged(w)
 
     # works in phase-space (assume no wraps), remove just the mean to prevent problems if the phase is constantly around +/-pi
     if solType == 'phase' or solType == 'scalarphase' or solType == 'rotation':
         # remove mean of vals
-        mean = np.angle( np.sum( weights.flatten() * np.exp(1j*vals.flatten()) ) / ( vals.flatten().size * sum(weights.flatten()) ) )
-        logging.debug('Working in phase-space, remove angular mean '+str(mean)+'.')
-        vals = normalize_phase(vals - mean)
-        weights, vals, rms = outlier_rej(vals, weights, flagCoord, order, mode, maxCycles, maxRms, maxRmsNoise, windowNoise, fixRms, fixRmsNoise, replace)
-        vals = normalize_phase(vals + mean)
+        size = np.prod(v.shape[1:])
+        mean = np.angle( np.sum( w * np.exp(1j*v), axis=allAxes ) / ( size * np.sum(w, axis=allAxes) ) )
+        mean = mean.reshape((-1,)+(1,)*(v.ndim-1))
+        v = normalize_phase(v - mean)
+        w, v, rms = _outlierRej(v, w, flagCoord, order, mode, maxCycles, maxRms, maxRmsNoise, windowNoise, fixRms, fixRmsNoise, replace)
+        v = normalize_phase(v + mean)
 
     elif solType == 'amplitude':
-        vals_good = (vals>0)
-        vals[vals_good] = np.log10(vals[vals_good])
-        weights, vals, rms = outlier_rej(vals, weights, flagCoord, order, mode, maxCycles, maxRms, maxRmsNoise, windowNoise, fixRmsNoise, replace)
-        vals[vals_good] = 10**vals[vals_good]
+        vals_good = (v>0)
+        v[vals_good] = np.log10(v[vals_good])
+        w, v, rms = _outlierRej(v, w, flagCoord, order, mode, maxCycles, maxRms, maxRmsNoise, windowNoise, fixRms, fixRmsNoise, replace)
+        v[vals_good] = 10**v[vals_good]
 
     else:
-        weights, vals, rms = outlier_rej(vals, weights, flagCoord, order, mode, maxCycles, maxRms, maxRmsNoise, windowNoise, fixRms, fixRmsNoise, replace)
+        w, v, rms = _outlierRej(v, w, flagCoord, order, mode, maxCycles, maxRms, maxRmsNoise, windowNoise, fixRms, fixRmsNoise, replace)
 
-    if percentFlagged(weights) == initPercentFlag:
-        logging.debug('Percentage of data flagged/replaced (%s): %.3f -> None' % ((removeKeys(coord, axesToFlag), initPercentFlag)))
-    else:
-        logging.debug('Percentage of data flagged/replaced (%s): %.3f -> %.3f %% (rms: %.5f)' \
-            % ((removeKeys(coord, axesToFlag), initPercentFlag, percentFlagged(weights), rms)))
+    for i, initPercent, percent, r in zip(todo, initPercentFlag, percentFlagged(w), rms):
+        if percent == initPercent:
+            logging.debug('Percentage of data flagged/replaced (%s): %.3f -> None' % ((removeKeys(coords[i], axesToFlag), initPercent)))
+        else:
+            logging.debug('Percentage of data flagged/replaced (%s): %.3f -> %.3f %% (rms: %.5f)' \
+                % ((removeKeys(coords[i], axesToFlag), initPercent, percent, r)))
 
-    outQueue.put([vals, weights, selection])
-#    return vals, weights, selection
+    vals[todo] = v
+    weights[todo] = w
+    outQueue.put([vals, weights, selections])
 
 
 def run( soltab, axesToFlag, order, maxCycles=5, maxRms=5., maxRmsNoise=0., fixRms=0., fixRmsNoise=0., windowNoise=11, replace=False, preflagzeros=False, mode='smooth', refAnt='', ncpu=0 ):
@@ -305,7 +343,7 @@ def run( soltab, axesToFlag, order, maxCycles=5, maxRms=5., maxRmsNoise=0., fixR
         Instead of calculating rms of the rmses use this value (it will not be multiplied by the MaxRmsNoise), by default 0 (ignored).
 
     windowNoise : int, optional
-        Window size for the running rms, by default 11.
+        Window size for the running rms (along each of axesToFlag), by default 11.
 
     replace : bool, optional
         Replace bad values with the interpolated ones, instead of flagging them. By default False.
@@ -322,6 +360,7 @@ def run( soltab, axesToFlag, order, maxCycles=5, maxRms=5., maxRmsNoise=0., fixR
     ncpu : int, optional
         Number of cpu to use, by default all available.
     """
+    import numpy as np
 
     logging.info("Flag on soltab: "+soltab.name)
 
@@ -347,10 +386,11 @@ def run( soltab, axesToFlag, order, maxCycles=5, maxRms=5., maxRmsNoise=0., fixR
         logging.error("AxesToFlag and order must be both 1 or 2 values.")
         return 1
 
-    if len(order) == 2: order = tuple(order)
+    if len(axesToFlag) > 2:
+        logging.error('FLAG operation can flag only along 1 or 2 axes. Given axes: '+str(axesToFlag))
+        return 1
 
-    # start processes for multi-thread
-    mpm = multiprocManager(ncpu, _flag)
+    if len(order) == 2: order = tuple(order)
 
     # reorder axesToFlag as axes in the table
     axesToFlag_orig = axesToFlag
@@ -359,18 +399,32 @@ def run( soltab, axesToFlag, order, maxCycles=5, maxRms=5., maxRmsNoise=0., fixR
 
     solType = soltab.getType()
 
+    # start processes for multi-thread
+    mpm = multiprocManager(ncpu, _flag)
+
     # fill the queue (note that sf and sw cannot be put into a queue since they have file references)
-    for vals, weights, coord, selection in soltab.getValuesIter(returnAxes=axesToFlag, weight=True, reference=refAnt):
-        mpm.put([vals, weights, coord, solType, order, mode, preflagzeros, maxCycles, maxRms, maxRmsNoise, windowNoise, fixRms, fixRmsNoise, replace, axesToFlag, selection])
+    slices = list(soltab.getValuesIter(returnAxes=axesToFlag, weight=True, reference=refAnt))
+    if mode == 'poly':
+        # slices are detrended in stacks (one per process), so that the fits of slices sharing a flag pattern are a single product
+        chunks = np.array_split(np.arange(len(slices)), min(len(slices), mpm.procs)) if slices else []
+    else:
+        chunks = [[i] for i in xrange(len(slices))]
+    for chunk in chunks:
+        vals = np.array([slices[i][0] for i in chunk])
+        weights = np.array([slices[i][1] for i in chunk])
+        coords = [slices[i][2] for i in chunk]
+        selections = [slices[i][3] for i in chunk]
+        mpm.put([vals, weights, coords, solType, order, mode, preflagzeros, maxCycles, maxRms, maxRmsNoise, windowNoise, fixRms, fixRmsNoise, replace, axesToFlag, selections])
 
     mpm.wait()
 
-    for v, w, sel in mpm.get():
-        if replace:
-            # rewrite solutions (flagged values are overwritten)
-            soltab.setValues(v, sel, weight=False)
-        else:
-            soltab.setValues(w, sel, weight=True)
+    for vals, weights, selections in mpm.get():
+        for v, w, sel in zip(vals, weights, selections):
+            if replace:
+                # rewrite solutions (flagged values are overwritten)
+                soltab.setValues(v, sel, weight=False)
+            else:
+                soltab.setValues(w, sel, weight=True)
 
     soltab.flush()
     soltab.addHistory('FLAG (over %s with %s sigma cut)' % (axesToFlag, maxRms))
@@ -17,50 +17,48 @@ def _run_parser(soltab, parser, step):
     return run(soltab, axesToExt, size, percent, maxCycles, ncpu)
 
 
-def _flag(weights, coord, axesToExt, selection, percent=50, size=[0], maxCycles=3, outQueue=None):
-        """
-        Flag data if surreounded by other flagged data
-        weights = the weights to convert into flags
-        percent = percent of surrounding flagged point to extend the flag
-        
-        return: flags array and final rms
-        """
-        def extendFlag(flags, percent):
-            #flags = flags.astype(np.int)
-            if float(np.sum( flags ))/len(flags) > percent/100.:
-                return 1
-            else:
-                return 0
-
-        def percentFlagged(w):
-            return 100.*(weights.size-np.count_nonzero(weights))/float(weights.size)
-
-
-        import scipy.ndimage
-        import numpy as np
-        initPercent = percentFlagged(weights)
-
-        # if size=0 then extend to all 2*axis, this otherwise create issues with mirroring
-        for i, s in enumerate(size):
-            if s == 0: size[i] = 2*weights.shape[i]
-
-        for cycle in xrange(maxCycles):
-            flag = scipy.ndimage.filters.generic_filter((weights==0), extendFlag, size=size, mode='mirror', cval=0.0, origin=0, extra_keywords={'percent':percent})
-            weights[ ( flag == 1 ) ] = 0
-            # no new flags
-            if cycle != 0 and np.count_nonzero(flag) == oldFlagCount: break
-            oldFlagCount = np.count_nonzero(flag)
-
-        if percentFlagged(weights) == initPercent:
-            logging.debug('Percentage of data flagged (%s): %.3f -> None' \
-                    % (removeKeys(coord, axesToExt), initPercent))
-        else:
-            logging.debug('Percentage of data flagged (%s): %.3f -> %.3f %%' \
-                    % (removeKeys(coord, axesToExt), initPercent, percentFlagged(weights)))
-
-        outQueue.put([weights, selection])
-        
-            
+def _extendFlag(weights, axes, size, percent=50, maxCycles=3):
+    """
+    Flag data if surrounded by other flagged data, all the slices at once.
+    The number of flagged neighbours is computed with box sums, so the cost does not depend on the window size.
+
+    Parameters
+    ----------
+    weights : array
+        The weights to convert into flags (modified in place).
+    axes : list of int
+        Axes along which to look for close flags.
+    size : list of int
+        Window size along each axis (0 = twice the axis length).
+    percent : float, optional
+        Percent of surrounding flagged points to extend the flag, by default 50.
+    maxCycles : int, optional
+        Max number of cycles, by default 3.
+
+    Returns
+    -------
+    array
+        The weights.
+    """
+    import numpy as np
+
+    # if size=0 then extend to all 2*axis, this otherwise create issues with mirroring
+    size = [2*weights.shape[ax] if s == 0 else s for ax, s in zip(axes, size)]
+    windowSize = float(np.prod(size))
+
+    oldFlagCount = None
+    for cycle in xrange(maxCycles):
+        nflagged = runningSum((weights == 0).astype(float), size, axes, mode='mirror')
+        flag = (nflagged/windowSize > percent/100.)
+        weights[ flag ] = 0
+        # no new flags (flags only grow, so if the count does not change nothing changes)
+        flagCount = np.sum(flag, axis=tuple(axes))
+        if oldFlagCount is not None and (flagCount == oldFlagCount).all(): break
+        oldFlagCount = flagCount
+
+    return weights
+
+
 def run( soltab, axesToExt, size, percent=50., maxCycles=3, ncpu=0 ):
     """
     This operation for LoSoTo implement a extend flag procedure
@@ -84,7 +82,7 @@ def run( soltab, axesToExt, size, percent=50., maxCycles=3, ncpu=0 ):
         Number of independent cycles of flag expansion, by default 3.
 
     ncpu : int, optional
-        Number of CPU used, by default all available.
+        Not used, the operation is vectorized over all the slices. Kept for compatibility.
     """
 
     import numpy as np
@@ -96,24 +94,25 @@ def run( soltab, axesToExt, size, percent=50., maxCycles=3, ncpu=0 ):
         logging.error("Please specify at least one axis to extend flag.")
         return 1
 
-    # start processes for multi-thread
-    mpm = multiprocManager(ncpu, _flag)
-
     for axisToExt in axesToExt:
         if axisToExt not in soltab.getAxesNames():
             logging.error('Axis \"'+axisToExt+'\" not found.')
-            mpm.wait()
             return 1
 
-    # fill the queue (note that sf and sw cannot be put into a queue since they have file references)
-    for vals, weights, coord, selection in soltab.getValuesIter(returnAxes=axesToExt, weight=True):
-        mpm.put([weights, coord, axesToExt, selection, percent, size, maxCycles])
+    if len(size) != len(axesToExt):
+        logging.error("Axes and size lengths must be equal.")
+        return 1
 
-    mpm.wait()
+    # all the slices are done at once
+    weights = soltab.getValues(retAxesVals=False, weight=True)
+    axes = [soltab.getAxesNames().index(axisToExt) for axisToExt in axesToExt]
+    initPercent = 100.*(weights.size-np.count_nonzero(weights))/float(weights.size)
+    weights = _extendFlag(weights, axes, size, percent, maxCycles)
+    logging.debug('Percentage of data flagged: %.3f -> %.3f %%' \
+            % (initPercent, 100.*(weights.size-np.count_nonzero(weights))/float(weights.size)))
 
     logging.info('Writing solutions')
-    for w, sel in mpm.get():
-        soltab.setValues(w, sel, weight=True)
+    soltab.setValues(weights, weight=True)
 
     soltab.addHistory('FLAG EXTENDED (over %s)' % (str(axesToExt)))
     return 0
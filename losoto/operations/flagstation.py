@@ -524,6 +524,7 @@ def run( soltab, mode, maxFlaggedFraction=0.5, nSigma=5.0, telescope='lofar', re
     # Check for NaN solutions and flag
     flagged = np.where(np.isnan(vals_arraytmp))
     weights_arraytmp[flagged] = 0.0
+    ants = soltab.ant
 
     if mode == 'bandpass':
         solType = soltab.getType()
@@ -533,9 +534,10 @@ def run( soltab, mode, maxFlaggedFraction=0.5, nSigma=5.0, telescope='lofar', re
 
         # Fill the queue
         mpm = multiprocManager(ncpu, _flag_bandpass)
-        for s in range(len(soltab.ant)):
-            mpm.put([soltab.freq[:], vals_arraytmp[:, s, :, :], weights_arraytmp[:, s, :, :],
-                     telescope, nSigma, maxFlaggedFraction, 0.01, False, soltab.ant[:], s])
+        freqs = soltab.freq
+        for s in range(len(ants)):
+            mpm.put([freqs, vals_arraytmp[:, s, :, :], weights_arraytmp[:, s, :, :],
+                     telescope, nSigma, maxFlaggedFraction, 0.01, False, ants, s])
         mpm.wait()
 
         # Write new weights
@@ -559,15 +561,15 @@ def run( soltab, mode, maxFlaggedFraction=0.5, nSigma=5.0, telescope='lofar', re
         if 'dir' in axis_names:
             for d, dirname in enumerate(soltab.dir):
                 mpm = multiprocManager(ncpu, _flag_resid)
-                for s in range(len(soltab.ant)):
-                    mpm.put([vals_arraytmp[:, s, :, :, d], weights_arraytmp[:, s, :, :, d], solType, nSigma, maxFlaggedFraction, maxStddev, soltab.ant[:], s])
+                for s in range(len(ants)):
+                    mpm.put([vals_arraytmp[:, s, :, :, d], weights_arraytmp[:, s, :, :, d], solType, nSigma, maxFlaggedFraction, maxStddev, ants, s])
                 mpm.wait()
                 for (s, w) in mpm.get():
                     weights_arraytmp[:, s, :, :, d] = w
         else:
             mpm = multiprocManager(ncpu, _flag_resid)
-            for s in range(len(soltab.ant)):
-                mpm.put([vals_arraytmp[:, s, :, :], weights_arraytmp[:, s, :, :], solType, nSigma, maxFlaggedFraction, maxStddev, soltab.ant[:], s])
+            for s in range(len(ants)):
+                mpm.put([vals_arraytmp[:, s, :, :], weights_arraytmp[:, s, :, :], solType, nSigma, maxFlaggedFraction, maxStddev, ants, s])
             mpm.wait()
             for (s, w) in mpm.get():
                 weights_arraytmp[:, s, :, :] = w
@@ -587,20 +589,21 @@ def run( soltab, mode, maxFlaggedFraction=0.5, nSigma=5.0, telescope='lofar', re
         soltabexp = solset.getSoltab(soltabExport)
         axis_namesexp = soltabexp.getAxesNames()
 
+        pols = soltab.pol.tolist()
         for stat in soltabexp.ant:
-            if stat in soltab.ant:
-                s = soltab.ant[:].tolist().index(stat)
+            if stat in ants:
+                s = ants.tolist().index(stat)
                 if 'pol' in axis_namesexp:
                     for pol in soltabexp.pol:
-                        if pol in soltab.pol:
+                        if pol in pols:
                             soltabexp.setSelection(ant=stat, pol=pol)
-                            p = soltab.pol[:].tolist().index(pol)
+                            p = pols.index(pol)
                             if np.all(weights_arraytmp[:, s, :, p] == 0):
-                                soltabexp.setValues(np.zeros(soltabexp.weight.shape), weight=True)
+                                soltabexp.setValues(np.zeros(soltabexp.shape), weight=True)
                 else:
                     soltabexp.setSelection(ant=stat)
                     if np.all(weights_arraytmp[:, s, :, :] == 0):
-                        soltabexp.setValues(np.zeros(soltabexp.weight.shape), weight=True)
+                        soltabexp.setValues(np.zeros(soltabexp.shape), weight=True)
         soltabexp.addHistory('WEIGHT imported by FLAGSTATION from '+soltab.name+'.')
 
     return 0
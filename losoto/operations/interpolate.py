@@ -131,7 +131,7 @@ def run( soltab, outsoltab, axisToRegrid, newdelta, delta='', maxFlaggedWidth=0,
     axisind = soltab.getAxesNames().index(axisToRegrid)
     orig_axisvals = soltab.getAxisValues(axisToRegrid)
     new_axisvals = _regrid_axis(orig_axisvals, delta, newdelta)
-    orig_shape = soltab.val.shape
+    orig_shape = soltab.shape
     new_shape = list(orig_shape)
     new_shape[axisind] = len(new_axisvals)
     new_vals = np.zeros(new_shape, dtype='float')
@@ -37,17 +37,25 @@ def run( soltab, axesToNorm, normVal = 1. ):
             logging.error('Normalization axis '+normAxis+' not found.')
             return 1
 
-    for vals, weights, coord, selection in soltab.getValuesIter(returnAxes=axesToNorm, weight = True):
-
-        # rescale solutions
-        if np.sum(weights) == 0: continue # skip flagged selections
-        valsMean = np.average(vals, weights=weights)
-        vals[weights != 0] *= normVal/valsMean
-        logging.debug(str(coord))
-        logging.debug("Rescaling by: "+str(normVal/valsMean))
-
-        # writing back the solutions
-        soltab.setValues(vals, selection)
+    vals = soltab.getValues(retAxesVals=False)
+    weights = soltab.getValues(retAxesVals=False, weight=True)
+    axes = tuple([axesNames.index(normAxis) for normAxis in axesToNorm])
+
+    # weighted mean over axesToNorm for all the other axes at once
+    for chunk in chunkSelections(vals.shape, axes):
+        v = vals[chunk] # view: rescaled in place
+        w = weights[chunk]
+        sumWeights = np.sum(w, axis=axes, keepdims=True, dtype=float)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            valsMean = np.sum(v*w, axis=axes, keepdims=True, dtype=float) / sumWeights
+            # rescale solutions, skip flagged selections
+            factor = np.where(sumWeights == 0, 1., normVal/valsMean)
+        np.putmask(v, w != 0, v*factor)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("Rescaling %i selections by factors: min %f, median %f, max %f", factor.size, np.nanmin(factor), np.nanmedian(factor), np.nanmax(factor))
+
+    # writing back the solutions
+    soltab.setValues(vals)
 
     soltab.flush()
     soltab.addHistory('NORM (on axis %s)' % (axesToNorm))
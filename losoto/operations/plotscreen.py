@@ -7,6 +7,7 @@
 import logging
 from losoto.lib_operations import *
 from losoto.operations.directionscreen import _calc_piercepoint
+from losoto.operations.stationscreen import _kl_evaluate
 
 logging.debug('Loading PLOTSCREEN module.')
 
@@ -16,7 +17,7 @@ def _run_parser(soltab, parser, step):
     prefix = parser.getstr( step, "Prefix", '' )
     remove_gradient = parser.getbool( step, "RemoveGradient", False )
     show_source_names = parser.getbool( step, "ShowSourceNames", False )
-    ncpu = parser.getint( step, "npcu", 0 )
+    ncpu = parser.getint( '_global', "ncpu", 0 )
 
     parser.checkSpelling( step, soltab, ['resSoltab', 'minZ', 'maxZ', 'prefix', 'remove_gradient', 'show_source_names'])
     return run(soltab, resSoltab, minZ, maxZ, prefix, remove_gradient, show_source_names, ncpu)
@@ -289,23 +290,60 @@ def _phase_cm():
     return cm
 
 
+def _grid_points(xr, yr, east, north, up, height):
+    """
+    Returns the screen locations of the pixels of a grid
+
+    Parameters
+    ----------
+    xr : array
+        Pixel x coordinates
+    yr : array
+        Pixel y coordinates
+    east : array
+        East array
+    north : array
+        North array
+    up : array
+        Up array
+    height : float
+        height of screen (m)
+
+    Returns
+    -------
+    p : array
+        Array of locations (len(xr), len(yr), 3)
+
+    """
+    import numpy as np
+
+    if height == 0.0:
+        p = np.zeros((len(xr), len(yr), 3))
+        p[:, :, 0] = xr[:, np.newaxis]
+        p[:, :, 1] = yr[np.newaxis, :]
+    else:
+        pos = xr[:, np.newaxis, np.newaxis] * east + yr[np.newaxis, :, np.newaxis] * north
+        p, airmass = _calc_piercepoint(pos, up, height)
+    return p
+
+
 def _calculate_screen(inscreen, residuals, pp, N_piercepoints, k, east, north, up,
-    T, Nx, Ny, sindx, height, beta_val, r_0, is_phase, outQueue):
+    T, Nx, Ny, sindx, height, beta_val, r_0, is_phase, grid, outQueue):
     """
     Calculates screen images
 
     Parameters
     ----------
     inscreen : array
-        Array of screen values at the piercepoints
+        Array of screen values at the piercepoints (N_piercepoints, len(k))
     residuals : array
-        Array of screen residuals at the piercepoints
+        Array of screen residuals at the piercepoints (N_piercepoints, len(k))
     pp : array
-        Array of piercepoint locations
+        Array of piercepoint locations, the same for all the time slots
     N_piercepoints : int
         Number of pierce points
-    k : int
-        Time index
+    k : list
+        Time indices
     east : array
         East array
     north : array
@@ -329,13 +367,14 @@ def _calculate_screen(inscreen, residuals, pp, N_piercepoints, k, east, north, u
         scale size of phase fluctuations
     is_phase : bool
         input screen is a phase screen
+    grid : array
+        Screen locations of the pixels (Nx, Ny, 3) shared by all the time slots (see
+        _grid_points()). If None, the grid is made on the extent of the piercepoints pp
 
     """
-    from numpy import kron, concatenate, newaxis
-    from numpy.linalg import pinv, norm
     import numpy as np
 
-    screen = np.zeros((Nx, Ny))
+    screen = np.zeros((Nx, Ny, len(k)))
 
     if height == 0.0:
         pp1 = pp[:, :]
@@ -345,34 +384,32 @@ def _calculate_screen(inscreen, residuals, pp, N_piercepoints, k, east, north, u
     min_xy = np.amin(pp1, axis=0)
     max_xy = np.amax(pp1, axis=0)
     extent = max_xy - min_xy
-    lowerk = min_xy - 0.1 * extent
-    upperk = max_xy + 0.1 * extent
-    im_extent_mk = upperk - lowerk
-    pix_per_mk = Nx / im_extent_mk[0]
-    m_per_pixk = 1.0 / pix_per_mk
-
-    xr = np.arange(lowerk[0], upperk[0], m_per_pixk)
-    yr = np.arange(lowerk[1], upperk[1], m_per_pixk)
-    D = np.resize(pp, (N_piercepoints, N_piercepoints, 3))
-    D = np.transpose(D, (1, 0, 2)) - D
+    shared = grid is not None
+    if not shared:
+        lowerk = min_xy - 0.1 * extent
+        upperk = max_xy + 0.1 * extent
+        im_extent_mk = upperk - lowerk
+        pix_per_mk = Nx / im_extent_mk[0]
+        m_per_pixk = 1.0 / pix_per_mk
+
+        xr = np.arange(lowerk[0], upperk[0], m_per_pixk)[0: Nx]
+        yr = np.arange(lowerk[1], upperk[1], m_per_pixk)[0: Ny]
+        grid = _grid_points(xr, yr, east, north, up, height)
+    D = pp[:, np.newaxis, :] - pp[np.newaxis, :, :]
     D2 = np.sum(D**2, axis=2)
     C = -(D2 / r_0**2)**(beta_val / 2.0) / 2.0
-    f = inscreen.reshape(N_piercepoints)
+    f = inscreen.reshape((N_piercepoints, len(k)))
     fitted_tec = np.dot(C, f) + residuals
     if is_phase:
         fitted_tec = normalize_phase(fitted_tec)
-    for i, xi in enumerate(xr[0: Nx]):
-        for j, yi in enumerate(yr[0: Ny]):
-            if height == 0.0:
-                p = np.array([xi, yi, 0.0])
-            else:
-                p, airmass = _calc_piercepoint(np.dot(np.array([xi, yi]), np.array([east, north])), up, height)
-            d2 = np.sum(np.square(pp - p), axis=1)
-            c = -(d2 / ( r_0**2 ))**(beta_val / 2.0) / 2.0
-            screen[i, j] = np.dot(c, f)
 
-    # Calculate the piercepoint coords, normalized to 1
-    if height == 0.0:
+    # all the pixels and time slots at once (station screens share the grid,
+    # so it is computed once for the whole batch of time slots)
+    screen[:grid.shape[0], :grid.shape[1]] = _kl_evaluate(pp, f, grid.reshape((-1, 3)),
+        r_0, beta_val).reshape((grid.shape[0], grid.shape[1], len(k)))
+
+    # Calculate the piercepoint coords, normalized to 1 (projected coords if the grid is shared)
+    if height == 0.0 or shared:
         x = pp1[:, 0]
         y = pp1[:, 1]
     else:
@@ -648,25 +685,28 @@ def _make_screen_plots(pp, inscreen, inresiduals, weights, station_names,
 
     T = concatenate([east[:, newaxis], north[:, newaxis]], axis=1)
 
-    # Use pierce point locations of first and last time slots to estimate
-    # required size of plot in meters
     if height == 0.0:
+        # Use pierce point locations of first and last time slots to estimate
+        # required size of plot in meters
         is_image_plane = True # pierce points are image plane coords
         pp1_0 = pp[:, 0:2]
         pp1_1 = pp[:, 0:2]
-    else:
-        is_image_plane = False
-        pp1_0 = np.dot(pp[0, :, :], T)
-        pp1_1 = np.dot(pp[-1, :, :], T)
 
-    max_xy = np.amax(pp1_0, axis=0) - np.amin(pp1_0, axis=0)
-    max_xy_1 = np.amax(pp1_1, axis=0) - np.amin(pp1_1, axis=0)
-    if max_xy_1[0] > max_xy[0]:
-        max_xy[0] = max_xy_1[0]
-    if max_xy_1[1] > max_xy[1]:
-        max_xy[1] = max_xy_1[1]
+        max_xy = np.amax(pp1_0, axis=0) - np.amin(pp1_0, axis=0)
+        max_xy_1 = np.amax(pp1_1, axis=0) - np.amin(pp1_1, axis=0)
+        if max_xy_1[0] > max_xy[0]:
+            max_xy[0] = max_xy_1[0]
+        if max_xy_1[1] > max_xy[1]:
+            max_xy[1] = max_xy_1[1]
 
-    min_xy = np.array([0.0, 0.0])
+        min_xy = np.array([0.0, 0.0])
+    else:
+        # one grid for all the time slots, covering the pierce points of all of them,
+        # so that the screen locations of its pixels are computed only once
+        is_image_plane = False
+        pp1 = np.dot(pp, T)
+        min_xy = np.amin(pp1.reshape((-1, 2)), axis=0)
+        max_xy = np.amax(pp1.reshape((-1, 2)), axis=0)
     extent = max_xy - min_xy
     lower = min_xy - 0.1 * extent
     upper = max_xy + 0.1 * extent
@@ -682,6 +722,13 @@ def _make_screen_plots(pp, inscreen, inresiduals, weights, station_names,
     Ny = len(yr)
     lower = np.array([xr[0], yr[0]])
     upper = np.array([xr[-1], yr[-1]])
+    if height == 0.0:
+        grid = None
+    else:
+        grid = _grid_points(xr, yr, east, north, up, height)
+        # plot distances from the lowest pierce point
+        lower -= min_xy
+        upper -= min_xy
 
     x = np.zeros((N_times, N_piercepoints)) # plot x pos of piercepoints
     y = np.zeros((N_times, N_piercepoints)) # plot y pos of piercepoints
@@ -691,11 +738,13 @@ def _make_screen_plots(pp, inscreen, inresiduals, weights, station_names,
         for sindx in range(station_positions.shape[0]):
             logging.info('Calculating screen images...')
             residuals = inresiduals[:, :, sindx, newaxis].transpose([0, 2, 1]).reshape(N_piercepoints, N_times)
+            # the pierce points are the same for all time slots: one batch
+            # of time slots per process
             mpm = multiprocManager(ncpu, _calculate_screen)
-            for k in range(N_times):
+            for k in np.array_split(np.arange(N_times), min(N_times, mpm.procs)):
                 mpm.put([inscreen[:, k, sindx], residuals[:, k], pp,
                     N_piercepoints, k, east, north, up, T, Nx, Ny, sindx, height,
-                    beta_val, r_0, is_phase])
+                    beta_val, r_0, is_phase, grid])
             mpm.wait()
             for (k, ft, scr, xa, ya) in mpm.get():
                 screen[:, :, k] = scr
@@ -735,24 +784,16 @@ def _make_screen_plots(pp, inscreen, inresiduals, weights, station_names,
         weights = weights.transpose([0, 2, 1]).reshape(N_piercepoints, N_times)
         mpm = multiprocManager(ncpu, _calculate_screen)
         for k in range(N_times):
-            mpm.put([inscreen[:, k, :], residuals[:, k], pp[k, :, :],
-                N_piercepoints, k, east, north, up, T, Nx, Ny, -1, height,
-                beta_val, r_0, is_phase])
+            mpm.put([inscreen[:, k, :], residuals[:, k, newaxis], pp[k, :, :],
+                N_piercepoints, [k], east, north, up, T, Nx, Ny, -1, height,
+                beta_val, r_0, is_phase, grid])
         mpm.wait()
         for (k, ft, scr, xa, ya) in mpm.get():
             screen[:, :, k] = scr
             fitted_phase1[:, k] = ft
-            if is_image_plane:
-                x[k, :] = xa
-                y[k, :] = ya
-            else:
-                x[k, :] = xa - np.amin(xa) # remove offsets for each time slot
-                y[k, :] = ya - np.amin(ya)
-
-        # Normalize piercepoint locations to extent calculated above
-        if not is_image_plane:
-            x *= extent[0]
-            y *= extent[1]
+            # same frame of the grid, in km
+            x[k, :] = (xa - min_xy[0]) / 1000.0
+            y[k, :] = (ya - min_xy[1]) / 1000.0
 
         if min_val is None:
             vmin = np.min([np.amin(screen), np.amin(fitted_phase1)])
@@ -43,15 +43,9 @@ def run( soltab, soltabOut='phasediff', maxResidual=1., fitOffset=False, average
         Reference antenna, by default the first.
     """
     import numpy as np
-    import scipy.optimize
-    from scipy import stats
-    from scipy.ndimage import generic_filter
 
     logging.info("Finding polarization align for soltab: "+soltab.name)
 
-    delaycomplex = lambda d, freq, y: abs(np.cos(d[0]*freq)  - np.cos(y)) + abs(np.sin(d[0]*freq)  - np.sin(y))
-    #delaycomplex = lambda d, freq, y: abs(d[0]*freq  - y)
-
     solType = soltab.getType()
     if solType != 'phase':
         logging.warning("Soltab type of "+soltab.name+" is of type "+solType+", should be phase. Ignoring.")
@@ -62,157 +56,124 @@ def run( soltab, soltabOut='phasediff', maxResidual=1., fitOffset=False, average
         refAnt = soltab.getAxisValues('ant')[1]
     if refAnt == '': refAnt = soltab.getAxisValues('ant')[1]
 
-    # times and ants needs to be complete or selection is much slower
-    times = soltab.getAxisValues('time')
-
-    # create new table
-    solset = soltab.getSolset()
-    soltabout = solset.makeSoltab(soltype = soltab.getType(), soltabName = soltabOut, axesNames=soltab.getAxesNames(), \
-                      axesVals=[soltab.getAxisValues(axisName) for axisName in soltab.getAxesNames()], \
-                      vals=soltab.getValues(retAxesVals = False), weights=soltab.getValues(weight = True, retAxesVals = False))
-    soltabout.addHistory('Created by POLALIGN operation from %s.' % soltab.name)
-
-    if 'XX' in soltab.getAxisValues('pol'): pol = 'XX'
-    elif 'RR' in soltab.getAxisValues('pol'): pol = 'RR'
+    pols = soltab.getAxisValues('pol')
+    if 'XX' in pols: pol = 'XX'
+    elif 'RR' in pols: pol = 'RR'
     else:
         logging.error('Cannot reference to known polarisation.')
         return 1
 
-    for vals, weights, coord, selection in soltab.getValuesIter(returnAxes=['freq','pol','time'], weight=True, reference=refAnt):
-
-        # reorder axes
-        vals = reorderAxes( vals, soltab.getAxesNames(), ['pol','freq','time'] )
-        weights = reorderAxes( weights, soltab.getAxesNames(), ['pol','freq','time'] )
-
-        if 'RR' in coord['pol'] and 'LL' in coord['pol']:
-            coord1 = np.where(coord['pol'] == 'RR')[0][0]
-            coord2 = np.where(coord['pol'] == 'LL')[0][0]
-        elif 'XX' in coord['pol'] and 'YY' in coord['pol']:
-            coord1 = np.where(coord['pol'] == 'XX')[0][0]
-            coord2 = np.where(coord['pol'] == 'YY')[0][0]
+    if 'RR' in pols and 'LL' in pols:
+        coord1 = np.where(pols == 'RR')[0][0]
+        coord2 = np.where(pols == 'LL')[0][0]
+    elif 'XX' in pols and 'YY' in pols:
+        coord1 = np.where(pols == 'XX')[0][0]
+        coord2 = np.where(pols == 'YY')[0][0]
+    else:
+        logging.error('Cannot find both parallel hand polarisations.')
+        return 1
 
-        if (weights == 0.).all() == True:
-            logging.warning('Skipping flagged antenna: '+coord['ant'])
-            weights[:] = 0
+    # all antennas (and other axes) at once: (others, pol, freq, time)
+    axesNames = soltab.getAxesNames()
+    otherAxes = [ax for ax in axesNames if ax not in ['pol','freq','time']]
+    newAxes = otherAxes+['pol','freq','time']
+    vals = reorderAxes( soltab.getValues(retAxesVals=False, reference=refAnt), axesNames, newAxes )
+    weights = reorderAxes( soltab.getValues(retAxesVals=False, weight=True, reference=refAnt), axesNames, newAxes )
+    shape = vals.shape
+    otherVals = [soltab.getAxisValues(ax) for ax in otherAxes]
+    sliceName = lambda i: ', '.join([str(v[j]) for v, j in zip(otherVals, np.unravel_index(i, shape[:-3]))])
+    vals = np.array(vals.reshape((-1,)+shape[-3:]))
+    weights = np.array(weights.reshape((-1,)+shape[-3:]), dtype=float)
+    freq = soltab.getAxisValues('freq')[:, np.newaxis]
+    nfreq = len(freq)
+
+    # apply flags
+    idx = ( (weights[:,coord1] != 0.) & (weights[:,coord2] != 0.) ) # (others, freq, time)
+    n = np.sum(idx, axis=1, keepdims=True)
+    flaggedSlices = (weights == 0.).all(axis=(1,2,3))
+
+    # if more than 1/2 of chans are flagged
+    for i, t in zip(*np.where((nfreq - n[:,0,:])/float(nfreq) > 1/2.)):
+        logging.debug('High number of filtered out data points for the timeslot %i: %i/%i' % (t, nfreq - n[i,0,t], nfreq) )
+
+    phase_diff = vals[:,coord1] - vals[:,coord2]
+    phase_diff = np.mod(phase_diff + np.pi, 2.*np.pi) - np.pi
+    phase_diff = nanUnwrap(np.where(idx, phase_diff, np.nan), axis=1)
+
+    # closed form linear regression along freq for all time slots
+    with np.errstate(invalid='ignore', divide='ignore'):
+        meanFreq = np.sum(idx*freq, axis=1, keepdims=True) / n
+        meanPhase = np.nansum(phase_diff, axis=1, keepdims=True) / n
+        dfreq = np.where(idx, freq - meanFreq, 0.)
+        fit_delays = np.nansum(dfreq*(phase_diff - meanPhase), axis=1, keepdims=True) / np.sum(dfreq**2, axis=1, keepdims=True)
+        fit_offset = meanPhase - fit_delays*meanFreq
+        # get the closest n*(2pi) to the intercept and refit with only 1 parameter
+        if not fitOffset:
+            numjumps = np.around(fit_offset/(2*np.pi))
+            phase_diff -= numjumps * 2 * np.pi
+            fit_delays = np.nansum(freq*phase_diff, axis=1, keepdims=True) / np.sum(idx*freq**2, axis=1, keepdims=True)
+            fit_offset = np.zeros_like(fit_delays) # set offset to 0 to keep the rest of the script equal
+
+        # fractional residual
+        residual = np.nansum(np.abs( fit_delays*freq + fit_offset - phase_diff ), axis=1, keepdims=True) / n
+
+    # not enough points
+    nodata = (n < 30)
+    fit_weights = np.ones_like(fit_delays)
+    if maxResidual != 0:
+        bad = ~(residual < maxResidual) & ~nodata
+        for i in np.where(bad.any(axis=(1,2)) & ~flaggedSlices)[0]:
+            # high residual, flag
+            logging.warning('Bad solution for: %s (%i time slots, max residual: %s) -> ignoring.' % \
+                            (sliceName(i), np.sum(bad[i]), np.nanmax(residual[i])))
+        fit_weights[bad] = 0.
+
+    fit_weights[nodata] = 0.
+    fit_delays[nodata] = 0.
+    fit_offset[nodata] = 0.
+
+    # avg in time
+    if average:
+        fit_delays_bkp = np.copy(fit_delays)
+        fit_offset_bkp = np.copy(fit_offset)
+        np.putmask(fit_delays, fit_weights == 0, np.nan)
+        np.putmask(fit_offset, fit_weights == 0, np.nan)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fit_delays = np.nanmean(fit_delays, axis=2, keepdims=True) * np.ones_like(fit_delays)
+            # angle mean
+            fit_offset = np.angle( np.nansum( np.exp(1j*fit_offset), axis=2, keepdims=True ) / \
+                    np.sum(~np.isnan(fit_offset), axis=2, keepdims=True) ) * np.ones_like(fit_offset)
+
+        if replace:
+            fit_weights[ fit_weights == 0 ] = 1.
+            fit_weights[ np.isnan(fit_delays) ] = 0. # all the size was flagged cannot estrapolate value
         else:
+            fit_delays[ fit_weights == 0 ] = fit_delays_bkp[ fit_weights == 0 ]
+            fit_offset[ fit_weights == 0 ] = fit_offset_bkp[ fit_weights == 0 ]
+
+    for i in np.where(~flaggedSlices)[0]:
+        logging.debug('%s: average delay: %f ns (offset: %f)' % ( sliceName(i), \
+                      np.mean(fit_delays[i])*1e9, np.mean(fit_offset[i])))
+
+    # completely flagged slices keep their values with all weights set to 0
+    for i in np.where(flaggedSlices)[0]:
+        logging.warning('Skipping flagged slice: '+sliceName(i))
+    weights[flaggedSlices] = 0.
+    ok = ~flaggedSlices
+    vals[ok,coord1] = 0
+    vals[ok,coord2] = -1.*(np.mod(fit_delays[ok]*freq + fit_offset[ok] + np.pi, 2.*np.pi) - np.pi)
+    weights[ok,coord1] = fit_weights[ok]
+    weights[ok,coord2] = fit_weights[ok]
+
+    # reorder axes back to the original order
+    vals = reorderAxes( vals.reshape(shape), newAxes, axesNames )
+    weights = reorderAxes( weights.reshape(shape), newAxes, axesNames )
 
-            fit_delays=[]; fit_offset=[]; fit_weights=[]
-            for t, time in enumerate(times):
-
-                # apply flags
-                idx       = ( (weights[coord1,:,t] != 0.) & (weights[coord2,:,t] != 0.))# & (coord['freq'] > 45.e6) & (coord['freq'] < 70.e6) )
-                freq      = np.copy(coord['freq'])[idx]
-                phase1    = vals[coord1,:,t][idx]
-                phase2    = vals[coord2,:,t][idx]
-
-                if len(freq) < 30:
-                    fit_weights.append(0.)
-                    fit_delays.append(0.)
-                    fit_offset.append(0.)
-                    logging.debug('Not enough unflagged point for the timeslot '+str(t))
-                    continue
-    
-                # if more than 1/2 of chans are flagged
-                if (len(idx) - len(freq))/float(len(idx)) > 1/2.:
-                    logging.debug('High number of filtered out data points for the timeslot %i: %i/%i' % (t, len(idx) - len(freq), len(idx)) )
-    
-                phase_diff = phase1 - phase2
-                phase_diff = np.mod(phase_diff + np.pi, 2.*np.pi) - np.pi
-                phase_diff = np.unwrap(phase_diff)
-
-                A = np.vstack([freq, np.ones(len(freq))]).T
-                fitresultdelay = np.linalg.lstsq(A, phase_diff.T)[0]
-                # get the closest n*(2pi) to the intercept and refit with only 1 parameter
-                if not fitOffset:
-                    numjumps = np.around(fitresultdelay[1]/(2*np.pi))
-                    A = np.reshape(freq, (-1,1)) # no b
-                    phase_diff -= numjumps * 2 * np.pi
-                    fitresultdelay = np.linalg.lstsq(A, phase_diff.T)[0]
-                    fitresultdelay = [fitresultdelay[0],0.] # set offset to 0 to keep the rest of the script equal
-
-                # fractional residual
-                residual = np.mean(np.abs( fitresultdelay[0]*freq + fitresultdelay[1] - phase_diff ))
-
-                fit_delays.append(fitresultdelay[0])
-                fit_offset.append(fitresultdelay[1])
-                if maxResidual == 0 or residual < maxResidual:
-                    fit_weights.append(1.)
-                else:       
-                    # high residual, flag
-                    logging.warning('Bad solution for ant: '+coord['ant']+' (time: '+str(t)+', residual: '+str(residual)+') -> ignoring.')
-                    fit_weights.append(0.)
-
-                # Debug plot
-                doplot = False
-                if doplot and t%100==0 and (coord['ant'] == 'RS310LBA' or coord['ant'] == 'CS301LBA'):
-                    if not 'matplotlib' in sys.modules:
-                        import matplotlib as mpl
-                        mpl.rc('figure.subplot',left=0.05, bottom=0.05, right=0.95, top=0.95,wspace=0.22, hspace=0.22 )
-                        mpl.use("Agg")
-                    import matplotlib.pyplot as plt
-
-                    fig = plt.figure()
-                    fig.subplots_adjust(wspace=0)
-                    ax = fig.add_subplot(111)
-
-                    # plot rm fit
-                    plotdelay = lambda delay, offset, freq: np.mod( delay*freq + offset + np.pi, 2.*np.pi) - np.pi
-                    ax.plot(freq, fitresultdelay[0]*freq + fitresultdelay[1], "-", color='purple')
-
-                    ax.plot(freq, np.mod(phase1 + np.pi, 2.*np.pi) - np.pi, 'ob' )
-                    ax.plot(freq, np.mod(phase2 + np.pi, 2.*np.pi) - np.pi, 'og' )
-                    #ax.plot(freq, np.mod(phase_diff + np.pi, 2.*np.pi) - np.pi, '.', color='purple' )                           
-                    ax.plot(freq, phase_diff, '.', color='purple' )                           
- 
-                    residual = np.mod(plotdelay(fitresultdelay[0], fitresultdelay[1], freq)-phase_diff + np.pi,2.*np.pi)-np.pi
-                    ax.plot(freq, residual, '.', color='yellow')
-    
-                    ax.set_xlabel('freq')
-                    ax.set_ylabel('phase')
-                    #ax.set_ylim(ymin=-np.pi, ymax=np.pi)
-
-                    logging.warning('Save pic: '+str(t)+'_'+coord['ant']+'.png')
-                    plt.savefig(coord['ant']+'_'+str(t)+'.png', bbox_inches='tight')
-                    del fig
-            # end cycle in time
-
-            fit_weights = np.array(fit_weights)
-            fit_delays = np.array(fit_delays)
-            fit_offset = np.array(fit_offset)
-
-            # avg in time
-            if average:
-                fit_delays_bkp = fit_delays[ fit_weights == 0 ]
-                fit_offset_bkp = fit_offset[ fit_weights == 0 ]
-                np.putmask(fit_delays, fit_weights == 0, np.nan)
-                np.putmask(fit_offset, fit_weights == 0, np.nan)
-                fit_delays[:] = np.nanmean(fit_delays)
-                # angle mean
-                fit_offset[:] = np.angle( np.nansum( np.exp(1j*fit_offset) ) / np.count_nonzero(~np.isnan(fit_offset)) )
-
-                if replace:
-                    fit_weights[ fit_weights == 0 ] = 1.
-                    fit_weights[ np.isnan(fit_delays) ] = 0. # all the size was flagged cannot estrapolate value
-                else:
-                    fit_delays[ fit_weights == 0 ] = fit_delays_bkp
-                    fit_offset[ fit_weights == 0 ] = fit_offset_bkp
-
-            logging.debug('%s: average delay: %f ns (offset: %f)' % ( coord['ant'], np.mean(fit_delays)*1e9, np.mean(fit_offset)))
-            for t, time in enumerate(times):
-                #vals[:,:,t] = 0.
-                #vals[coord1,:,t] = fit_delays[t]*np.array(coord['freq'])/2.
-                vals[coord1,:,t] = 0
-                phase = np.mod(fit_delays[t]*coord['freq'] + fit_offset[t] + np.pi, 2.*np.pi) - np.pi
-                vals[coord2,:,t] = -1.*phase#/2.
-                #weights[:,:,t] = 0.
-                weights[coord1,:,t] = fit_weights[t]
-                weights[coord2,:,t] = fit_weights[t]
-
-        # reorder axes back to the original order, needed for setValues
-        vals = reorderAxes( vals, ['pol','freq','time'], [ax for ax in soltab.getAxesNames() if ax in ['pol','freq','time']] )
-        weights = reorderAxes( weights, ['pol','freq','time'], [ax for ax in soltab.getAxesNames() if ax in ['pol','freq','time']] )
-        soltabout.setSelection(**coord)
-        soltabout.setValues( vals )
-        soltabout.setValues( weights, weight=True )
+    # create new table
+    solset = soltab.getSolset()
+    soltabout = solset.makeSoltab(soltype = soltab.getType(), soltabName = soltabOut, axesNames=axesNames, \
+                      axesVals=[soltab.getAxisValues(axisName) for axisName in axesNames], \
+                      vals=vals, weights=weights)
+    soltabout.addHistory('Created by POLALIGN operation from %s.' % soltab.name)
 
     return 0
@@ -23,84 +23,6 @@ def _run_parser(soltab, parser, step):
     return run(soltab, chanWidth, outSoltabName, BadSBList, interpolate, removeTimeAxis,
                autoFlag, nSigma, maxFlaggedFraction, maxStddev, ncpu)
 
-def _savitzky_golay(y, window_size, order, deriv=0, rate=1):
-    """Smooth (and optionally differentiate) data with a Savitzky-Golay filter.
-    The Savitzky-Golay filter removes high frequency noise from data.
-    It has the advantage of preserving the original shape and
-    features of the signal better than other types of filtering
-    approaches, such as moving averages techniques.
-
-    Parameters
-    ----------
-    y : array_like, shape (N,)
-        the values of the time history of the signal.
-    window_size : int
-        the length of the window. Must be an odd integer number.
-    order : int
-        the order of the polynomial used in the filtering.
-        Must be less then `window_size` - 1.
-    deriv: int
-        the order of the derivative to compute (default = 0 means only smoothing)
-
-    Returns
-    -------
-    ys : ndarray, shape (N)
-        the smoothed signal (or it's n-th derivative).
-
-    Notes
-    -----
-    The Savitzky-Golay is a type of low-pass filter, particularly
-    suited for smoothing noisy data. The main idea behind this
-    approach is to make for each point a least-square fit with a
-    polynomial of high order over a odd-sized window centered at
-    the point.
-
-    Examples
-    --------
-    t = np.linspace(-4, 4, 500)
-    y = np.exp( -t**2 ) + np.random.normal(0, 0.05, t.shape)
-    ysg = savitzky_golay(y, window_size=31, order=4)
-    import matplotlib.pyplot as plt
-    plt.plot(t, y, label='Noisy signal')
-    plt.plot(t, np.exp(-t**2), 'k', lw=1.5, label='Original signal')
-    plt.plot(t, ysg, 'r', label='Filtered signal')
-    plt.legend()
-    plt.show()
-
-    References
-    ----------
-    .. [1] A. Savitzky, M. J. E. Golay, Smoothing and Differentiation of
-       Data by Simplified Least Squares Procedures. Analytical
-       Chemistry, 1964, 36 (8), pp 1627-1639.
-    .. [2] Numerical Recipes 3rd Edition: The Art of Scientific Computing
-       W.H. Press, S.A. Teukolsky, W.T. Vetterling, B.P. Flannery
-       Cambridge University Press ISBN-13: 9780521880688
-    """
-    import numpy as np
-    from math import factorial
-
-    try:
-        window_size = np.abs(np.int(window_size))
-        order = np.abs(np.int(order))
-    except ValueError as msg:
-        raise ValueError("window_size and order have to be of type int")
-    if window_size % 2 != 1 or window_size < 1:
-        raise TypeError("window_size size must be a positive odd number")
-    if window_size < order + 2:
-        raise TypeError("window_size is too small for the polynomials order")
-    order_range = range(order+1)
-    half_window = (window_size -1) // 2
-    # precompute coefficients
-    b = np.mat([[k**i for i in order_range] for k in range(-half_window, half_window+1)])
-    m = np.linalg.pinv(b).A[deriv] * rate**deriv * factorial(deriv)
-    # pad the signal at the extremes with
-    # values taken from the signal itself
-    firstvals = y[0] - np.abs( y[1:half_window+1][::-1] - y[0] )
-    lastvals = y[-1] + np.abs(y[-half_window-1:-1][::-1] - y[-1])
-    y = np.concatenate((firstvals, y, lastvals))
-    return np.convolve( m[::-1], y, mode='valid')
-
-
 def _B(x, k, i, t, extrap, invert):
     if k == 0:
         if extrap:
@@ -464,9 +386,10 @@ def run(soltab, chanWidth='', outSoltabName='bandpass', BadSBList = '', interpol
     weights_arraytmp = weights # axes are [time, ant, freq, pol]
     flagged = np.where(amplitude_arraytmp == 1.0)
     weights_arraytmp[flagged] = 0.0
-    nfreqs = len(soltab.freq[:])
-    ntimes = len(soltab.time[:])
-    nants = len(soltab.ant[:])
+    freqs = soltab.freq
+    nfreqs = soltab.getAxisLen('freq')
+    ntimes = soltab.getAxisLen('time')
+    nants = soltab.getAxisLen('ant')
 
     subbandHz = 195.3125e3
     if interpolate:
@@ -490,9 +413,9 @@ def run(soltab, chanWidth='', outSoltabName='bandpass', BadSBList = '', interpol
         else:
             chanWidthHz = chanWidth
         offsetHz = subbandHz / 2.0 - 0.5 * chanWidthHz
-        freqmin = np.min(soltab.freq[:]) + offsetHz # central frequency of first subband
-        freqmax = np.max(soltab.freq[:]) + offsetHz # central frequency of last subband
-        SBgrid = np.floor((soltab.freq[:]-np.min(soltab.freq[:]))/subbandHz)
+        freqmin = np.min(freqs) + offsetHz # central frequency of first subband
+        freqmax = np.max(freqs) + offsetHz # central frequency of last subband
+        SBgrid = np.floor((freqs-np.min(freqs))/subbandHz)
         freqs_new  = np.arange(freqmin, freqmax+100e3, subbandHz)
         amps_array_flagged = np.zeros( (nants, ntimes, len(freqs_new), 2), dtype='float')
         amps_array = np.zeros( (nants, ntimes, len(freqs_new), 2), dtype='float')
@@ -507,7 +430,7 @@ def run(soltab, chanWidth='', outSoltabName='bandpass', BadSBList = '', interpol
         # make a mapping of new frequencies to old ones
         freq_mapping = {}
         for fn in freqs_new:
-            ind = np.where(np.logical_and(soltab.freq < fn+subbandHz/2.0, soltab.freq >= fn-subbandHz/2.0))
+            ind = np.where(np.logical_and(freqs < fn+subbandHz/2.0, freqs >= fn-subbandHz/2.0))
             freq_mapping['{}'.format(fn)] = ind
 
     # remove bad subbands specified by user
@@ -522,7 +445,7 @@ def run(soltab, chanWidth='', outSoltabName='bandpass', BadSBList = '', interpol
             ncpu = multiprocessing.cpu_count()
         mpm = multiprocManager(ncpu, _flag_amplitudes)
         for s in range(nants):
-            mpm.put([soltab.freq[:], amplitude_arraytmp[:, s, :, :], weights_arraytmp[:, s, :, :],
+            mpm.put([freqs, amplitude_arraytmp[:, s, :, :], weights_arraytmp[:, s, :, :],
                      nSigma, maxFlaggedFraction, maxStddev, False, s])
         mpm.wait()
         for (s, w) in mpm.get():
@@ -530,11 +453,12 @@ def run(soltab, chanWidth='', outSoltabName='bandpass', BadSBList = '', interpol
 
     # Now interpolate over flagged values and smooth over frequency and time axes
     if interpolate:
-        for antenna_id in range(len(soltab.ant[:])):
-            for time in range(len(soltab.time[:])):
+        ants = soltab.ant
+        for antenna_id in range(nants):
+            for time in range(ntimes):
                 amp_xx_tmp = np.copy(amplitude_arraytmp[time, antenna_id, :, 0])
                 amp_yy_tmp = np.copy(amplitude_arraytmp[time, antenna_id, :, 1])
-                freq_tmp = soltab.freq[:]
+                freq_tmp = freqs
                 assert len(amp_xx_tmp[:]) == len(freq_tmp[:])
                 mask_xx = np.not_equal(weights_arraytmp[time, antenna_id, :, 0], 0.0)
                 if np.sum(mask_xx)>2:
@@ -553,7 +477,7 @@ def run(soltab, chanWidth='', outSoltabName='bandpass', BadSBList = '', interpol
 
         ampsoutfile = open('calibrator_amplitude_array.txt','w')
         ampsoutfile.write('# Antenna name, Antenna ID, subband, XXamp, YYamp, frequency\n')
-        for antenna_id in range(len(soltab.ant[:])):
+        for antenna_id in range(nants):
             if np.all(weights_arraytmp[:, antenna_id, :, :] == 0.0):
                 weights_array[antenna_id, :, :, :] = 0.0
             else:
@@ -566,14 +490,14 @@ def run(soltab, chanWidth='', outSoltabName='bandpass', BadSBList = '', interpol
                 amp_yy = scipy.ndimage.filters.median_filter(amp_yy, (7,1))
 
                 for i in range(len(freqs_new)):
-                    ampsoutfile.write('%s %s %s %s %s %s\n'%(soltab.ant[antenna_id], antenna_id,
+                    ampsoutfile.write('%s %s %s %s %s %s\n'%(ants[antenna_id], antenna_id,
                                                              i, np.median(amp_xx[:,i], axis=0),
                                                              np.median(amp_yy[:,i], axis=0),
                                                              freqs_new[i]))
 
-                for time in range(len(soltab.time[:])):
-                    amps_array[antenna_id, time, :, 0] = np.copy(_savitzky_golay(amp_xx[time,:], 17, 2))
-                    amps_array[antenna_id, time, :, 1] = np.copy(_savitzky_golay(amp_yy[time,:], 17, 2))
+                # all times at once, along freq
+                amps_array[antenna_id, :, :, 0] = nanSavitzkyGolay(amp_xx, 17, 2)
+                amps_array[antenna_id, :, :, 1] = nanSavitzkyGolay(amp_yy, 17, 2)
 
                 for i in range(len(freqs_new)):
                     amps_array[antenna_id, :, i, 0] = np.median(amps_array[antenna_id, :, i, 0])
@@ -592,7 +516,7 @@ def run(soltab, chanWidth='', outSoltabName='bandpass', BadSBList = '', interpol
     else:
         amps_array = amplitude_arraytmp
         weights_array = weights_arraytmp
-        freqs_new = soltab.freq[:]
+        freqs_new = freqs
 
     # delete existing bandpass soltab if needed and write solutions
     if soltab.name != outSoltabName:
@@ -87,24 +87,19 @@ def _estimate_weights_window(sindx, vals, nmedian, nstddev, type, outQueue):
 
     """
     import numpy as np
-    from scipy.ndimage import generic_filter
 
     pad_width = [(0, 0)] * len(vals.shape)
-    pad_width[-1] = ((nmedian-1)/2, (nmedian-1)/2)
     if type == 'phase' or type == 'rotation':
         # Median smooth and subtract to de-trend
         if nmedian > 0:
-            # Convert to real/imag
+            # Convert to real/imag, both smoothed in one go
             real = np.cos(vals)
-            pad_real = np.pad(real, pad_width, 'constant', constant_values=(np.nan,))
-            med_real = np.nanmedian(_rolling_window_lastaxis(pad_real, nmedian), axis=-1)
+            imag = np.sin(vals)
+            med_real, med_imag = nanRunningMedian(np.array([real, imag]), nmedian, axes=[-1])
             real -= med_real
             real[real < -1.0] = -1.0
             real[real > 1.0] = 1.0
 
-            imag = np.sin(vals)
-            pad_imag = np.pad(imag, pad_width, 'constant', constant_values=(np.nan,))
-            med_imag = np.nanmedian(_rolling_window_lastaxis(pad_imag, nmedian), axis=-1)
             imag -= med_imag
             imag[imag < -1.0] = -1.0
             imag[imag > 1.0] = 1.0
@@ -126,9 +121,7 @@ def _estimate_weights_window(sindx, vals, nmedian, nstddev, type, outQueue):
     else:
         # Median smooth and subtract to de-trend
         if nmedian > 0:
-            pad_vals = np.pad(vals, pad_width, 'constant', constant_values=(np.nan,))
-            med = np.nanmedian(_rolling_window_lastaxis(pad_vals, nmedian), axis=-1)
-            vals -= med
+            vals -= nanRunningMedian(vals, nmedian, axes=[-1])
 
         # Calculate standard deviation in larger window
         pad_width[-1] = ((nstddev-1)/2, (nstddev-1)/2)
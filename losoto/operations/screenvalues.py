@@ -6,6 +6,7 @@
 
 import logging
 from losoto.lib_operations import *
+from losoto.operations.stationscreen import _radec2xy, _kl_evaluate
 
 logging.debug('Loading SCREENVALUES module.')
 
@@ -15,24 +16,31 @@ def _run_parser(soltab, parser, step):
     inSoltab2 = parser.getstr( step, "inSoltab2", None )
     outSoltab = parser.getstr( step, "outSoltab" )
     sourceDict = parser.getstr( step, "sourceDict" )
-    ncpu = parser.getint( step, "ncpu", 0 )
+    ncpu = parser.getint( '_global', "ncpu", 0 )
 
     parser.checkSpelling( step, soltab, ['inSoltab1', 'sourceDict', 'outSoltab', 'inSoltab2'])
     return run(inSoltab1, sourceDict, outSoltab, inSoltab2, ncpu)
 
-def _calculate_tecsp(screen1, screen2, pp, directions, k, sindx, beta_val,
-    r_0, freq1, freq2, midRA, midDec, outQueue):
+def _calculate_tecsp(screen1, screen2, pp, points, k, sindx, beta_val,
+    r_0, freq1, freq2, outQueue):
     """
     Calculates TEC and scalar phase from screens at two frequencies
 
     screen1: array
-        Array of screen values at the piercepoints for freq1
+        Array of screen values at the piercepoints for freq1 (N_piercepoints,
+        len(k))
     screen2: array
-        Array of screen values at the piercepoints for freq2
+        Array of screen values at the piercepoints for freq2 (N_piercepoints,
+        len(k))
     pp: array
         Array of piercepoint locations
-    directions: array
-        Array of RA, Dec in degrees for which phases are desired
+    points: array
+        Array of (x, y, 0) locations of the directions for which phases are
+        desired
+    k: array
+        Time indices
+    sindx: int
+        Station index
     r_0: float
         Scale size of phase fluctuations
     beta_val: float
@@ -42,75 +50,79 @@ def _calculate_tecsp(screen1, screen2, pp, directions, k, sindx, beta_val,
         Frequency of screen1 in Hz
     freq2: float
         Frequency of screen2 in Hz
-    midRA : float
-        RA for WCS reference in degrees
-    midDec : float
-        Dec for WCS reference in degrees
 
     """
     import numpy as np
-    from losoto.operations.phasescreen import radec2xy
 
-    # Convert direction (RA, Dec) to (x, y)
-    x, y = radec2xy(directions[0], directions[1], midRA, midDec)
-
-    # Calculate phases at freq1 and freq2
-    phase1 = np.zeros(len(x))
-    phase2 = np.zeros(len(x))
-    for i, (xi, yi) in enumerate(zip(x, y)):
-        p = np.array([xi, yi, 0.0])
-        d2 = np.sum(np.square(pp - p), axis=1)
-        c = -(d2 / ( r_0**2 ))**(beta_val / 2.0) / 2.0
-        phase1[i] = np.dot(c, screen1)
-        phase2[i] = np.dot(c, screen2)
+    # Calculate phases at freq1 and freq2 for all directions and times
+    phase1 = _kl_evaluate(pp, screen1, points, r_0, beta_val)
+    phase2 = _kl_evaluate(pp, screen2, points, r_0, beta_val)
 
     # Calculate TEC and scalarphase from phase1 and phase2
     tec = normalize_phase(phase1 - phase2) / (1.0/freq1 - 1.0/freq2) / (-8.4479745e9)
     scalarphase = normalize_phase((freq1*phase1 - freq2*phase2) / (freq1 - freq2))
 
-    outQueue.put([k, tec, scalarphase])
+    outQueue.put([k, sindx, tec, scalarphase])
 
 
-def _calculate_val(screen, pp, directions, k, sindx, beta_val, r_0, midRA,
-    midDec, outQueue):
+def _calculate_val(screen, pp, points, k, sindx, beta_val, r_0, outQueue):
     """
     Calculates values from screen
 
     screen: array
-        Array of screen values at the piercepoints
+        Array of screen values at the piercepoints (N_piercepoints, len(k),
+        ...)
     pp: array
         Array of piercepoint locations
-    directions: array
-        Array of RA, Dec in degrees for which phases are desired
+    points: array
+        Array of (x, y, 0) locations of the directions for which values are
+        desired
+    k: array
+        Time indices
+    sindx: int
+        Station index
     r_0: float
         Scale size of phase fluctuations
     beta_val: float
         Power-law index for phase structure function (5/3 =>
         pure Kolmogorov turbulence)
+
+    """
+    # Calculate values for all directions, times, freqs and pols at once
+    values = _kl_evaluate(pp, screen, points, r_0, beta_val)
+
+    outQueue.put([k, sindx, values])
+
+
+def _directions_to_points(directions, midRA, midDec):
+    """
+    Returns the screen locations of the given directions
+
+    Parameters
+    ----------
+    directions: list of arrays
+        List of (RA, Dec) arrays in radians
     midRA : float
         RA for WCS reference in degrees
     midDec : float
         Dec for WCS reference in degrees
 
+    Returns
+    -------
+    points: array
+        Array of (x, y, 0) locations
+
     """
     import numpy as np
-    from losoto.operations.phasescreen import radec2xy
-
-    # Convert direction (RA, Dec) to (x, y)
-    x, y = radec2xy(directions[0], directions[1], midRA, midDec)
 
-    # Calculate values
-    N_dirs = len(x)
-    N_freqs = screen.shape[1]
-    values = np.zeros((N_dirs, N_freqs))
-    for i, (xi, yi) in enumerate(zip(x, y)):
-        p = np.array([xi, yi, 0.0])
-        d2 = np.sum(np.square(pp - p), axis=1)
-        c = -(d2 / ( r_0**2 ))**(beta_val / 2.0) / 2.0
-        for findx in range(N_freqs):
-            values[i, findx] = np.dot(c, screen[:, findx])
+    ra = [r * 180.0 / np.pi for r, d in directions]
+    dec = [d * 180.0 / np.pi for r, d in directions]
+    x, y = _radec2xy(ra, dec, midRA, midDec)
+    points = np.zeros((len(ra), 3))
+    points[:, 0] = x
+    points[:, 1] = y
 
-    outQueue.put([k, values])
+    return points
 
 
 def _screens_to_tecsp(pp, screen1, screen2, directions, station_positions,
@@ -148,39 +160,28 @@ def _screens_to_tecsp(pp, screen1, screen2, directions, station_positions,
 
     """
     import numpy as np
-    try:
-        import progressbar
-    except ImportError:
-        import losoto.progressbar as progressbar
 
-    ra = [r for r, d in directions]
-    dec = [d for r, d in directions]
-    directions = np.array([ra, dec]) * 180.0 / np.pi
+    points = _directions_to_points(directions, midRA, midDec)
 
-    N_sources = len(ra)
+    N_sources = len(points)
     N_times = screen1.shape[1]
     N_freqs = 1
     N_stations = screen1.shape[2]
     tec = np.zeros((N_times, N_stations, N_sources, N_freqs))
     scalarphase = np.zeros((N_times, N_stations, N_sources, N_freqs))
 
+    # one pool for all the stations, each job gets a chunk of time slots
     logging.info('Calculating phases...')
-    N_total = N_stations
-    pbar = progressbar.ProgressBar(maxval=N_total).start()
-    ipbar = 0
+    mpm = multiprocManager(ncpu, _calculate_tecsp)
+    N_chunks = min(N_times, max(1, mpm.procs // N_stations))
     for sindx in range(N_stations):
-        mpm = multiprocManager(ncpu, _calculate_tecsp)
-        for tindx in range(N_times):
+        for tindx in np.array_split(np.arange(N_times), N_chunks):
             mpm.put([screen1[:, tindx, sindx], screen2[:, tindx, sindx],
-                pp, directions, tindx, sindx, beta_val, r_0,
-                freq1, freq2, midRA, midDec])
-        mpm.wait()
-        for (tindx, t, s) in mpm.get():
-            tec[tindx, sindx, :, 0] = t
-            scalarphase[tindx, sindx, :, 0] = s
-        pbar.update(ipbar)
-        ipbar += 1
-    pbar.finish()
+                pp, points, tindx, sindx, beta_val, r_0, freq1, freq2])
+    mpm.wait()
+    for (tindx, sindx, t, s) in mpm.get():
+        tec[tindx, sindx, :, 0] = t.T
+        scalarphase[tindx, sindx, :, 0] = s.T
 
     return (tec, scalarphase)
 
@@ -215,49 +216,31 @@ def _screen_to_val(pp, screen, directions, station_positions, beta_val, r_0,
 
     """
     import numpy as np
-    try:
-        import progressbar
-    except ImportError:
-        import losoto.progressbar as progressbar
 
-    ra = [r for r, d in directions]
-    dec = [d for r, d in directions]
-    directions = np.array([ra, dec]) * 180.0 / np.pi
+    points = _directions_to_points(directions, midRA, midDec)
 
-    N_sources = len(ra)
+    N_sources = len(points)
     N_times = screen.shape[1]
     N_freqs = screen.shape[2]
     N_stations = screen.shape[3]
     if len(screen.shape) == 4:
-        N_pols = 1
         values = np.zeros((N_times, N_stations, N_sources, N_freqs))
     else:
         N_pols = screen.shape[4]
         values = np.zeros((N_times, N_stations, N_sources, N_freqs, N_pols))
 
+    # one pool for all the stations, each job gets a chunk of time slots with
+    # all freqs and pols
     logging.info('Calculating values...')
-    N_total = N_pols * N_stations
-    pbar = progressbar.ProgressBar(maxval=N_total).start()
-    ipbar = 0
+    mpm = multiprocManager(ncpu, _calculate_val)
+    N_chunks = min(N_times, max(1, mpm.procs // N_stations))
     for sindx in range(N_stations):
-        for pindx in range(N_pols):
-            mpm = multiprocManager(ncpu, _calculate_val)
-            for tindx in range(N_times):
-                if len(screen.shape) == 4:
-                    inscreen = screen[:, tindx, :, sindx]
-                else:
-                    inscreen = screen[:, tindx, :, sindx, pindx]
-                mpm.put([inscreen, pp, directions, tindx, sindx,
-                    beta_val, r_0, midRA, midDec])
-            mpm.wait()
-            for (tindx, val) in mpm.get():
-                if len(screen.shape) == 4:
-                    values[tindx, sindx, :, :] = val
-                else:
-                    values[tindx, sindx, :, :, pindx] = val
-            pbar.update(ipbar)
-            ipbar += 1
-    pbar.finish()
+        inscreen = screen[:, :, :, sindx] # order is now [dir, time, freq(, pol)]
+        for tindx in np.array_split(np.arange(N_times), N_chunks):
+            mpm.put([inscreen[:, tindx], pp, points, tindx, sindx, beta_val, r_0])
+    mpm.wait()
+    for (tindx, sindx, val) in mpm.get():
+        values[tindx, sindx] = val.swapaxes(0, 1)
 
     return values
 
@@ -21,6 +21,7 @@ def _run_parser(soltab, parser, step):
     scale_dist = parser.getfloat( step, "scaleDist", 25000.0 )
     min_order = parser.getint( step, "MinOrder", 5 )
     adjust_order = parser.getbool( step, "AdjustOrder", True )
+    ncpu = parser.getint( '_global', 'ncpu', 0 )
 
     parser.checkSpelling( step, soltab, ['outSoltab', 'order', 'beta', 'niter', 'nsigma',\
         'refAnt', 'scale_order', 'scale_dist', 'min_order', 'adjust_order'])
@@ -28,10 +29,15 @@ def _run_parser(soltab, parser, step):
         refAnt, scale_order, scale_dist, min_order, adjust_order)
 
 
+_ppCache = {}
+_ppCacheSize = 4 # max number of cached pierce-point sets
+
 def _calculate_piercepoints(station_positions, source_positions):
     """
     Returns array of piercepoint locations
 
+    The results are cached, keyed by the input positions
+
     Parameters
     ----------
     station_positions : array
@@ -49,18 +55,18 @@ def _calculate_piercepoints(station_positions, source_positions):
         Reference Dec for WCS system (deg)
 
     """
-    import casacore.measures
     import numpy as np
-    try:
-        import progressbar
-    except ImportError:
-        import losoto.progressbar as progressbar
+
+    station_positions = np.asarray(station_positions, dtype=float)
+    source_positions = np.asarray(source_positions, dtype=float)
+    key = (station_positions.shape, station_positions.tobytes(),
+        source_positions.shape, source_positions.tobytes())
+    if key in _ppCache:
+        return _ppCache[key]
 
     logging.info('Calculating screen pierce-point locations...')
     N_sources = source_positions.shape[0]
     N_stations = station_positions.shape[0]
-    N_piercepoints = N_stations * N_sources
-    pp = np.zeros((N_piercepoints, 3))
 
     xyz = np.zeros((N_sources, 3))
     ra_deg = source_positions.T[0] * 180.0 / np.pi
@@ -68,13 +74,12 @@ def _calculate_piercepoints(station_positions, source_positions):
     xy, midRA, midDec = _getxy(ra_deg, dec_deg)
     xyz[:, 0] = xy[0]
     xyz[:, 1] = xy[1]
-    pp_idx = 0
-    for i in range(N_sources):
-        for station_position in station_positions:
-            pp[pp_idx, :] = xyz[i]
-            pp_idx += 1
+    pp = np.repeat(xyz, N_stations, axis=0) # order is [source, station]
 
-    return pp, midRA, midDec
+    if len(_ppCache) >= _ppCacheSize:
+        _ppCache.clear()
+    _ppCache[key] = (pp, midRA, midDec)
+    return _ppCache[key]
 
 
 def _get_ant_dist(ant_xyz, ref_xyz):
@@ -185,10 +190,10 @@ def _radec2xy(RA, Dec, refRA=None, refDec=None):
     # Make wcs object to handle transformation from ra and dec to pixel coords.
     w = _makeWCS(refRA, refDec)
 
-    for ra_deg, dec_deg in zip(RA, Dec):
-        ra_dec = np.array([[ra_deg, dec_deg]])
-        x.append(w.wcs_world2pix(ra_dec, 0)[0][0])
-        y.append(w.wcs_world2pix(ra_dec, 0)[0][1])
+    if len(RA) > 0:
+        xy = w.wcs_world2pix(np.array([RA, Dec], dtype=float).T, 0)
+        x = xy[:, 0].tolist()
+        y = xy[:, 1].tolist()
 
     return x, y
 
@@ -227,10 +232,10 @@ def _xy2radec(x, y, refRA=0.0, refDec=0.0):
     # Make wcs object to handle transformation from ra and dec to pixel coords.
     w = _makeWCS(refRA, refDec)
 
-    for xp, yp in zip(x, y):
-        x_y = np.array([[xp, yp]])
-        RA.append(w.wcs_pix2world(x_y, 0)[0][0])
-        Dec.append(w.wcs_pix2world(x_y, 0)[0][1])
+    if len(x) > 0:
+        radec = w.wcs_pix2world(np.array([x, y], dtype=float).T, 0)
+        RA = radec[:, 0].tolist()
+        Dec = radec[:, 1].tolist()
 
     return RA, Dec
 
@@ -288,7 +293,7 @@ def _flag_outliers(weights, residual, nsigma, screen_type):
 
     """
     import numpy as np
-    from losoto.operations.reweight import nancircstd
+    from losoto.operations.reweight import _nancircstd as nancircstd
 
     # Find stddev of the screen
     stddev = np.zeros(weights.shape)
@@ -349,9 +354,147 @@ def _circ_chi2(samples, weights):
     return var * sumw
 
 
-def _calculate_svd(pp, r_0, beta, N_piercepoints):
+def _kl_decomposition(D2, r_0, beta, rcond=1e-3):
+    """
+    Returns the covariance matrix of the pierce points and its symmetric
+    eigendecomposition
+
+    Parameters
+    ----------
+    D2: array
+        Array of squared distances between piercepoints
+    r_0: float
+        Scale size of phase fluctuations (m)
+    beta: float
+        Power-law index for phase structure function
+    rcond: float
+        Cutoff for small eigenvalues, relative to the largest one (as in pinv)
+
+    Returns
+    -------
+    C: array
+        Covariance matrix
+    invS: array
+        Inverse of the eigenvalues of C (0 for eigenvalues below the cutoff),
+        sorted by decreasing absolute eigenvalue
+    U: array
+        Eigenvectors of C, in the same order. Since C is symmetric, the
+        first vectors are the Karhunen-Lo`eve base vectors and the
+        pseudo-inverse of C is U.diag(invS).U^T
+
+    """
+    import numpy as np
+
+    C = -(D2 / r_0**2)**(beta / 2.0) / 2.0
+    S, U = np.linalg.eigh(C)
+    # eigenvalues with the same absolute value (e.g. +/-c with 2 pierce points)
+    # are sorted deterministically: the positive one first
+    absS = np.round(np.abs(S) / max(np.max(np.abs(S)), 1e-300), 12)
+    order = np.lexsort((-S, -absS))
+    S = S[order]
+    U = U[:, order]
+    invS = np.zeros(len(S))
+    large = np.abs(S) > rcond * np.abs(S[0])
+    invS[large] = 1.0 / S[large]
+
+    return C, invS, U
+
+
+def _kl_fit(invS, U, rr, weights, order, rcond=1e-3):
+    """
+    Fits the first KL base vectors to several time slots that share the
+    same decomposition
+
+    Parameters
+    ----------
+    invS: array
+        Inverse eigenvalues from _kl_decomposition()
+    U: array
+        Eigenvectors from _kl_decomposition()
+    rr: array
+        Array of values to fit screen to (N_piercepoints, N_times)
+    weights: array
+        Array of weights (N_piercepoints, N_times)
+    order: int
+        Order of screen (i.e., number of KL base vectors to keep)
+    rcond: float
+        Cutoff for small singular values of the weighted normal matrix
+
+    Returns
+    -------
+    fit: array
+        Array of white screen values (N_piercepoints, N_times), i.e. the
+        screen at the pierce points is C.fit
+
+    """
+    import numpy as np
+
+    if order == 0:
+        return np.zeros(rr.shape)
+    U = U[:, :order]
+    Uw = U[:, :, np.newaxis] * weights[:, np.newaxis, :]
+    M = np.einsum('ikt,il->tkl', Uw, U)
+    rr1 = np.einsum('ikt,it->tk', Uw, rr)
+
+    # pseudo-inverse of all the (symmetric) normal matrices at once
+    S, V = np.linalg.eigh(M)
+    large = np.abs(S) > rcond * np.max(np.abs(S), axis=1)[:, np.newaxis]
+    invM = np.zeros(S.shape)
+    invM[large] = 1.0 / S[large]
+    coeff = np.einsum('tkl,tl,tml,tm->tk', V, invM, V, rr1)
+
+    return np.dot(U * invS[:order], coeff.T)
+
+
+def _kl_evaluate(pp, fit_white, points, r_0, beta, chunkSize=2**22):
     """
-    Returns result (U) of svd for K-L vectors
+    Evaluates screens at arbitrary points from their white fit values
+
+    Parameters
+    ----------
+    pp : array
+        Array of piercepoint locations (N_piercepoints, 3)
+    fit_white : array
+        Array of white screen values (N_piercepoints, ...), i.e. the screen at
+        the pierce points is C.fit_white
+    points : array
+        Array of locations where the screens are evaluated (N_points, 3)
+    r_0: float
+        Scale size of fluctuations (m)
+    beta: float
+        Power-law index for structure function
+    chunkSize : int
+        Maximum number of point-piercepoint distances computed at once
+
+    Returns
+    -------
+    vals : array
+        Array of screen values (N_points, ...)
+
+    """
+    import numpy as np
+
+    N_piercepoints = pp.shape[0]
+    N_points = points.shape[0]
+    f = fit_white.reshape((N_piercepoints, -1))
+    vals = np.zeros((N_points, f.shape[1]))
+    step = max(1, chunkSize // max(1, N_piercepoints))
+    for i in range(0, N_points, step):
+        d2 = np.sum(np.square(pp[np.newaxis, :, :] - points[i:i+step, np.newaxis, :]), axis=2)
+        c = -(d2 / ( r_0**2 ))**(beta / 2.0) / 2.0
+        vals[i:i+step] = np.dot(c, f)
+
+    return vals.reshape((N_points,) + fit_white.shape[1:])
+
+
+_klCache = {}
+_klCacheSize = 1024 # max number of cached decompositions
+
+def _calculate_kl(pp, r_0, beta):
+    """
+    Returns the KL decomposition of the covariance of the given piercepoints.
+    The result is cached, as the same (unflagged) piercepoints recur for all
+    stations, frequencies, polarizations and time slots
 
     Parameters
     ----------
@@ -362,62 +505,57 @@ def _calculate_svd(pp, r_0, beta, N_piercepoints):
     beta: float
         Power-law index for amp structure function (5/3 => pure Kolmogorov
         turbulence)
-    N_piercepoints : int
-        Number of piercepoints
 
     Returns
     -------
     C : array
         C matrix
-    pinvC : array
-        Inv(C) matrix
+    invS : array
+        Inverse eigenvalues of C
     U : array
-        Unitary matrix
+        Eigenvectors of C
 
     """
     import numpy as np
-    from pylab import kron, concatenate, pinv, norm, newaxis, find, amin, svd, eye
 
-    D = np.resize(pp, (N_piercepoints, N_piercepoints, 3))
-    D = np.transpose(D, (1, 0, 2)) - D
-    D2 = np.sum(D**2, axis=2)
-    C = -(D2 / r_0**2)**(beta / 2.0) / 2.0
-    pinvC = pinv(C, rcond=1e-3)
-    U, S, V = svd(C)
+    key = (pp.shape, pp.tobytes(), r_0, beta)
+    if key not in _klCache:
+        D = pp[:, np.newaxis, :] - pp[np.newaxis, :, :]
+        D2 = np.sum(D**2, axis=2)
+        if len(_klCache) >= _klCacheSize:
+            _klCache.clear()
+        _klCache[key] = _kl_decomposition(D2, r_0, beta)
+    return _klCache[key]
 
-    return C, pinvC, U
 
-
-def _fit_screen(station_names, source_names, full_matrices, pp, rr, weights, order, r_0, beta,
+def _fit_screen(source_names, full_matrices, pp, rr, weights, orders, r_0, beta,
     screen_type):
     """
-    Fits a screen to amplitudes or phases using Karhunen-Lo`eve base vectors
+    Fits screens to amplitudes or phases of several time slots using
+    Karhunen-Lo`eve base vectors
 
     Parameters
     ----------
-    station_names: array
-        Array of station names
     source_names: array
         Array of source names
     full_matrices : list of arrays
-        List of [C, pivC, U] matrices for all piercepoints
+        List of [C, invS, U] matrices for all piercepoints
     pp: array
         Array of piercepoint locations
-    airmass: array
-        Array of airmass values (note: not currently used)
     rr: array
-        Array of amp values to fit screen to
+        Array of amp values to fit screen to (N_sources, N_times)
     weights: array
-        Array of weights
-    order: int
-        Order of screen (i.e., number of KL base vectors to keep)
+        Array of weights (N_sources, N_times)
+    orders: array
+        Order of screen (i.e., number of KL base vectors to keep) for each
+        time slot
     r_0: float
         Scale size of amp fluctuations (m)
     beta: float
         Power-law index for amp structure function (5/3 => pure Kolmogorov
         turbulence)
     screen_type : str
-        Type of screen: 'phase' or 'amplitude'
+        Type of screen: 'phase', 'tec', or 'amplitude'
 
     Returns
     -------
@@ -426,88 +564,200 @@ def _fit_screen(station_names, source_names, full_matrices, pp, rr, weights, ord
 
     """
     import numpy as np
-    from pylab import kron, concatenate, pinv, norm, newaxis, find, amin, svd, eye
-
-    # Identify flagged directions
-    N_sources_all = len(source_names)
-    unflagged = np.where(weights > 0.0)
-    N_sources = len(source_names[unflagged])
-
-    # Initialize arrays
-    N_stations = len(station_names)
-    N_piercepoints = N_sources * N_stations
-    N_piercepoints_all = N_sources_all * N_stations
-    screen_fit_all = np.zeros((N_sources_all, N_stations))
-    pp_all = pp.copy()
-    rr_all = rr.copy()
-    pp = pp_all[unflagged[0], :]
-    w = np.diag(weights[unflagged])
-
-    # Calculate matrices
-    if N_sources == N_sources_all:
-        C, pinvC, U = full_matrices
-    else:
-        # Recalculate for unflagged directions
-        C, pinvC, U = _calculate_svd(pp, r_0, beta, N_piercepoints)
-    invU = pinv(np.dot(np.transpose(U[:, :order]), np.dot(w, U)[:, :order]), rcond=1e-3)
+    from numpy import newaxis
 
-    # Fit screen to unflagged directions
+    N_sources_all, N_times = rr.shape
+    screen_fit_white_all = np.zeros((N_sources_all, N_times))
+    screen_residual_all = np.zeros((N_sources_all, N_times))
     if screen_type == 'phase':
         # Change phase to real/imag
-        rr_real = np.cos(rr[unflagged])
-        rr_imag = np.sin(rr[unflagged])
+        vals = [np.cos(rr), np.sin(rr)]
+    elif screen_type == 'amplitude':
+        # Fit log(amp)
+        vals = [np.log10(rr)]
+    elif screen_type == 'tec':
+        vals = [rr]
 
-        # Calculate real screen
-        rr1 = np.dot(np.transpose(U[:, :order]), np.dot(w, rr_real))
-        real_fit = np.dot(pinvC, np.dot(U[:, :order], np.dot(invU, rr1)))
+    # Time slots with the same flagged directions and order are fit together
+    groups = {}
+    for tindx in range(N_times):
+        key = ((weights[:, tindx] > 0.0).tobytes(), int(orders[tindx]))
+        groups.setdefault(key, []).append(tindx)
 
-        # Calculate imag screen
-        rr1 = np.dot(np.transpose(U[:, :order]), np.dot(w, rr_imag))
-        imag_fit = np.dot(pinvC, np.dot(U[:, :order], np.dot(invU, rr1)))
+    for (pattern, order), tindx in groups.items():
+        unflagged = np.where(weights[:, tindx[0]] > 0.0)[0]
 
-        # Calculate phase screen
-        screen_fit = np.arctan2(np.dot(C, imag_fit), np.dot(C, real_fit))
-        screen_fit_white = np.dot(pinvC, screen_fit)
-    elif screen_type == 'amplitude':
-        # Calculate log(amp) screen
-        rr = rr[unflagged]
-        rr1 = np.dot(np.transpose(U[:, :order]), np.dot(w, np.log10(rr)))
-        amp_fit_log = np.dot(pinvC, np.dot(U[:, :order], np.dot(invU, rr1)))
-
-        # Calculate amp screen
-        screen_fit = 10**(np.dot(C, amp_fit_log))
-        screen_fit_white = np.dot(pinvC, screen_fit)
-    elif screen_type == 'tec':
-        # Calculate tec screen
-        rr = rr[unflagged]
-        rr1 = np.dot(np.transpose(U[:, :order]), np.dot(w, rr))
-        tec_fit = np.dot(pinvC, np.dot(U[:, :order], np.dot(invU, rr1)))
-
-        # Calculate amp screen
-        screen_fit = np.dot(C, tec_fit)
-        screen_fit_white = np.dot(pinvC, screen_fit)
-
-    # Calculate screen in all directions
-    if N_sources != N_sources_all:
-        screen_fit_all[unflagged[0], :] = screen_fit[:, newaxis]
-        flagged = np.where(weights <= 0.0)
-        for findx in flagged[0]:
-            p = pp_all[findx, :]
-            d2 = np.sum(np.square(pp - p), axis=1)
+        # Calculate matrices
+        if len(unflagged) == N_sources_all:
+            C, invS, U = full_matrices
+        else:
+            # Recalculate for unflagged directions
+            C, invS, U = _calculate_kl(pp[unflagged], r_0, beta)
+
+        # Fit screen to unflagged directions
+        w = weights[unflagged][:, tindx]
+        fits = [_kl_fit(invS, U, v[unflagged][:, tindx], w, order) for v in vals]
+        if screen_type == 'phase':
+            screen_fit = np.arctan2(np.dot(C, fits[1]), np.dot(C, fits[0]))
+        elif screen_type == 'amplitude':
+            screen_fit = 10**(np.dot(C, fits[0]))
+        elif screen_type == 'tec':
+            screen_fit = np.dot(C, fits[0])
+        screen_fit_white = np.dot(U, invS[:, newaxis] * np.dot(U.T, screen_fit))
+
+        # Calculate screen in all directions
+        if len(unflagged) != N_sources_all:
+            flagged = np.where(weights[:, tindx[0]] <= 0.0)[0]
+            screen_fit_all = np.zeros((N_sources_all, len(tindx)))
+            screen_fit_all[unflagged] = screen_fit
+            d2 = np.sum(np.square(pp[newaxis, unflagged, :] - pp[flagged, newaxis, :]), axis=2)
             c = -(d2 / ( r_0**2 ))**(beta / 2.0) / 2.0
-            screen_fit_all[findx, :] = np.dot(c, screen_fit_white)
-        C, pinvC, U = full_matrices
-        screen_fit_white_all = np.dot(pinvC, screen_fit_all)
-        screen_residual_all = rr_all - screen_fit_all.reshape(N_piercepoints_all)
-    else:
-        screen_fit_white_all = screen_fit_white
-        screen_residual_all = rr_all - np.dot(C, screen_fit_white)
-    screen_fit_white_all = screen_fit_white_all.reshape((N_sources_all, N_stations))
-    screen_residual_all = screen_residual_all.reshape((N_sources_all, N_stations))
+            screen_fit_all[flagged] = np.dot(c, screen_fit_white)
+            C, invS, U = full_matrices
+            screen_fit_white_all[:, tindx] = np.dot(U, invS[:, newaxis] * np.dot(U.T, screen_fit_all))
+            screen_residual_all[:, tindx] = rr[:, tindx] - screen_fit_all
+        else:
+            screen_fit_white_all[:, tindx] = screen_fit_white
+            screen_residual_all[:, tindx] = rr[:, tindx] - np.dot(C, screen_fit_white)
 
     return (screen_fit_white_all, screen_residual_all)
 
 
+def _fit_station_screens(source_names, pp, rr, weights, station_order, niter, nsigma,
+    adjust_order, r_0, beta, screen_type, index, outQueue):
+    """
+    Fits the screens of one station at one frequency and polarization for all
+    time slots, iteratively flagging outliers and adjusting the order
+
+    Parameters
+    ----------
+    source_names: array
+        Array of source names
+    pp: array
+        Array of piercepoint locations
+    rr: array
+        Array of values to fit screen to (N_sources, N_times)
+    weights: array
+        Array of weights (N_sources, N_times)
+    station_order: int
+        Initial (and minimum) order of the screens
+    niter: int
+        Number of iterations to do when determining weights
+    nsigma: float
+        Number of sigma above which directions are flagged
+    adjust_order : bool
+        If True, adjust the screen order to obtain a reduced chi^2 of approx.
+        unity
+    r_0: float
+        Scale size of amp fluctuations (m)
+    beta: float
+        Power-law index for amp structure function
+    screen_type : str
+        Type of screen: 'phase', 'tec', or 'amplitude'
+    index: tuple
+        Indices (freq, pol, station) returned with the results
+
+    """
+    import numpy as np
+
+    N_sources, N_times = rr.shape
+    screen = np.zeros((N_sources, N_times))
+    residual = np.zeros((N_sources, N_times))
+    screen_order = np.zeros(N_times)
+    screen_order[:] = station_order
+    target_redchi2 = 1.0
+    full_matrices = _calculate_kl(pp, r_0, beta)
+
+    # Iterate:
+    # 1. fit screens
+    # 2. flag nsigma outliers
+    # 3. refit with new weights
+    # 4. repeat for niter
+    station_weights = weights
+    init_station_weights = weights.copy() # preserve initial weights
+    for iterindx in range(niter):
+        unchanged = np.zeros(N_times, dtype=bool)
+        if iterindx > 0:
+            # Flag outliers
+            if screen_type == 'phase' or screen_type == 'tec':
+                # Use residuals
+                screen_diff = residual
+            elif screen_type == 'amplitude':
+                # Use log residuals
+                screen_diff = np.log10(rr) - np.log10(rr - residual)
+            station_weights = _flag_outliers(init_station_weights,
+                    screen_diff, nsigma, screen_type)
+            unchanged = np.all(station_weights == prev_station_weights, axis=0)
+
+        # Fit the screens of all time slots at once, then adjust the order of
+        # each one and refit the ones that need it
+        norderiter = 1
+        if adjust_order:
+            if iterindx > 0:
+                norderiter = 4
+        N_unflagged = np.sum(station_weights > 0.0, axis=0)
+        active = N_unflagged > 0
+        toohigh = active & (screen_order > N_unflagged-1)
+        screen_order[toohigh] = N_unflagged[toohigh]-1
+        hit_upper = np.zeros(N_times, dtype=bool)
+        hit_lower = np.zeros(N_times, dtype=bool)
+        hit_upper2 = np.zeros(N_times, dtype=bool)
+        hit_lower2 = np.zeros(N_times, dtype=bool)
+        sign = np.ones(N_times)
+        prev_redchi2 = np.zeros(N_times)
+        for oindx in range(norderiter):
+            if not adjust_order:
+                # stop fitting if weights did not change
+                active &= ~unchanged
+            # Skip the fit for first iteration, as it is the same as the prev one
+            tindx = np.where(active & ~(unchanged & (oindx == 0)))[0]
+            if len(tindx) > 0:
+                scr, res = _fit_screen(source_names, full_matrices, pp,
+                    rr[:, tindx], station_weights[:, tindx],
+                    screen_order[tindx].astype(int), r_0, beta, screen_type)
+                screen[:, tindx] = scr
+                residual[:, tindx] = res
+
+            active &= ~(hit_lower2 | hit_upper2)
+            if not (adjust_order and iterindx > 0):
+                continue
+
+            for t in np.where(active)[0]:
+                if screen_type == 'phase':
+                    redchi2 =  _circ_chi2(residual[:, t],
+                        station_weights[:, t]) / (N_unflagged[t] - screen_order[t])
+                else:
+                    redchi2 = np.sum(np.square(residual[:, t]) *
+                        station_weights[:, t]) / (N_unflagged[t] - screen_order[t])
+                if oindx > 0:
+                    if redchi2 > 1.0 and prev_redchi2[t] < redchi2:
+                        sign[t] *= -1
+                    if redchi2 < 1.0 and prev_redchi2[t] > redchi2:
+                        sign[t] *= -1
+                prev_redchi2[t] = redchi2
+                order_factor = (N_unflagged[t] - screen_order[t])**0.2
+                target_order = float(screen_order[t]) - sign[t] * order_factor * (target_redchi2 - redchi2)
+                target_order = max(station_order, target_order)
+                target_order = min(int(round(target_order)), N_unflagged[t]-1)
+                if target_order <= 0:
+                    target_order = min(station_order, N_unflagged[t]-1)
+                if target_order == screen_order[t]:# don't fit again if order is the same as last one
+                    active[t] = False
+                    continue
+                if target_order == N_unflagged[t]-1:# check whether we've been here before. If so, break
+                    if hit_upper[t]:
+                        hit_upper2[t] = True
+                    hit_upper[t] = True
+                if target_order == station_order:# check whether we've been here before. If so, break
+                    if hit_lower[t]:
+                        hit_lower2[t] = True
+                    hit_lower[t] = True
+                screen_order[t] = target_order
+        prev_station_weights = station_weights.copy()
+
+    outQueue.put([index, screen, residual, screen_order, station_weights])
+
+
 def run(soltab, outsoltab, order=12, beta=5.0/3.0, ncpu=0, niter=2, nsigma=5.0,
     refAnt=-1, scale_order=True, scale_dist=None, min_order=5, adjust_order=True):
     """
@@ -559,10 +809,6 @@ def run(soltab, outsoltab, order=12, beta=5.0/3.0, ncpu=0, niter=2, nsigma=5.0,
     from numpy import newaxis
     import re
     import os
-    try:
-        import progressbar
-    except ImportError:
-        import losoto.progressbar as progressbar
 
     # Get screen type
     screen_type = soltab.getType()
@@ -648,129 +894,29 @@ def run(soltab, outsoltab, order=12, beta=5.0/3.0, ncpu=0, niter=2, nsigma=5.0,
     residual = np.zeros((N_sources, N_stations, N_times, N_freqs, N_pols))
     screen_order = np.zeros((N_stations, N_times, N_freqs, N_pols))
     r_0 = 100
-    target_redchi2 = 1.0
 
-    # Calculate full piercepoint arrays
-    pp_list = []
-    full_matrices = []
-    for s in range(N_stations):
-        pp_s, midRA, midDec = _calculate_piercepoints(np.array([station_positions[s]]),
-            np.array(source_positions))
-        pp_list.append(pp_s)
-        full_matrices.append(_calculate_svd(pp_s, r_0, beta, N_piercepoints))
-
-    # Fit station screens
-    N_total = N_freqs * N_pols * N_stations * niter * N_times
-    pbar = progressbar.ProgressBar(maxval=N_total).start()
-    ipbar = 0
+    # Calculate full piercepoint array (it is the same for all stations)
+    pp, midRA, midDec = _calculate_piercepoints(np.array([station_positions[0]]),
+        np.array(source_positions))
+
+    # Fit station screens, one process per station, frequency and polarization
+    mpm = multiprocManager(ncpu, _fit_station_screens)
     for freq_ind in range(N_freqs):
         for pol_ind in range(N_pols):
-            r = r_full[:, :, freq_ind, :, pol_ind] # order is now [dir, time, ant]
-            r = r.transpose([0, 2, 1]) # order is now [dir, ant, time]
-            weights = weights_full[:, :, freq_ind, :, pol_ind]
-            weights = weights.transpose([0, 2, 1])
-
-            # Fit screens
             for s, stat in enumerate(station_names):
                 if s == refAnt and (screen_type == 'phase' or screen_type == 'tec'):
                     # skip reference station (phase- or tec-type only)
                     continue
-                screen_order[s, :, freq_ind, pol_ind] = station_order[s]
-                rr = np.reshape(r[:, s, :], [N_piercepoints, N_times])
-                pp = pp_list[s]
-
-                # Iterate:
-                # 1. fit screens
-                # 2. flag nsigma outliers
-                # 3. refit with new weights
-                # 4. repeat for niter
-                station_weights = weights[:, s, :]
-                init_station_weights = weights[:, s, :].copy() # preserve initial weights
-                for iterindx in range(niter):
-                    if iterindx > 0:
-                        # Flag outliers
-                        if screen_type == 'phase' or screen_type == 'tec':
-                            # Use residuals
-                            screen_diff = residual[:, s, :, freq_ind, pol_ind]
-                        elif screen_type == 'amplitude':
-                            # Use log residuals
-                            screen_diff = np.log10(rr) - np.log10(rr -
-                                residual[:, s, :, freq_ind, pol_ind])
-                        station_weights = _flag_outliers(init_station_weights,
-                                screen_diff, nsigma, screen_type)
-
-                    # Fit the screens
-                    norderiter = 1
-                    if adjust_order:
-                        if iterindx > 0:
-                            norderiter = 4
-                    for tindx, t in enumerate(times):
-                        N_unflagged = np.where(station_weights[:, tindx] > 0.0)[0].size
-                        if N_unflagged == 0:
-                            continue
-                        if screen_order[s, tindx, freq_ind, pol_ind] > N_unflagged-1:
-                            screen_order[s, tindx, freq_ind, pol_ind] = N_unflagged-1
-                        hit_upper = False
-                        hit_lower = False
-                        hit_upper2 = False
-                        hit_lower2 = False
-                        sign = 1.0
-                        for oindx in range(norderiter):
-                            skip_fit = False
-                            if iterindx > 0:
-                                if np.all(station_weights[:, tindx] == prev_station_weights[:, tindx]):
-                                    if not adjust_order:
-                                        # stop fitting if weights did not change
-                                        break
-                                    elif oindx == 0:
-                                        # Skip the fit for first iteration, as it is the same as the prev one
-                                        skip_fit = True
-                            if not np.all(station_weights[:, tindx] == 0.0) and not skip_fit:
-                                scr, res = _fit_screen([stat], source_names, full_matrices[s],
-                                    pp[:, :], rr[:, tindx], station_weights[:, tindx],
-                                    int(screen_order[s, tindx, freq_ind, pol_ind]), r_0, beta, screen_type)
-                                screen[:, s, tindx, freq_ind, pol_ind] = scr[:, 0]
-                                residual[:, s, tindx, freq_ind, pol_ind] = res[:, 0]
-
-                            if hit_lower2 or hit_upper2:
-                                break
-
-                            if adjust_order and iterindx > 0:
-                                if screen_type == 'phase':
-                                    redchi2 =  _circ_chi2(residual[:, s, tindx, freq_ind, pol_ind],
-                                        station_weights[:, tindx]) / (N_unflagged - screen_order[s, tindx, freq_ind, pol_ind])
-                                else:
-                                    redchi2 = np.sum(np.square(residual[:, s, tindx, freq_ind, pol_ind]) *
-                                        station_weights[:, tindx]) / (N_unflagged - screen_order[s, tindx, freq_ind, pol_ind])
-                                if oindx > 0:
-                                    if redchi2 > 1.0 and prev_redchi2 < redchi2:
-                                        sign *= -1
-                                    if redchi2 < 1.0 and prev_redchi2 > redchi2:
-                                        sign *= -1
-                                prev_redchi2 = redchi2
-                                order_factor = (N_unflagged - screen_order[s, tindx, freq_ind, pol_ind])**0.2
-                                target_order = float(screen_order[s, tindx, freq_ind, pol_ind]) - sign * order_factor * (target_redchi2 - redchi2)
-                                target_order = max(station_order[s], target_order)
-                                target_order = min(int(round(target_order)), N_unflagged-1)
-                                if target_order <= 0:
-                                    target_order = min(station_order[s], N_unflagged-1)
-                                if target_order == screen_order[s, tindx, freq_ind, pol_ind]:# don't fit again if order is the same as last one
-                                    break
-                                if target_order == N_unflagged-1:# check whether we've been here before. If so, break
-                                    if hit_upper:
-                                        hit_upper2 = True
-                                    hit_upper = True
-                                if target_order == station_order[s]:# check whether we've been here before. If so, break
-                                    if hit_lower:
-                                        hit_lower2 = True
-                                    hit_lower = True
-                                screen_order[s, tindx, freq_ind, pol_ind] = target_order
-                        pbar.update(ipbar)
-                        ipbar += 1
-                    prev_station_weights = station_weights.copy()
-                weights[:, s, :] = station_weights
-            weights_full[:, :, freq_ind, :, pol_ind] = weights.transpose([0, 2, 1]) # order is now [dir, time, ant]
-    pbar.finish()
+                rr = r_full[:, :, freq_ind, s, pol_ind] # order is now [dir, time]
+                station_weights = weights_full[:, :, freq_ind, s, pol_ind]
+                mpm.put([source_names, pp, rr, station_weights, station_order[s],
+                    niter, nsigma, adjust_order, r_0, beta, screen_type, (freq_ind, pol_ind, s)])
+    mpm.wait()
+    for (freq_ind, pol_ind, s), scr, res, scr_order, station_weights in mpm.get():
+        screen[:, s, :, freq_ind, pol_ind] = scr
+        residual[:, s, :, freq_ind, pol_ind] = res
+        screen_order[s, :, freq_ind, pol_ind] = scr_order
+        weights_full[:, :, freq_ind, s, pol_ind] = station_weights
 
     # Write the results to the output solset
     dirs_out = source_names
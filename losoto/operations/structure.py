@@ -11,12 +11,13 @@ def _run_parser(soltab, parser, step):
     refAnt = parser.getstr( step, 'refAnt', '')
     plotName = parser.getstr( step, 'plotName', '' )
     ndiv = parser.getint( step, 'ndiv', 1 )
+    ncpu = parser.getint( '_global', 'ncpu', 0 )
 
     parser.checkSpelling( step, soltab, ['doUnwrap', 'refAnt', 'plotName', 'ndiv'])
-    return run(soltab, doUnwrap, refAnt, plotName, ndiv)
+    return run(soltab, doUnwrap, refAnt, plotName, ndiv, ncpu)
 
 
-def run( soltab, doUnwrap=False, refAnt='', plotName='', ndiv=1 ):
+def run( soltab, doUnwrap=False, refAnt='', plotName='', ndiv=1, ncpu=0 ):
     """
     Find the structure function from phase solutions of core stations.
 
@@ -33,6 +34,8 @@ def run( soltab, doUnwrap=False, refAnt='', plotName='', ndiv=1 ):
     ndiv : int, optional
         
 
+    ncpu : int, optional
+        Number of cpu to use for unwrapping, by default all available.
     """
     import numpy as np
     from losoto.lib_unwrap import unwrap, unwrap_2d
@@ -75,14 +78,14 @@ def run( soltab, doUnwrap=False, refAnt='', plotName='', ndiv=1 ):
 
         # unwrap
         if doUnwrap:
-            # remove mean to facilitate unwrapping
-            for a, ant in enumerate(coord['ant']):
-                if not (flags[a,:,:] == True).all() and ant != refAnt:
-                    logging.debug('Unwrapping: '+ant)
-                    mean = np.angle( np.nanmean( np.exp(1j*vals[a].flatten()) ))
-                    vals[a] -= mean
-                    vals[a] = np.mod(vals[a]+np.pi, 2*np.pi) - np.pi
-                    vals[a,:,:] = unwrap_2d(vals[a,:,:], flags[a,:,:], coord['freq'], coord['time'])
+            toUnwrap = np.array([not (flags[a,:,:] == True).all() and ant != refAnt for a, ant in enumerate(coord['ant'])], dtype=bool)
+            if toUnwrap.any():
+                logging.debug('Unwrapping: '+', '.join(np.array(coord['ant'])[toUnwrap]))
+                # remove mean to facilitate unwrapping
+                mean = np.angle( np.nanmean( np.exp(1j*vals[toUnwrap]).reshape(np.sum(toUnwrap),-1), axis=1 ))
+                vals[toUnwrap] = np.mod(vals[toUnwrap]-mean[:,np.newaxis,np.newaxis]+np.pi, 2*np.pi) - np.pi
+                # all antennas share the same freq x time grid: unwrap them in one pass
+                vals[toUnwrap] = unwrap_2d(vals[toUnwrap], flags[toUnwrap], coord['freq'], coord['time'], ncpu=ncpu)
         
         logging.debug('Computing differential values...')
         t1 = np.ma.array( vals, mask=flags ) # mask flagged data
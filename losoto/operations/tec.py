@@ -11,12 +11,88 @@ def _run_parser(soltab, parser, step):
     soltabOut = parser.getstr( step, 'soltabOut', 'tec000' )
     refAnt = parser.getstr( step, 'refAnt', '')
     maxResidual = parser.getfloat( step, 'maxResidual', 1. )
+    ncpu = parser.getint( '_global', 'ncpu', 0 )
 
     parser.checkSpelling( step, soltab, ['soltabOut', 'refAnt', 'maxResidual'])
-    return run(soltab, soltabOut, refAnt, maxResidual)
+    return run(soltab, soltabOut, refAnt, maxResidual, ncpu)
 
 
-def run( soltab, soltabOut='tec000', refAnt='', maxResidual=1. ):
+def _fitTec(vals, weights, freqs, ant, maxResidual, outQueue):
+    """
+    Fit dTEC for all the time slots of an antenna at once.
+
+    Parameters
+    ----------
+    vals : array
+        Phases (pol, freq, time).
+    weights : array
+        Weights (pol, freq, time).
+    freqs : array
+        Frequencies.
+    ant : str
+        Antenna name.
+    maxResidual : float
+        Max average residual in radians before flagging datapoint. If 0: no check.
+    """
+    import numpy as np
+
+    ntimes = vals.shape[-1]
+    fitd = np.zeros(ntimes)
+    fitweights = np.ones(ntimes) # all unflagged to start
+
+    if (weights == 0.).all() == True:
+        logging.warning('Skipping flagged antenna: '+ant)
+        fitweights[:] = 0
+        outQueue.put([ant, fitd, fitweights])
+        return
+
+    # combine pol
+    valscomb = np.angle( np.sum( np.exp(1j*vals), axis=0 ) )
+
+    # flags of each time slot
+    idx = ((weights[0] != 0.) & (weights[1] != 0.)) # (freq, time)
+    nfreq = np.sum(idx, axis=0)
+
+    # the cost of each time slot also includes the previous and following slots (with half weight)
+    # on the channels unflagged in that time slot
+    expvals = np.exp(1j*valscomb)
+    expvals[np.isnan(expvals)] = 0
+    expvals_pre = np.concatenate((expvals[:,:1], expvals[:,:-1]), axis=1)
+    expvals_post = np.concatenate((expvals[:,1:], expvals[:,-1:]), axis=1)
+    Z = idx * (expvals + .5*expvals_pre + .5*expvals_post)
+
+    # grid search on all the time slots at once (coarse grid as the old brute force, then refined)
+    fitd, score = phaseGridSearch(Z, -8.44797245e9/freqs, -0.4, 0.4, n=100)
+
+    with np.errstate(invalid='ignore'):
+        residual = np.abs( (-8.44797245e9*fitd[np.newaxis,:]/freqs[:,np.newaxis]) - valscomb )
+        best_residual = np.nansum(np.where(idx, residual, np.nan), axis=0) / nfreq
+
+    # if more than 1/4 of chans are flagged
+    for t in np.where((len(freqs) - nfreq)/float(len(freqs)) > 1/4.)[0]:
+        logging.debug('High number of filtered out data points for the timeslot %i: %i/%i' % (t, len(freqs) - nfreq[t], len(freqs)) )
+
+    if maxResidual != 0:
+        with np.errstate(invalid='ignore'):
+            bad = ~(best_residual < maxResidual) # NaN (no data) is bad too
+        if bad.any():
+            # high residual, flag
+            maxBestResidual = np.nan if np.isnan(best_residual).all() else np.nanmax(best_residual)
+            logging.warning('Bad solution for ant: '+ant+' (%i time slots, max residual: %s).' % (np.sum(bad), maxBestResidual))
+        fitweights[bad] = 0
+
+    # not enough data
+    nodata = (nfreq < 10)
+    if nodata.any():
+        logging.warning('No valid data found for delay fitting for antenna: '+ant+' at %i time slots' % np.sum(nodata))
+        fitd[nodata] = 0
+        fitweights[nodata] = 0
+
+    logging.debug('%s: average tec: %f TECU' % (ant, np.mean(2*fitd)))
+    outQueue.put([ant, fitd, fitweights])
+
+
+def run( soltab, soltabOut='tec000', refAnt='', maxResidual=1., ncpu=0 ):
     """
     Bruteforce TEC extraction from phase solutions.
 
@@ -31,19 +107,10 @@ def run( soltab, soltabOut='tec000', refAnt='', maxResidual=1. ):
     maxResidual : float, optional
         Max average residual in radians before flagging datapoint, by default 1. If 0: no check.
 
+    ncpu : int, optional
+        Number of cpu to use, by default all available.
     """
     import numpy as np
-    import scipy.optimize
-    from losoto.lib_unwrap import unwrap_2d
-
-    dreal = lambda d, freq, y: -8.44797245e9*d[0]/freq - y
-    dreal2 = lambda d, freq, y: -8.44797245e9*d[0]/freq + d[1] - y
-    #dcomplex = lambda d, freq, y:  np.sum( ( np.cos(-8.44797245e9*d/freq)  - np.cos(y) )**2 ) +  np.sum( ( np.sin(-8.44797245e9*d/freq)  - np.sin(y) )**2 ) 
-    def dcomplex( d, freq, y, y_pre, y_post):  
-        return np.sum( ( np.absolute( np.exp(-1j*8.44797245e9*d/freq)  - np.exp(1j*y) ) )**2 ) + \
-               .5*np.sum( ( np.absolute( np.exp(-1j*8.44797245e9*d/freq)  - np.exp(1j*y_pre) ) )**2 ) + \
-               .5*np.sum( ( np.absolute( np.exp(-1j*8.44797245e9*d/freq)  - np.exp(1j*y_post) ) )**2 )
-    dcomplex2 = lambda d, freq, y:  abs(np.cos(-8.44797245e9*d[0]/freq + d[1])  - np.cos(y)) + abs(np.sin(-8.44797245e9*d[0]/freq + d[1])  - np.sin(y))
 
     logging.info("Find TEC for soltab: "+soltab.name)
 
@@ -59,6 +126,10 @@ def run( soltab, soltabOut='tec000', refAnt='', maxResidual=1. ):
         refAnt = ants[0]
     if refAnt == '': refAnt = ants[0]
 
+    if soltab.getAxisLen('freq') < 10:
+        logging.error('Delay estimation needs at least 10 frequency channels, preferably distributed over a wide range.')
+        return 1
+
     # times and ants needs to be complete or selection is much slower
     times = soltab.getAxisValues('time')
 
@@ -69,132 +140,26 @@ def run( soltab, soltabOut='tec000', refAnt='', maxResidual=1. ):
                       vals=np.zeros(shape=(soltab.getAxisLen('ant'),soltab.getAxisLen('time'))), \
                       weights=np.ones(shape=(soltab.getAxisLen('ant'),soltab.getAxisLen('time'))) )
     soltabout.addHistory('Created by TEC operation from %s.' % soltab.name)
-        
-    for vals, weights, coord, selection in soltab.getValuesIter(returnAxes=['freq','pol','time'], weight=True, reference=refAnt):
-
-        if len(coord['freq']) < 10:
-            logging.error('Delay estimation needs at least 10 frequency channels, preferably distributed over a wide range.')
-            return 1
 
+    # one antenna per process
+    mpm = multiprocManager(ncpu, _fitTec)
+    for vals, weights, coord, selection in soltab.getValuesIter(returnAxes=['freq','pol','time'], weight=True, reference=refAnt):
+        if coord['ant'] == refAnt: continue
         # reorder axes
         vals = reorderAxes( vals, soltab.getAxesNames(), ['pol','freq','time'] )
         weights = reorderAxes( weights, soltab.getAxesNames(), ['pol','freq','time'] )
-
-        fitd = np.zeros(len(times))
-        fitweights = np.ones(len(times)) # all unflagged to start
-        fitdguess = 0.01 # good guess
-
-        if not coord['ant'] == refAnt:
-
-            if (weights == 0.).all() == True:
-                logging.warning('Skipping flagged antenna: '+coord['ant'])
-                fitweights[:] = 0
-            else:
-
-                # combine pol
-                valscomb = np.ma.cos(vals) + 1.j * np.ma.sin(vals)
-                valscomb = np.ma.sum(valscomb, axis=0)
-                valscomb = np.ma.arctan2(np.imag(valscomb), np.real(valscomb))  # np.angle doesnot yet return masked array!!
-                # unwrap 2d timexfreq
-                #flags = np.array((weights[0,...] == 0) | (weights[1,...] == 0), dtype=bool)
-                #valscomb = unwrap_2d(valscomb, flags, coord['freq'], coord['time'])
-
-                for t, time in enumerate(times):
-
-                    # apply flags
-                    idx       = ((weights[0,:,t] != 0.) & (weights[1,:,t] != 0.))
-                    freq      = np.copy(coord['freq'])[idx]
-
-                    if t == 0: phaseComb_pre  = valscomb[idx,0]
-                    else: phaseComb_pre  = valscomb[idx,t-1]
-                    if t == len(times)-1: phaseComb_post  = valscomb[idx,-1]
-                    else: phaseComb_post  = valscomb[idx,t+1]
-                    
-                    phaseComb  = valscomb[idx,t]
-
-                    if len(freq) < 10:
-                        fitweights[t] = 0
-                        logging.warning('No valid data found for delay fitting for antenna: '+coord['ant']+' at timestamp '+str(t))
-                        continue
-        
-                    # if more than 1/4 of chans are flagged
-                    if (len(idx) - len(freq))/float(len(idx)) > 1/4.:
-                        logging.debug('High number of filtered out data points for the timeslot %i: %i/%i' % (t, len(idx) - len(freq), len(idx)) )
-
-                    # least square
-                    #fitresultd2, success = scipy.optimize.leastsq(dreal2, [fitdguess,0.], args=(freq, phaseComb))
-                    #print fitresultd2
-                    #numjumps = np.around(fitresultd2[1]/(2*np.pi))
-                    #print 'best jumps:', numjumps
-                    #phaseComb -= numjumps * 2*np.pi
-                    #fitresultd, success = scipy.optimize.leastsq(dreal, [fitresultd2[0]], args=(freq, phaseComb))
-                    #print fitresultd
-                    #best_residual = np.nanmean(np.abs( (-8.44797245e9*fitresultd[0]/freq) - phaseComb ) )
-
-                    #best_residual = np.inf
-                    #for jump in [-2,-1,0,1,2]:
-                    #    fitresultd, success = scipy.optimize.leastsq(dreal, [fitdguess], args=(freq, phaseComb - jump * 2*np.pi))
-                    #    print fitresultd
-                    #    # fractional residual
-                    #    residual = np.nanmean(np.abs( (-8.44797245e9*fitresultd[0]/freq) - phaseComb - jump * 2*np.pi ) )
-                    #    if residual < best_residual:
-                    #        best_residual = residual
-                    #        fitd[t] = fitresultd[0]
-                    #        best_jump = jump
-
-                    # brute force
-                    fitresultd2 = scipy.optimize.brute(dcomplex, ranges=((-0.4,0.4,),), Ns=100, args=(freq, phaseComb, phaseComb_pre, phaseComb_post))
-                    best_residual = np.nanmean(np.abs( (-8.44797245e9*fitresultd2[0]/freq) - phaseComb ) )
-
-                    fitd[t] = fitresultd2[0]
-                    if maxResidual == 0 or best_residual < maxResidual:
-                        fitweights[t] = 1
-                        fitdguess = fitresultd2[0]
-                    else:       
-                        # high residual, flag
-                        logging.warning('Bad solution for ant: '+coord['ant']+' (time: '+str(t)+', resdiaul: '+str(best_residual)+').')
-                        fitweights[t] = 0
-
-                    # Debug plot
-                    doplot = True
-                    if doplot and (coord['ant'] == 'RS509LBA' or coord['ant'] == 'RS210LBA') and t%50==0:
-                        print("Plotting")
-                        if not 'matplotlib' in sys.modules:
-                            import matplotlib as mpl
-                            mpl.rc('figure.subplot',left=0.05, bottom=0.05, right=0.95, top=0.95,wspace=0.22, hspace=0.22 )
-                            mpl.use("Agg")
-                        import matplotlib.pyplot as plt
-
-                        fig = plt.figure()
-                        fig.subplots_adjust(wspace=0)
-                        ax = fig.add_subplot(111)
-
-                        # plot rm fit
-                        plotd = lambda d, freq: -8.44797245e9*d/freq # notice the factor of 2
-                        ax.plot(freq, plotd(fitresultd2[0], freq[:]), "-", color='purple')
-                        ax.plot(freq, np.mod(plotd(fitresultd2[0], freq[:]) + np.pi, 2.*np.pi) - np.pi, ":", color='purple')
-
-                        ax.plot(freq, np.mod(vals[0,idx,t] + np.pi, 2.*np.pi) - np.pi, '.b' )
-                        ax.plot(freq, np.mod(vals[1,idx,t] + np.pi, 2.*np.pi) - np.pi, '.g' )
-                        #ax.plot(freq, phaseComb + numjumps * 2*np.pi, 'x', color='purple' )                           
-                        ax.plot(freq, phaseComb, 'o', color='purple' )                           
-     
-                        residual = np.mod( plotd(fitd[t], freq[:]) - phaseComb + np.pi, 2.*np.pi) - np.pi
-                        ax.plot(freq, residual, '.', color='orange')
-        
-                        ax.set_xlabel('freq')
-                        ax.set_ylabel('phase')
-                        #ax.set_ylim(ymin=-np.pi, ymax=np.pi)
-    
-                        logging.warning('Save pic: '+str(t)+'_'+coord['ant']+'.png')
-                        plt.savefig(str(t)+'_'+coord['ant']+'.png', bbox_inches='tight')
-                        del fig
-
-                logging.debug('%s: average tec: %f TECU' % (coord['ant'], np.mean(2*fitd)))
-
-        # reorder axes back to the original order, needed for setValues
-        soltabout.setSelection(ant=coord['ant'])
-        soltabout.setValues( fitd )
-        soltabout.setValues( fitweights, weight=True )
+        mpm.put([vals, weights, np.array(coord['freq']), coord['ant'], maxResidual])
+    mpm.wait()
+
+    # the reference antenna stays at 0
+    fitd = np.zeros((len(ants), len(times)))
+    fitweights = np.ones((len(ants), len(times)))
+    antIdx = dict([(ant, i) for i, ant in enumerate(soltabout.getAxisValues('ant'))])
+    for ant, d, w in mpm.get():
+        fitd[antIdx[ant]] = d
+        fitweights[antIdx[ant]] = w
+
+    soltabout.setValues( fitd )
+    soltabout.setValues( fitweights, weight=True )
 
     return 0
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Run losoto parsets from python on already open h5parms
+
+import gc
+import logging
+from losoto.lib_losoto import LosotoParser, getStepSoltabs, cacheSteps
+import losoto.operations as operations
+
+# cached operations which always write back their cache with a flush()
+# (e.g. PLOT is cached but may modify its copy without flushing)
+flushSteps = ['clip','flag','norm','smooth']
+
+
+def getParser(parset):
+    """
+    Return a parser for a parset given in any of the supported forms.
+
+    Parameters
+    ----------
+    parset : str, LosotoParser or list of dict
+        A parset filename, an already created parser or a list of steps.
+        Each step is a dict of options, e.g.:
+        {'name':'clip', 'operation':'CLIP', 'axesToClip':['time','freq']}
+        If 'name' is missing the step is called stepN. A dict with
+        name '_global' sets the global options.
+
+    Returns
+    -------
+    LosotoParser obj
+        The parser.
+    """
+    if isinstance(parset, LosotoParser):
+        return parset
+    elif isinstance(parset, str):
+        return LosotoParser(parset)
+
+    def toStr(v):
+        if isinstance(v, (list, tuple)):
+            return '['+','.join([str(x) for x in v])+']'
+        return str(v)
+
+    globalText = ''
+    stepsText = ''
+    for i, step in enumerate(parset):
+        name = step.get('name', 'step%i' % i)
+        text = ''.join(['%s = %s\n' % (k, toStr(v)) for k, v in step.items() if k != 'name'])
+        if name == '_global':
+            globalText += text
+        else:
+            stepsText += '\n[%s]\n' % name + text
+
+    return LosotoParser(parsetText=globalText+stepsText)
+
+
+class Pipeline(object):
+    """
+    Run parsets against an open h5parm keeping operations modules and
+    cached soltab data alive between steps and between calls.
+
+    Parameters
+    ----------
+    H : h5parm obj
+        An h5parm opened with readonly=False.
+
+    Note
+    ----
+    If the h5parm is modified outside the pipeline call clearCache().
+    """
+
+    def __init__(self, H):
+        self.H = H
+        self.cache = {} # {'solset/soltab':(val, weight)}
+
+
+    def clearCache(self):
+        """
+        Drop all cached soltab data.
+        """
+        self.cache = {}
+
+
+    def runStep(self, parser, step):
+        """
+        Run a single step of a parset.
+
+        Parameters
+        ----------
+        parser : LosotoParser obj
+            The parset.
+        step : str
+            Name of the step.
+
+        Returns
+        -------
+        dict
+            {'step':step name, 'operation':operation name, 'soltabs':[solset/soltab addresses],
+            'returncode':0 if everything went fine, 'time':wall time (s), 'cputime':cpu time (s)}
+        """
+        op = parser.getstr(step,'Operation')
+        result = {'step':step, 'operation':op, 'soltabs':[], 'returncode':1, 'time':0., 'cputime':0.}
+        if not op in operations.ops:
+            logging.error('Unkown operation: '+op)
+            return result
+        opModule = operations.getOperation(op)
+
+        returncode = 0
+        with operations.timer(logging, step, op) as t:
+            # global+local selection on axes are applied by this function
+            soltabs = getStepSoltabs(parser, step, self.H, self.cache)
+            for soltab in soltabs:
+                returncode += opModule._run_parser( soltab, parser, step )
+            if returncode != 0:
+               logging.error("Step \'" + step + "\' incomplete. Try to continue anyway.")
+            else:
+               logging.info("Step \'" + step + "\' completed successfully.")
+
+        # keep data that are known to be equal to what is on disk,
+        # other operations may have written anywhere in the file
+        if op.lower() in flushSteps and returncode == 0:
+            for soltab in soltabs:
+                self.cache[soltab.getAddress()] = (soltab.cacheVal, soltab.cacheWeight)
+        elif op.lower() not in cacheSteps or returncode != 0:
+            self.clearCache()
+
+        result.update({'soltabs':[soltab.getAddress() for soltab in soltabs], 'returncode':returncode,
+                       'time':t.elapsed, 'cputime':t.elapsedcpu})
+        del soltabs
+        gc.collect()
+
+        return result
+
+
+    def run(self, parset):
+        """
+        Run all the steps of a parset.
+
+        Parameters
+        ----------
+        parset : str, LosotoParser or list of dict
+            See getParser().
+
+        Returns
+        -------
+        list
+            A result dict for each step, see runStep().
+        """
+        parser = getParser(parset)
+        results = []
+        for step in parser.sections():
+            if step == '_global': continue # skip global setting
+            results.append( self.runStep(parser, step) )
+
+        return results
+
+
+def run(H, parset):
+    """
+    Convenience function to run a parset on an open h5parm.
+
+    Parameters
+    ----------
+    H : h5parm obj
+        An h5parm opened with readonly=False.
+    parset : str, LosotoParser or list of dict
+        See getParser().
+
+    Returns
+    -------
+    list
+        A result dict for each step, see Pipeline.runStep().
+    """
+    return Pipeline(H).run(parset)
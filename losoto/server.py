@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Resident losoto server: run parset jobs sent over a UNIX socket
+
+import os, sys, time, json, socket, threading
+import logging
+import multiprocessing
+if (sys.version_info > (3, 0)):
+    import socketserver
+    import queue
+else:
+    import SocketServer as socketserver
+    import Queue as queue
+
+from losoto import _logging
+
+
+class _listHandler(logging.Handler):
+    """
+    Logging handler that stores (level, message) of each record to send them to the client.
+    """
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append((record.levelno, record.getMessage()))
+
+
+def _closeFile(H):
+    """
+    Close an h5parm, and stop the processes kept alive by the operations:
+    they were forked while the file was open and still hold its descriptor.
+    """
+    from losoto.lib_operations import multiprocManager
+    H.close()
+    multiprocManager.stopAll()
+
+
+def _runJob(files, job, maxFiles):
+    """
+    Run a job inside a worker process.
+
+    Parameters
+    ----------
+    files : OrderedDict
+        {h5parmFile:[h5parm obj, Pipeline obj, (mtime, size)]} open files, the last is the most recently used.
+    job : dict
+        {'h5parm':h5parm filename, 'parset':parset text, 'loglevel':'warning'/'info'/'debug'}.
+    maxFiles : int
+        Max number of h5parm kept open.
+
+    Returns
+    -------
+    dict
+        {'returncode':int, 'results':list of step results, 'log':list of (level, message), 'files':open h5parm filenames}
+    """
+    from losoto.h5parm import h5parm
+    from losoto.lib_losoto import LosotoParser
+    from losoto.pipeline import Pipeline
+
+    def fileStat(fileName):
+        stat = os.stat(fileName)
+        return (stat.st_mtime, stat.st_size)
+
+    handler = _listHandler()
+    logging.root.handlers.insert(0, handler) # before the coloring handler
+    oldLevel = logging.root.level
+    _logging.setLevel(job.get('loglevel', 'info'))
+    returncode = 0
+    results = []
+    try:
+        fileName = str(job['h5parm'])
+
+        # the file was modified by someone else: reopen it
+        if fileName in files and files[fileName][2] != fileStat(fileName):
+            logging.debug('File %s changed on disk, reopening.' % fileName)
+            _closeFile(files.pop(fileName)[0])
+
+        if fileName in files:
+            files[fileName] = files.pop(fileName) # mark as most recently used
+        else:
+            while len(files) >= maxFiles:
+                oldFileName, (H, pipeline, stat) = files.popitem(last=False)
+                logging.debug('Closing %s.' % oldFileName)
+                _closeFile(H)
+            H = h5parm(fileName, readonly=False)
+            files[fileName] = [H, Pipeline(H), None]
+
+        H, pipeline, stat = files[fileName]
+        results = pipeline.run(LosotoParser(parsetText=job['parset']))
+        H.H.flush()
+        files[fileName][2] = fileStat(fileName)
+        returncode = int(any([r['returncode'] != 0 for r in results]))
+    except Exception as e:
+        logging.error('Job failed: %s' % str(e))
+        returncode = 1
+        # do not trust a file left in an unknown state
+        if 'fileName' in locals() and fileName in files:
+            _closeFile(files.pop(fileName)[0])
+    finally:
+        logging.root.removeHandler(handler)
+        logging.root.setLevel(oldLevel)
+
+    return {'returncode':returncode, 'results':results, 'log':handler.records, 'files':list(files.keys())}
+
+
+def _worker(inQueue, outQueue, maxFiles, maxPools):
+    """
+    Worker process: import all operations once and then run jobs until a None is received.
+    The processes started by the operations (multiprocManager) are kept alive between jobs,
+    up to maxPools sets of them.
+    """
+    import signal
+    from collections import OrderedDict
+    import losoto.operations as operations
+    from losoto.lib_operations import multiprocManager
+
+    # the server takes care of stopping the workers (also on ctrl-c)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1)) # exit cleanly, stopping the processes kept alive
+
+    for op in operations.ops:
+        try:
+            operations.getOperation(op)
+        except ImportError as e:
+            logging.debug('Cannot preload operation %s: %s' % (op, str(e)))
+
+    multiprocManager.keepAlive(maxPools)
+    files = OrderedDict()
+    while True:
+        job = inQueue.get()
+        if job is None: break
+        outQueue.put(_runJob(files, job, maxFiles))
+
+    for H, pipeline, stat in files.values():
+        H.close()
+    multiprocManager.stopAll()
+
+
+class _workerProc(object):
+    """
+    A resident worker process, with its queues and the list of h5parm it keeps open.
+    """
+    def __init__(self, maxFiles, maxPools):
+        self.maxFiles = maxFiles
+        self.maxPools = maxPools
+        self.busy = False
+        self.lastUsed = 0.
+        self.start()
+
+    def start(self):
+        self.files = []
+        self.inQueue = multiprocessing.Queue()
+        self.outQueue = multiprocessing.Queue()
+        # not daemonic: operations spawn their own processes (multiprocManager)
+        self.proc = multiprocessing.Process(target=_worker, args=(self.inQueue, self.outQueue, self.maxFiles, self.maxPools))
+        self.proc.start()
+
+    def run(self, job):
+        self.inQueue.put(job)
+        while True:
+            try:
+                response = self.outQueue.get(timeout=1)
+                break
+            except queue.Empty:
+                if not self.proc.is_alive():
+                    logging.error('Worker died (exitcode: %s), restarting it.' % self.proc.exitcode)
+                    self.start()
+                    return {'returncode':1, 'results':[], 'files':[], 'log':[(logging.ERROR, 'Worker died while running the job.')]}
+        self.files = response['files']
+        return response
+
+    def stop(self, timeout=10):
+        """
+        Ask the worker to close its files and exit, kill it if it does not within timeout seconds.
+        """
+        if self.proc.is_alive():
+            self.inQueue.put(None)
+            self.proc.join(timeout)
+        if self.proc.is_alive():
+            logging.warning('Worker did not stop, terminating it.')
+            self.proc.terminate()
+            self.proc.join()
+
+
+class losotoServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Server that accepts jobs (h5parm filename + parset) over a UNIX socket.
+    Jobs on the same h5parm are queued and always go to the worker which keeps
+    that file open (with its cached data), jobs on different files run concurrently.
+
+    Parameters
+    ----------
+    socketFile : str
+        Path of the UNIX socket.
+    nWorkers : int, optional
+        Number of worker processes, if 0 use all available cpus, by default 0.
+    maxFiles : int, optional
+        Max number of h5parm kept open by each worker, by default 4.
+    maxPools : int, optional
+        Max number of sets of operation processes (one per operation function) each
+        worker keeps alive between jobs, by default 8.
+    """
+    daemon_threads = True
+
+    def __init__(self, socketFile, nWorkers=0, maxFiles=4, maxPools=8):
+        if os.path.exists(socketFile):
+            os.remove(socketFile)
+        socketserver.UnixStreamServer.__init__(self, socketFile, _jobHandler)
+        self.socketFile = socketFile
+        if nWorkers == 0: nWorkers = multiprocessing.cpu_count()
+        logging.info('Spawning %i workers...' % nWorkers)
+        self.workers = [_workerProc(maxFiles, maxPools) for i in range(nWorkers)]
+        self.cond = threading.Condition()
+
+
+    def acquireWorker(self, fileName):
+        """
+        Wait for the worker that has fileName open, or for any free worker if the file is not open.
+        """
+        with self.cond:
+            while True:
+                owner = [w for w in self.workers if fileName in w.files]
+                if owner:
+                    # never open the same file in two workers
+                    if not owner[0].busy:
+                        owner[0].busy = True
+                        return owner[0]
+                else:
+                    free = [w for w in self.workers if not w.busy]
+                    if free:
+                        w = min(free, key=lambda w: (len(w.files), w.lastUsed))
+                        w.busy = True
+                        w.files.append(fileName)
+                        return w
+                self.cond.wait()
+
+
+    def releaseWorker(self, worker):
+        with self.cond:
+            worker.busy = False
+            worker.lastUsed = time.time()
+            self.cond.notify_all()
+
+
+    def runJob(self, job):
+        worker = self.acquireWorker(job['h5parm'])
+        try:
+            return worker.run(job)
+        finally:
+            self.releaseWorker(worker)
+
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        for w in self.workers:
+            w.stop()
+        if os.path.exists(self.socketFile):
+            os.remove(self.socketFile)
+
+
+class _jobHandler(socketserver.StreamRequestHandler):
+    """
+    Read a json job (one line), run it and answer with a json response (one line).
+    """
+    def handle(self):
+        try:
+            job = json.loads(self.rfile.readline().decode('utf-8'))
+            logging.info('Job on %s.' % job['h5parm'])
+        except (ValueError, KeyError, TypeError) as e:
+            logging.error('Malformed job: %s' % str(e))
+            response = {'returncode':1, 'results':[], 'files':[], 'log':[(logging.ERROR, 'Malformed job: %s' % str(e))]}
+        else:
+            response = self.server.runJob(job)
+        self.wfile.write((json.dumps(response)+'\n').encode('utf-8'))
+
+
+def serve(socketFile, nWorkers=0, maxFiles=4, maxPools=8):
+    """
+    Run the server until interrupted.
+
+    Parameters
+    ----------
+    socketFile : str
+        Path of the UNIX socket.
+    nWorkers : int, optional
+        Number of worker processes, if 0 use all available cpus, by default 0.
+    maxFiles : int, optional
+        Max number of h5parm kept open by each worker, by default 4.
+    maxPools : int, optional
+        Max number of sets of operation processes (one per operation function) each
+        worker keeps alive between jobs, by default 8.
+    """
+    import signal
+    server = losotoServer(socketFile, nWorkers, maxFiles, maxPools)
+    # stop cleanly also on "kill"
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logging.info('Listening on %s.' % socketFile)
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        logging.info('Stopping server.')
+    finally:
+        server.server_close()
+
+
+def submit(socketFile, h5parmFile, parsetFile, loglevel='info'):
+    """
+    Send a job to a running server and wait for it to finish.
+    Log messages produced by the job are re-emitted locally.
+
+    Parameters
+    ----------
+    socketFile : str
+        Path of the UNIX socket.
+    h5parmFile : str
+        H5parm filename.
+    parsetFile : str
+        LoSoTo parset filename.
+    loglevel : str, optional
+        Verbosity of the job: 'warning', 'info' or 'debug', by default 'info'.
+
+    Returns
+    -------
+    dict
+        {'returncode':int, 'results':list of step results (see Pipeline.runStep())}
+    """
+    job = {'h5parm':os.path.abspath(h5parmFile), 'parset':open(parsetFile).read(), 'loglevel':loglevel}
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.connect(socketFile)
+    try:
+        s.sendall((json.dumps(job)+'\n').encode('utf-8'))
+        response = json.loads(s.makefile('rb').readline().decode('utf-8'))
+    finally:
+        s.close()
+
+    for level, msg in response.pop('log'):
+        logging.log(level, msg)
+
+    return response
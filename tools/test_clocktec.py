@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from losoto.operations._fitClockTEC import joinSegments, getDesignMatrix, _lstsqOperator
+import unittest
+import numpy as np
+
+class TestJoinSegments(unittest.TestCase):
+    def setUp(self):
+      freqs = np.linspace(120e6, 180e6, 40)
+      # tec/clock change of a 2pi phase wrap in all the channels
+      self.steps = np.dot(_lstsqOperator(getDesignMatrix(freqs), np.zeros(len(freqs), dtype=bool)), 2*np.pi*np.ones(len(freqs)))
+      nT = 100
+      t = np.arange(nT)
+      self.tec = 0.05*np.sin(t/20.)
+      self.clock = 3. + 0.01*t
+      self.residual = np.random.RandomState(0).randn(nT, len(freqs))
+      self.tec[60] = -10 # failed fit
+      self.bounds = [(0, 34), (34, 67), (67, 100)]
+      self.overlap = 10
+
+    def segments(self, wraps):
+      results = []
+      for (start, end), nwraps in zip(self.bounds, wraps):
+        times = slice(max(0, start-self.overlap), end)
+        tec, clock = self.tec[times].copy(), self.clock[times].copy()
+        good = tec > -5
+        tec[good] += nwraps*self.steps[0]
+        clock[good] += nwraps*self.steps[1]
+        results.append((tec, clock, self.residual[times]))
+      return results
+
+    def test_wrap_offsets(self):
+      # each segment is shifted to match the previous one in the overlap
+      tec, clock, residual = joinSegments(self.segments([0, 1, -2]), self.bounds, self.overlap, self.steps)
+      self.assertTrue(np.allclose(tec, self.tec))
+      self.assertTrue(np.allclose(clock, self.clock))
+      self.assertTrue(np.array_equal(residual, self.residual))
+
+      # the first segment sets the wrap of the joined solution
+      tec, clock, residual = joinSegments(self.segments([2, 0, 1]), self.bounds, self.overlap, self.steps)
+      good = self.tec > -5
+      self.assertTrue(np.allclose(tec[good], self.tec[good] + 2*self.steps[0]))
+      self.assertTrue(np.allclose(clock[good], self.clock[good] + 2*self.steps[1]))
+      self.assertEqual(tec[60], -10)
+
+if __name__ == '__main__':
+    unittest.main()
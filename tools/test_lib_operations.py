@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from losoto.lib_operations import nanRunningMedian, nanRunningPoly, nanSavitzkyGolay, runningSum, nanRunningRms, nanUnwrap, phaseGridSearch, multiprocManager
+import unittest
+import warnings
+import numpy as np
+import os
+
+def _pid(i, outQueue):
+    outQueue.put([i, os.getpid()])
+
+class TestRunningMedian(unittest.TestCase):
+    def setUp(self):
+      rng = np.random.RandomState(1)
+      self.vals = rng.randn(4, 30, 20)
+      self.vals[rng.rand(*self.vals.shape) < 0.3] = np.nan
+      self.vals[1, :5, :] = np.nan # completely flagged windows
+
+    def reference(self, vals, size, mode):
+      from scipy.ndimage import generic_filter
+      with warnings.catch_warnings():
+        warnings.simplefilter('ignore') # all-NaN windows
+        return generic_filter(vals, np.nanmedian, size=size, mode=mode, cval=np.nan)
+
+    def test_generic_filter(self):
+      for size in [[1, 5, 1], [1, 4, 3], [1, 30, 20]]:
+        for mode in ['constant', 'reflect', 'nearest']:
+          ref = self.reference(self.vals, size, mode)
+          med = nanRunningMedian(self.vals, size[1:], mode=mode)
+          self.assertTrue(np.allclose(ref, med, equal_nan=True))
+
+    def test_axes_and_chunks(self):
+      ref = self.reference(self.vals, [3, 5, 1], 'constant')
+      for chunkSize in [10, 1000, 2**24]:
+        med = nanRunningMedian(self.vals, [5, 3], axes=[1, 0], chunkSize=chunkSize)
+        self.assertTrue(np.allclose(ref, med, equal_nan=True))
+
+class TestRunningPoly(unittest.TestCase):
+    def setUp(self):
+      rng = np.random.RandomState(2)
+      self.vals = rng.randn(6, 50)
+
+    def test_savitzky_golay(self):
+      # without NaNs it is a convolution with fixed coefficients
+      size, degree = 11, 2
+      half = size//2
+      b = np.array([[k**i for i in range(degree+1)] for k in range(-half, half+1)], dtype=float)
+      m = np.linalg.pinv(b)[0]
+      sg = nanSavitzkyGolay(self.vals, size, degree)
+      self.assertTrue(np.allclose(sg[:, half:-half], np.array([np.convolve(m[::-1], v, mode='valid') for v in self.vals])))
+
+      # NaNs have zero weight and do not spread
+      vals = self.vals.copy()
+      vals[0, 20] = np.nan
+      sg = nanSavitzkyGolay(vals, size, degree)
+      self.assertFalse(np.isnan(sg).any())
+      x = np.arange(-half, half+1)
+      y = vals[0, 20-half:20+half+1]
+      self.assertAlmostEqual(sg[0, 20], np.polyval(np.polyfit(x[~np.isnan(y)], y[~np.isnan(y)], degree), 0))
+
+    def test_running_poly(self):
+      vals = self.vals.copy()
+      vals[:, 10:16] = np.nan
+      for degree in [1, 2]:
+        rp = nanRunningPoly(vals.T, 5, degree, axis=0).T
+        for v, r in zip(vals, rp):
+          for i in [0, 9, 12, 30, 49]:
+            y = np.pad(v, 2, mode='constant', constant_values=np.nan)[i:i+5]
+            x = np.arange(-2, 3)[~np.isnan(y)]
+            if len(x) == 0:
+              self.assertTrue(np.isnan(r[i]))
+            else:
+              self.assertAlmostEqual(r[i], np.polynomial.polynomial.polyval(0, np.polynomial.polynomial.polyfit(x, y[~np.isnan(y)], degree)))
+
+class TestRunningRms(unittest.TestCase):
+    def test_running_sum(self):
+      from scipy.ndimage import uniform_filter
+      vals = np.random.RandomState(0).randn(3, 40, 30)
+      for mode in ['constant', 'mirror', 'nearest']:
+        ref = uniform_filter(vals, size=(1, 4, 5), mode=mode) * 20
+        self.assertTrue(np.allclose(ref, runningSum(vals, [5, 4], axes=[2, 1], mode=mode)))
+
+    def test_running_rms(self):
+      from scipy.ndimage import generic_filter
+      vals = np.random.RandomState(1).randn(40, 30) + 10
+      vals[5:12, 3:9] = np.nan
+      with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        ref = generic_filter(vals, np.nanstd, size=(5, 3), mode='mirror')
+      self.assertTrue(np.allclose(ref, nanRunningRms(vals, [5, 3]), equal_nan=True))
+
+class TestUnwrap(unittest.TestCase):
+    def test_nan_unwrap(self):
+      vals = np.cumsum(np.random.RandomState(2).randn(6, 50), axis=1) * 2
+      vals = np.mod(vals + np.pi, 2*np.pi) - np.pi
+      vals[0, :3] = np.nan
+      vals[1, 10:20] = np.nan
+      vals[2, -1] = np.nan
+      vals[3] = np.nan
+      uw = nanUnwrap(vals.T, axis=0).T
+      for v, u in zip(vals, uw):
+        valid = ~np.isnan(v)
+        self.assertTrue((np.isnan(u) == ~valid).all())
+        self.assertTrue(np.allclose(u[valid], np.unwrap(v[valid])))
+
+class TestGridSearch(unittest.TestCase):
+    def test_chunks(self):
+      rng = np.random.RandomState(3)
+      freqs = np.linspace(30e6, 70e6, 24)
+      basis = -8.44797245e9/freqs
+      dTEC = rng.uniform(-0.3, 0.3, 1000)
+      Z = np.exp(1j*(np.outer(basis, dTEC) + rng.normal(0, 0.3, (len(freqs), len(dTEC)))))
+      Z[:, :10] = 0 # no data
+      p, score = phaseGridSearch(Z, basis, -0.4, 0.4)
+      self.assertTrue(np.allclose(p[10:], dTEC[10:], atol=0.01))
+      self.assertTrue((score[:10] == 0).all())
+      # the series and the grid are processed in blocks of at most chunkSize elements
+      for chunkSize in [1, 100, 3000, 2**16]:
+        pc, scorec = phaseGridSearch(Z, basis, -0.4, 0.4, chunkSize=chunkSize)
+        self.assertTrue(np.array_equal(p, pc))
+        self.assertTrue(np.allclose(score, scorec))
+
+class TestMultiprocManager(unittest.TestCase):
+    def tearDown(self):
+      multiprocManager.keepAlive(0)
+
+    def run_jobs(self):
+      mpm = multiprocManager(2, _pid)
+      for i in range(6):
+        mpm.put([i])
+      mpm.wait()
+      results = sorted(mpm.get())
+      self.assertEqual([i for i, pid in results], list(range(6)))
+      return set([pid for i, pid in results])
+
+    def test_keep_alive(self):
+      # processes are stopped at each wait()
+      self.assertTrue(self.run_jobs().isdisjoint(self.run_jobs()))
+      # processes are reused
+      multiprocManager.keepAlive(1)
+      self.run_jobs()
+      self.assertTrue(self.run_jobs() <= set([t.pid for t in multiprocManager._pools[(2, _pid)][0]]))
+      self.assertEqual(len(multiprocManager._pools), 1)
+      multiprocManager.stopAll()
+      self.assertEqual(len(multiprocManager._pools), 0)
+
+if __name__ == '__main__':
+    unittest.main()
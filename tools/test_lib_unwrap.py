@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from losoto.lib_unwrap import unwrap, unwrap_fft, unwrap_huib, unwrap_2d
+import unittest
+import numpy as np
+
+class TestUnwrap(unittest.TestCase):
+    def setUp(self):
+      t = np.linspace(0, 1, 100)
+      self.true = np.array([20*t**2, -15*t, 3*np.sin(10*t)])
+      self.phase = np.angle(np.exp(1j*self.true))
+
+    def test_batched(self):
+      for funct in [unwrap, unwrap_fft]:
+        out = funct(self.phase)
+        self.assertEqual(out.shape, self.phase.shape)
+        for i in range(len(self.phase)):
+          self.assertTrue(np.allclose(out[i], funct(self.phase[i])))
+          # unwrapped up to a constant 2pi offset
+          self.assertTrue(np.allclose(np.diff(out[i]), np.diff(self.true[i])))
+
+      out = unwrap_huib(np.degrees(self.phase))
+      for i in range(len(self.phase)):
+        self.assertTrue(np.allclose(out[i], unwrap_huib(np.degrees(self.phase[i]))))
+
+    def test_known_trend(self):
+      # linear ramps starting in [-pi, pi]: the unwrapped phase is the analytic one
+      truth = 0.3 + np.outer([0.1, -0.25, 0.4], np.arange(100.))
+      wrapped = np.angle(np.exp(1j*truth))
+      self.assertTrue(np.allclose(unwrap(wrapped), truth))
+      # the FFT method is defined up to a constant multiple of 2pi
+      offset = (unwrap_fft(wrapped) - truth) / (2*np.pi)
+      self.assertTrue(np.allclose(offset, np.round(offset[:,:1])))
+      # the adaptive filter needs slowly varying phases
+      truthDeg = np.degrees(0.3 + np.outer([0.1, -0.05], np.arange(100.)))
+      self.assertTrue(np.allclose(unwrap_huib(np.mod(truthDeg+180., 360.)-180.), truthDeg))
+
+      x, y = np.arange(16.), np.arange(20.)
+      truth = 0.3 + 0.7*x[:,np.newaxis] - 0.4*y[np.newaxis,:]
+      offset = (unwrap_2d(np.angle(np.exp(1j*truth))) - truth) / (2*np.pi)
+      self.assertTrue(np.allclose(offset, np.round(offset[0,0])))
+
+    def test_batched_2d(self):
+      x, y = np.arange(16.), np.arange(20.)
+      planes = np.array([np.add.outer(x, y)*0.5*(i+1) for i in range(3)])
+      wrapped = np.angle(np.exp(1j*planes))
+      flags = np.zeros(planes.shape, dtype=bool)
+      flags[1, 3:5, 7] = True
+      out = unwrap_2d(wrapped, flags, x, y)
+      for i in range(len(planes)):
+        self.assertTrue(np.allclose(out[i], unwrap_2d(wrapped[i], flags[i], x, y)))
+        # flagged points are filled with the nearest value
+        self.assertTrue(np.allclose((out[i] - out[i,0,0])[~flags[i]], (planes[i] - planes[i,0,0])[~flags[i]]))
+      self.assertTrue(np.allclose(unwrap_2d(wrapped, flags, x, y, ncpu=2), out))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from losoto.h5parm import h5parm
+from losoto import server
+import unittest
+import numpy as np
+import os, json, socket, tempfile, threading
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+      self.h5fname = tempfile.mktemp(suffix='.h5')
+      self.parsetfname = tempfile.mktemp(suffix='.parset')
+      self.socketfname = tempfile.mktemp(suffix='.sock')
+
+      h5 = h5parm(self.h5fname, readonly=False)
+      solset = h5.makeSolset("sol000")
+      vals = np.random.RandomState(0).normal(0, 0.1, (4, 50))
+      vals[1, 10] = 3. # outlier
+      solset.makeSoltab(soltype="phase", soltabName="phase000",
+                        axesNames=["ant","time"],
+                        axesVals=[["CS001", "CS002", "RS106", "RS208"], np.arange(50.)],
+                        vals=vals, weights=np.ones_like(vals))
+      h5.close()
+
+      # FLAG spawns its own processes (multiprocManager) inside the server worker
+      with open(self.parsetfname, 'w') as f:
+        f.write("ncpu = 2\n\n[flag]\noperation = FLAG\naxesToFlag = [time]\norder = [5]\nmode = smooth\n")
+
+      self.server = server.losotoServer(self.socketfname, nWorkers=1)
+      self.thread = threading.Thread(target=self.server.serve_forever)
+      self.thread.start()
+
+    def stopServer(self):
+      if self.thread.is_alive():
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def tearDown(self):
+      self.stopServer()
+      os.remove(self.h5fname)
+      os.remove(self.parsetfname)
+
+    def test_multiprocessing_job(self):
+      # the second job reuses the FLAG processes kept alive by the server worker
+      for i in range(2):
+        response = server.submit(self.socketfname, self.h5fname, self.parsetfname, loglevel='debug')
+        self.assertEqual(response['returncode'], 0)
+
+      # the file is kept open by the worker: close it before reading
+      self.stopServer()
+      h5 = h5parm(self.h5fname, readonly=True)
+      weights = h5.getSolset("sol000").getSoltab("phase000").getValues(retAxesVals=False, weight=True)
+      h5.close()
+      self.assertEqual(weights[1, 10], 0)
+
+    def test_malformed_job(self):
+      s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      s.connect(self.socketfname)
+      s.sendall(b'{"parset": "\n')
+      response = json.loads(s.makefile('rb').readline().decode('utf-8'))
+      s.close()
+      self.assertEqual(response['returncode'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+from losoto.h5parm import h5parm
+import unittest
+import numpy as np
+import os
+
+class TestSoltabMetadata(unittest.TestCase):
+    def setUp(self):
+      import tempfile
+      self.h5fname = tempfile.mktemp(suffix='.h5')
+
+      h5 = h5parm(self.h5fname, readonly=False)
+      solset = h5.makeSolset("sol000")
+
+      antvals = ["CS001", "CS002", "RS106", "RS208"]
+      timevals = np.arange(0, 5)
+      freqvals = np.arange(0, 3)
+
+      vals = np.arange(4*5*3, dtype=float).reshape((4, 5, 3))
+      solset.makeSoltab(soltype="amplitude", soltabName="amplitude000",
+                        axesNames=["ant","time","freq"],
+                        axesVals=[antvals, timevals, freqvals],
+                        vals=vals, weights=np.ones_like(vals))
+      h5.close()
+
+    def tearDown(self):
+      os.remove(self.h5fname)
+
+    def test_shape_size_dtype(self):
+      h5 = h5parm(self.h5fname, readonly=True)
+      soltab = h5.getSolset("sol000").getSoltab("amplitude000")
+
+      self.assertEqual(soltab.shape, (4, 5, 3))
+      self.assertEqual(soltab.size, 60)
+      self.assertEqual(soltab.dtype, np.float64)
+
+      soltab.setSelection(ant=["CS001", "RS106"], time={'min':1, 'max':4, 'step':2})
+      self.assertEqual(soltab.shape, soltab.getValues(retAxesVals=False).shape)
+      self.assertEqual(soltab.shape, (2, 2, 3))
+      self.assertEqual(soltab.size, 12)
+      self.assertEqual(list(soltab.ant), ["CS001", "RS106"])
+      self.assertEqual(list(soltab.time), [1, 3])
+
+      # returned axes values are copies
+      ant = soltab.ant
+      ant[0] = "XXX"
+      self.assertEqual(soltab.ant[0], "CS001")
+
+      h5.close()
+
+    def test_values_iter_selection(self):
+      h5 = h5parm(self.h5fname, readonly=True)
+      soltab = h5.getSolset("sol000").getSoltab("amplitude000")
+      soltab.setSelection(ant=["CS002", "RS208"], time={'min':2})
+
+      vals = soltab.getValues(retAxesVals=False)
+      n = 0
+      for v, coord, sel in soltab.getValuesIter(returnAxes=['freq']):
+        i = ["CS002", "RS208"].index(coord['ant'])
+        j = [2, 3, 4].index(coord['time'])
+        self.assertTrue(np.array_equal(v, vals[i, j]))
+        # the selection points to the same data in the complete table
+        self.assertEqual(sel[0], [["CS001", "CS002", "RS106", "RS208"].index(coord['ant'])])
+        self.assertEqual(sel[1], [coord['time']])
+        n += 1
+      self.assertEqual(n, 6)
+
+      h5.close()
+
+if __name__ == '__main__':
+    unittest.main()